@@ -0,0 +1,107 @@
+from decimal import Decimal
+from fractions import Fraction
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+
+WEI = 10**18
+# Boosts are floats, they are turned into integers with this many decimals before weighting votes
+BOOST_SCALE = 10**18
+
+
+def to_wei(amount: Union[int, float, str, Decimal]) -> int:
+    """
+    Token amount to integer wei, rounding down. Floats go through their shortest repr, so 0.1 is exactly
+    10**17 wei rather than the wei value of its binary expansion
+    """
+    if isinstance(amount, float):
+        amount = repr(amount)
+    return int(Decimal(amount) * WEI)
+
+
+def percent_of_wei(total_wei: int, percent: Union[int, float, str, Decimal]) -> int:
+    """
+    `percent`% of `total_wei`, rounding down
+    """
+    if isinstance(percent, float):
+        percent = repr(percent)
+    return int(total_wei * Decimal(percent) / 100)
+
+
+def boost_to_int(boost: float) -> int:
+    return round(boost * BOOST_SCALE)
+
+
+def apportion(total_wei: int, weights: Sequence[int]) -> np.ndarray:
+    """
+    Split `total_wei` proportionally to integer `weights` with the largest remainder method: everyone gets
+    the floor of their exact share, and the wei those floors leave over go one each to the largest
+    remainders, ties to the first entry. The result always sums to `total_wei` exactly, unless every
+    weight is 0, in which case nothing is handed out. Returns an object array of python ints
+    """
+    weights = np.asarray(weights, dtype=object)
+    total_weight = weights.sum() if len(weights) else 0
+    if total_weight <= 0 or total_wei <= 0:
+        return np.zeros(len(weights), dtype=object)
+    products = weights * total_wei
+    shares = products // total_weight
+    remainders = products % total_weight
+    missing = total_wei - shares.sum()
+    if missing:
+        order = np.argsort(-remainders, kind="stable")
+        shares[order[:missing]] += 1
+    return shares
+
+
+def water_fill_wei(
+    amounts: Sequence[int],
+    caps: Sequence[int],
+    weights: Sequence[int],
+    to_distribute: int,
+) -> Tuple[np.ndarray, int]:
+    """
+    Distribute `to_distribute` wei on top of `amounts` proportionally to integer `weights`, never pushing an
+    entry past its cap. Whatever a capped entry can't take flows to the remaining ones, again proportionally
+    to weight.
+
+    Every entry receives min(level * weight, headroom) for a single water level, found by sorting entries
+    by the level at which they fill up, so this runs in O(n log n) and needs no iteration to converge.
+    The entries below their cap split what's left between them with `apportion`, so no wei is lost to
+    rounding. Returns the new amounts and the leftover that could not be placed because every entry with
+    weight reached its cap
+    """
+    amounts = np.asarray(amounts, dtype=object)
+    caps = np.asarray(caps, dtype=object)
+    weights = np.asarray(weights, dtype=object)
+    headrooms = np.maximum(caps - amounts, 0) if len(amounts) else amounts.copy()
+    eligible = [i for i in range(len(amounts)) if weights[i] > 0 and headrooms[i] > 0]
+    new_amounts = amounts.copy()
+    if to_distribute <= 0 or not eligible:
+        return new_amounts, max(to_distribute, 0)
+    # Order entries by the water level at which they hit their cap, compared exactly as fractions
+    eligible.sort(key=lambda i: Fraction(headrooms[i], weights[i]))
+    eligible = np.asarray(eligible)
+    eligible_headrooms = headrooms[eligible]
+    eligible_weights = weights[eligible]
+    # Wei placed in all entries before each position once they are full, and the weight still taking water
+    filled_before = np.concatenate(
+        (np.zeros(1, dtype=object), np.cumsum(eligible_headrooms)[:-1])
+    )
+    active_weights = np.cumsum(eligible_weights[::-1])[::-1]
+    # The water level settles at the first entry whose cap holds, i.e.
+    # filled + headroom / weight * active_weight >= to_distribute, multiplied out to stay in integers
+    settles = (
+        filled_before * eligible_weights + eligible_headrooms * active_weights
+        >= to_distribute * eligible_weights
+    )
+    if not settles.any():
+        new_amounts[eligible] += eligible_headrooms
+        return new_amounts, to_distribute - int(eligible_headrooms.sum())
+    position = int(np.argmax(settles))
+    new_amounts[eligible[:position]] += eligible_headrooms[:position]
+    new_amounts[eligible[position:]] += apportion(
+        to_distribute - int(filled_before[position]), eligible_weights[position:]
+    )
+    return new_amounts, 0
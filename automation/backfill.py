@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import TYPE_CHECKING
+
+from automation.emissions_per_year import get_emissions_per_week
+from automation.helpers import EpochProtocolFeeReducer
+from automation.helpers import fetch_all_pools_info
+from automation.helpers import get_block_by_ts
+from automation.helpers import get_root_gauge_recipients
+from automation.helpers import get_subgraph_url
+from automation.helpers import reduce_pool_snapshots_between_timestamps
+from automation.lstGrant import EpochInputs
+from automation.lstGrant import calculate_gauge_distributions
+from automation.lstGrant import fetch_gauge_weights
+from automation.lstGrant import get_bal_token_price
+from automation.lstGrant import get_epoch_dates
+from automation.lstGrant import get_mainnet_web3
+from automation.lstGrant import get_program_gauges
+from automation.lstGrant import get_root_dir
+from automation.lstGrant import save_program_outputs
+from automation.metrics import propagate
+from automation.metrics import record_metrics
+from automation.metrics import stage
+from automation.program_config import ProgramConfig
+
+if TYPE_CHECKING:
+    from web3 import Web3
+
+EPOCH_LENGTH_SECONDS = 14 * 24 * 60 * 60
+# Recomputed epochs never overwrite the csvs, payloads and history of the runs that were executed
+BACKFILL_OUTPUT_SUBDIR = "backfill"
+
+
+def plan_epochs(from_ts: int, to_ts: int) -> List[int]:
+    """
+    End timestamps of all epochs to backfill: every two weeks starting at `from_ts`, up to `to_ts` inclusive
+    """
+    if to_ts < from_ts:
+        raise ValueError(f"Backfill range ends before it starts: {from_ts} > {to_ts}")
+    return list(range(from_ts, to_ts + 1, EPOCH_LENGTH_SECONDS))
+
+
+@stage("fee_snapshots")
+def fetch_pool_fees_by_epoch(
+    chain: str, epoch_ends: List[int], max_workers: Optional[int] = None
+) -> List[Dict[str, float]]:
+    """
+    Protocol fees collected per pool for every epoch, from a single pass over the snapshots of the whole
+    range. Consecutive epochs tile the range, so every snapshot is reduced into exactly one epoch
+    """
+    edges = [epoch_ends[0] - EPOCH_LENGTH_SECONDS] + epoch_ends
+    reducer = reduce_pool_snapshots_between_timestamps(
+        get_subgraph_url(chain, "core"),
+        edges[0],
+        edges[-1],
+        num_slices=7 * len(epoch_ends),
+        reducer_factory=lambda: EpochProtocolFeeReducer(edges),
+        max_workers=max_workers or 8,
+    )
+    return [epoch_reducer.fees_collected() for epoch_reducer in reducer.reducers]
+
+
+def fetch_gauge_weights_by_epoch(
+    web3: Web3,
+    gauge_addrs: List[str],
+    target_blocks: List[int],
+    max_workers: Optional[int] = None,
+) -> List[Dict[str, int]]:
+    """
+    Gauge weights at every epoch's target block, one multicall per block with a few blocks in flight at once
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or 4) as executor:
+        return list(
+            executor.map(
+                propagate(lambda block: fetch_gauge_weights(web3, gauge_addrs, block)),
+                target_blocks,
+            )
+        )
+
+
+def run_backfill(
+    from_ts: int,
+    to_ts: int,
+    configs: List[ProgramConfig],
+    max_workers: Optional[int] = None,
+) -> None:
+    """
+    Recompute every epoch between `from_ts` and `to_ts` for the given programs. All inputs are fetched once
+    for the whole range up front: the voting list, the fee snapshots of each chain, the BAL price history
+    and the gauge weights at every epoch block. Epochs are then computed from that shared data set.
+    Outputs, and the timing and request counts per stage of the whole backfill, go to output/backfill
+    """
+    epoch_ends = plan_epochs(from_ts, to_ts)
+    first_start, _ = get_epoch_dates(epoch_ends[0])
+    _, last_end = get_epoch_dates(epoch_ends[-1])
+    with record_metrics(
+        f"{get_root_dir()}/output/{BACKFILL_OUTPUT_SUBDIR}/backfill_{first_start.date()}_{last_end.date()}_metrics.json",
+        programs=[config.file_prefix for config in configs],
+        epochEnds=epoch_ends,
+    ):
+        _run_backfill(epoch_ends, configs, max_workers)
+
+
+def _run_backfill(
+    epoch_ends: List[int], configs: List[ProgramConfig], max_workers: Optional[int]
+) -> None:
+    print(
+        f"Backfilling {len(epoch_ends)} epochs for {', '.join(c.file_prefix for c in configs)}: "
+        f"{datetime.fromtimestamp(epoch_ends[0]).date()} - {datetime.fromtimestamp(epoch_ends[-1]).date()}"
+    )
+    web3_mainnet = get_mainnet_web3()
+
+    # The voting list only comes as of now, so gauges killed since an epoch are left out of it
+    voting_list = fetch_all_pools_info("mainnet")
+    gauges_by_program = {
+        config.file_prefix: get_program_gauges(config, voting_list)
+        for config in configs
+    }
+    gauge_addrs = sorted(
+        {addr for gauges in gauges_by_program.values() for addr in gauges.keys()}
+    )
+    recipient_gauges = get_root_gauge_recipients(web3_mainnet, gauge_addrs)
+
+    target_blocks = [
+        get_block_by_ts(end_ts, chain="mainnet", web3=web3_mainnet)
+        for end_ts in epoch_ends
+    ]
+    weights_by_epoch = fetch_gauge_weights_by_epoch(
+        web3_mainnet, gauge_addrs, target_blocks, max_workers
+    )
+    fees_by_chain = {
+        chain: fetch_pool_fees_by_epoch(chain, epoch_ends, max_workers)
+        for chain in {config.chain_name for config in configs}
+    }
+    # Oldest epoch first: its lookup fills the price store for the whole range, the rest are local TWAPs.
+    # Spot prices make no sense for past epochs, so every epoch uses the BAL TWAP leading up to its end
+    bal_prices = [
+        get_bal_token_price(start_date=datetime.fromtimestamp(end_ts))
+        for end_ts in epoch_ends
+    ]
+    emissions_per_week = get_emissions_per_week()
+
+    for epoch_index, end_ts in enumerate(epoch_ends):
+        start_date, end_date = get_epoch_dates(end_ts)
+        print(
+            f"Computing epoch {start_date.date()} - {end_date.date()} at block {target_blocks[epoch_index]}"
+        )
+        for config in configs:
+            # calculate_gauge_distributions annotates the gauges, so every epoch gets its own copy
+            gauges = {
+                addr: dict(gauge)
+                for addr, gauge in gauges_by_program[config.file_prefix].items()
+            }
+            inputs = EpochInputs(
+                target_block=target_blocks[epoch_index],
+                gauges=gauges,
+                pool_fees=fees_by_chain[config.chain_name][epoch_index],
+                gauge_weights=weights_by_epoch[epoch_index],
+                bal_token_price=bal_prices[epoch_index],
+                emissions_per_week=emissions_per_week,
+                recipient_gauges=recipient_gauges,
+            )
+            gauge_distributions = calculate_gauge_distributions(config, inputs)
+            save_program_outputs(
+                config,
+                gauge_distributions,
+                start_date,
+                end_date,
+                inputs,
+                output_dir=f"{get_root_dir()}/output/{BACKFILL_OUTPUT_SUBDIR}",
+            )
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import bisect
+import threading
+from typing import Dict
+from typing import Optional
+from typing import TYPE_CHECKING
+from typing import Tuple
+
+from automation.cache import FactCache
+from automation.cache import get_fact_cache
+
+if TYPE_CHECKING:
+    from web3 import Web3
+
+
+class NodeBehindError(ValueError):
+    """
+    The node's head block is older than the timestamp looked up
+    """
+
+
+class BlockIndex:
+    """
+    Per chain timestamp -> block lookup. Every (block number, timestamp) pair we ever observe is kept as an
+    anchor in the persistent fact cache, so repeated and historical lookups are answered locally, and
+    the ones that aren't only need a few eth_getBlockByNumber calls between the closest known anchors
+    """
+
+    def __init__(self, chain: str, cache: Optional[FactCache] = None):
+        self.chain = chain
+        self._cache = cache or get_fact_cache()
+        self._lock = threading.Lock()
+        anchors = {
+            int(number): timestamp
+            for number, timestamp in self._cache.get_namespace(
+                self._anchors_namespace
+            ).items()
+        }
+        self._numbers = sorted(anchors.keys())
+        # Block timestamps never decrease with block number, so this list is sorted as well
+        self._timestamps = [anchors[number] for number in self._numbers]
+        self._resolved = {
+            int(timestamp): number
+            for timestamp, number in self._cache.get_namespace(
+                self._resolved_namespace
+            ).items()
+        }
+
+    @property
+    def _anchors_namespace(self) -> str:
+        return f"{self.chain}:block_timestamp"
+
+    @property
+    def _resolved_namespace(self) -> str:
+        return f"{self.chain}:block_by_timestamp"
+
+    def add_anchors(self, anchors: Dict[int, int]) -> None:
+        """
+        Record observed blocks, as block number -> block timestamp
+        """
+        with self._lock:
+            new_anchors = {}
+            for number, timestamp in anchors.items():
+                index = bisect.bisect_left(self._numbers, number)
+                if index < len(self._numbers) and self._numbers[index] == number:
+                    continue
+                self._numbers.insert(index, number)
+                self._timestamps.insert(index, timestamp)
+                new_anchors[str(number)] = timestamp
+        self._cache.set_many(self._anchors_namespace, new_anchors)
+
+    def set_resolved(self, timestamp: int, number: int) -> None:
+        with self._lock:
+            self._resolved[timestamp] = number
+        self._cache.set_many(self._resolved_namespace, {str(timestamp): number})
+
+    def bracket(
+        self, timestamp: int
+    ) -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+        """
+        Closest known anchors around `timestamp`: the last block strictly before it and the first block at or
+        after it, as (number, timestamp) tuples or None when there is no anchor on that side
+        """
+        with self._lock:
+            index = bisect.bisect_left(self._timestamps, timestamp)
+            before = (
+                (self._numbers[index - 1], self._timestamps[index - 1])
+                if index > 0
+                else None
+            )
+            after = (
+                (self._numbers[index], self._timestamps[index])
+                if index < len(self._numbers)
+                else None
+            )
+        return before, after
+
+    def lookup(self, timestamp: int) -> Optional[int]:
+        """
+        First block with a timestamp at or after `timestamp`, if it can be answered from local data
+        """
+        with self._lock:
+            if timestamp in self._resolved:
+                return self._resolved[timestamp]
+        before, after = self.bracket(timestamp)
+        if after is None:
+            return None
+        if before is None:
+            return after[0] if after[0] == 0 else None
+        # Anchors on adjacent blocks pin the answer down exactly
+        return after[0] if after[0] == before[0] + 1 else None
+
+    def find_with_rpc(self, web3: Web3, timestamp: int) -> int:
+        """
+        Narrow down the bracketing anchors with eth_getBlockByNumber, alternating interpolation steps
+        (few calls on evenly spaced blocks) with bisection steps (bounded worst case). Raises NodeBehindError
+        when the node has no block at or after `timestamp` yet
+        """
+        observed = {}
+
+        def _get_block(identifier) -> Tuple[int, int]:
+            block = web3.eth.get_block(identifier)
+            observed[block["number"]] = block["timestamp"]
+            return block["number"], block["timestamp"]
+
+        before, after = self.bracket(timestamp)
+        try:
+            if after is None:
+                after = _get_block("latest")
+                if after[1] < timestamp:
+                    # The node is behind, its head can't stand in for the block: it would be cached for good
+                    raise NodeBehindError(
+                        f"Node head block {after[0]} is older than timestamp {timestamp}, the node is not synced"
+                    )
+            if before is None:
+                before = _get_block(0)
+                if before[1] >= timestamp:
+                    return before[0]
+            step = 0
+            while after[0] - before[0] > 1:
+                if step % 2 == 0:
+                    guess = before[0] + (timestamp - before[1]) * (
+                        after[0] - before[0]
+                    ) // (after[1] - before[1])
+                else:
+                    guess = (before[0] + after[0]) // 2
+                guess = min(max(guess, before[0] + 1), after[0] - 1)
+                block = _get_block(guess)
+                if block[1] < timestamp:
+                    before = block
+                else:
+                    after = block
+                step += 1
+        finally:
+            self.add_anchors(observed)
+        return after[0]
+
+
+_block_indexes = {}
+_block_indexes_lock = threading.Lock()
+
+
+def get_block_index(chain: str) -> BlockIndex:
+    fact_cache = get_fact_cache()
+    with _block_indexes_lock:
+        if (
+            chain not in _block_indexes
+            or _block_indexes[chain]._cache is not fact_cache
+        ):
+            _block_indexes[chain] = BlockIndex(chain, fact_cache)
+        return _block_indexes[chain]
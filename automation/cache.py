@@ -0,0 +1,121 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+CACHE_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(os.path.dirname(__file__))), "data", "cache"
+)
+FACT_CACHE_FILE = "chain_facts.sqlite"
+# sqlite caps the number of bound parameters per statement, keep IN (...) lookups below it
+_MAX_KEYS_PER_QUERY = 500
+
+_cache_dir_override: Optional[str] = None
+
+
+def get_cache_dir() -> str:
+    """
+    Root directory of all persistent caches, data/cache unless redirected with set_cache_dir
+    """
+    return _cache_dir_override or CACHE_DIR
+
+
+def set_cache_dir(path: Optional[str]) -> None:
+    """
+    Redirect all persistent caches to another directory, None goes back to data/cache.
+    Cache singletons notice the change on their next lookup
+    """
+    global _cache_dir_override
+    _cache_dir_override = None if path == CACHE_DIR else path
+
+
+class FactCache:
+    """
+    Persistent key-value store for on-chain facts that never change once observed, like the recipient
+    of a root gauge or the decimals of a token. Values are stored as JSON, grouped by namespace
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(get_cache_dir(), FACT_CACHE_FILE)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS facts ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._conn.commit()
+
+    def get_many(self, namespace: str, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), _MAX_KEYS_PER_QUERY):
+                chunk = keys[start : start + _MAX_KEYS_PER_QUERY]
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM facts WHERE namespace = ? "
+                    f"AND key IN ({','.join('?' * len(chunk))})",
+                    [namespace, *chunk],
+                ).fetchall()
+                for key, value in rows:
+                    found[key] = json.loads(value)
+        return found
+
+    def get_namespace(self, namespace: str) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM facts WHERE namespace = ?", [namespace]
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def set_many(self, namespace: str, items: Dict[str, Any]) -> None:
+        if not items:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO facts (namespace, key, value) VALUES (?, ?, ?)",
+                [(namespace, key, json.dumps(value)) for key, value in items.items()],
+            )
+            self._conn.commit()
+
+    def get_or_fetch_many(
+        self,
+        namespace: str,
+        keys: Iterable[str],
+        fetch_missing: Callable[[List[str]], Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        """
+        Return cached values for `keys`, resolving all misses with a single call to `fetch_missing`.
+        Only values returned by `fetch_missing` are persisted, so it can leave out keys it failed to resolve
+        """
+        keys = list(dict.fromkeys(keys))
+        found = self.get_many(namespace, keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            fetched = fetch_missing(missing)
+            self.set_many(namespace, fetched)
+            found.update(fetched)
+        return found
+
+
+_fact_cache = None
+_fact_cache_lock = threading.Lock()
+
+
+def get_fact_cache() -> FactCache:
+    """
+    Process wide FactCache backed by data/cache/chain_facts.sqlite
+    """
+    global _fact_cache
+    with _fact_cache_lock:
+        path = os.path.join(get_cache_dir(), FACT_CACHE_FILE)
+        if _fact_cache is None or _fact_cache.path != path:
+            _fact_cache = FactCache(path)
+        return _fact_cache
@@ -0,0 +1,165 @@
+import copy
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+
+from automation.cache import get_cache_dir
+from automation.cache import set_cache_dir
+
+CASSETTE_MODES = ("record", "replay")
+CASSETTE_VERSION = 1
+
+
+class CassetteMiss(Exception):
+    """
+    Raised in replay mode for a request that is not in the cassette
+    """
+
+
+def _canonical(value: Any) -> Any:
+    # web3 takes most of a second to import, it is only loaded once a cassette is in use
+    from web3._utils.encoding import Web3JsonEncoder
+
+    # Round trip through JSON so requests and responses are plain, detached data
+    return json.loads(json.dumps(value, cls=Web3JsonEncoder, sort_keys=True))
+
+
+class Cassette:
+    """
+    Recorded responses of every outside request of a run: JSON-RPC calls, GraphQL queries, price API
+    lookups and address book lookups. Requests are keyed by a hash of their kind and canonical content,
+    repeated requests replay their responses in recording order.
+
+    Cassettes contain the full GraphQL endpoint urls, so don't share ones recorded against endpoints with
+    private keys in the url. JSON-RPC requests are keyed by chain instead of by node url
+    """
+
+    def __init__(self, path: str, mode: str):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Cassette mode must be one of {CASSETTE_MODES}: {mode}")
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._replayed: Dict[str, int] = {}
+        if mode == "replay":
+            with gzip.open(path, "rt") as f:
+                data = json.load(f)
+            if data["version"] != CASSETTE_VERSION:
+                raise ValueError(f"Unsupported cassette version {data['version']}")
+            self.recorded_at = data["recordedAt"]
+            self.interactions = data["interactions"]
+        else:
+            self.recorded_at = int(time.time())
+            self.interactions = {}
+
+    @staticmethod
+    def key(kind: str, request: Any) -> str:
+        return hashlib.sha256(
+            json.dumps([kind, request], sort_keys=True).encode()
+        ).hexdigest()
+
+    def call(self, kind: str, request: Any, fetch: Callable[[], Any]) -> Any:
+        """
+        Replay the recorded response to `request`, or in record mode run `fetch` and record its response
+        """
+        request = _canonical(request)
+        key = self.key(kind, request)
+        if self.mode == "replay":
+            with self._lock:
+                interaction = self.interactions.get(key)
+                if interaction is None:
+                    raise CassetteMiss(
+                        f"No recorded response for {kind} request {request}"
+                    )
+                index = self._replayed.get(key, 0)
+                self._replayed[key] = index + 1
+                responses = interaction["responses"]
+                # Requests repeated more often than recorded get the last response again
+                return copy.deepcopy(responses[min(index, len(responses) - 1)])
+        response = fetch()
+        with self._lock:
+            self.interactions.setdefault(
+                key, {"kind": kind, "request": request, "responses": []}
+            )["responses"].append(_canonical(response))
+        return response
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        # mtime=0 keeps cassettes of identical runs byte for byte identical
+        with open(tmp_path, "wb") as raw, gzip.GzipFile(
+            fileobj=raw, mode="wb", mtime=0
+        ) as f:
+            f.write(
+                json.dumps(
+                    {
+                        "version": CASSETTE_VERSION,
+                        "recordedAt": self.recorded_at,
+                        "interactions": self.interactions,
+                    },
+                    sort_keys=True,
+                ).encode()
+            )
+        os.replace(tmp_path, self.path)
+
+
+_active_cassette: Optional[Cassette] = None
+
+
+def get_cassette() -> Optional[Cassette]:
+    return _active_cassette
+
+
+def cassette_call(kind: str, request: Any, fetch: Callable[[], Any]) -> Any:
+    """
+    Route an outside request through the active cassette, or just run `fetch` when there is none
+    """
+    cassette = _active_cassette
+    if cassette is None:
+        return fetch()
+    return cassette.call(kind, request, fetch)
+
+
+def now() -> int:
+    """
+    Current unix time, or the time the active cassette was recorded at so replays see the same clock
+    """
+    cassette = _active_cassette
+    return cassette.recorded_at if cassette is not None else int(time.time())
+
+
+@contextmanager
+def use_cassette(path: str, mode: str) -> Iterator[Cassette]:
+    """
+    Record or replay all outside requests made inside the block. The persistent caches under data/cache
+    are swapped for an empty temporary directory meanwhile, so a recording holds every request the run
+    needs and a replay can't be served stale local data. In record mode the cassette is saved on exit
+    """
+    global _active_cassette
+    cassette = Cassette(path, mode)
+    previous_cache_dir = get_cache_dir()
+    tmp_cache_dir = tempfile.mkdtemp(prefix="cassette_cache_")
+    _active_cassette = cassette
+    set_cache_dir(tmp_cache_dir)
+    try:
+        yield cassette
+        if mode == "record":
+            cassette.save()
+            print(
+                f"Recorded {sum(len(i['responses']) for i in cassette.interactions.values())} responses to {path}"
+            )
+    finally:
+        _active_cassette = None
+        set_cache_dir(previous_cache_dir)
+        shutil.rmtree(tmp_cache_dir, ignore_errors=True)
@@ -0,0 +1,122 @@
+import contextvars
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+
+from automation.cache import get_cache_dir
+
+# Checkpointed stages of a pipeline run, in the order they run. Forcing a stage recomputes it and every
+# stage after it
+CHECKPOINT_STAGES = (
+    "block_lookup",
+    "bal_price",
+    "voting_list",
+    "fee_snapshots",
+    "gauge_weights",
+    "recipient_lookups",
+)
+CHECKPOINT_DIR = "checkpoints"
+
+_run_key: contextvars.ContextVar = contextvars.ContextVar(
+    "checkpoint_run", default=None
+)
+_forced_stage: Optional[str] = None
+_checkpoint_dir_override: Optional[str] = None
+
+
+def get_checkpoint_dir() -> str:
+    """
+    Root directory of the checkpoints, data/cache/checkpoints unless redirected with set_checkpoint_dir
+    """
+    return _checkpoint_dir_override or os.path.join(get_cache_dir(), CHECKPOINT_DIR)
+
+
+def set_checkpoint_dir(path: Optional[str]) -> None:
+    """
+    Keep checkpoints somewhere else than under the cache directory, None goes back to the default
+    """
+    global _checkpoint_dir_override
+    _checkpoint_dir_override = path
+
+
+def force_stage(stage_name: Optional[str]) -> None:
+    """
+    Ignore the checkpoints of `stage_name` and every stage after it for the rest of the process: they are
+    recomputed and their checkpoints overwritten. None goes back to resuming from all checkpoints
+    """
+    global _forced_stage
+    if stage_name is not None and stage_name not in CHECKPOINT_STAGES:
+        raise ValueError(f"Stage must be one of {CHECKPOINT_STAGES}: {stage_name}")
+    _forced_stage = stage_name
+
+
+def _is_forced(stage_name: str) -> bool:
+    if _forced_stage is None:
+        return False
+    return CHECKPOINT_STAGES.index(stage_name) >= CHECKPOINT_STAGES.index(_forced_stage)
+
+
+@contextmanager
+def use_checkpoints(program: str, epoch: str) -> Iterator[None]:
+    """
+    Checkpoint the stages run inside the block as part of `program`'s run for the epoch ending at `epoch`
+    """
+    token = _run_key.set((program, epoch))
+    try:
+        yield
+    finally:
+        _run_key.reset(token)
+
+
+def clear_checkpoints(program: str, epoch: str) -> None:
+    """
+    Delete the checkpoints of `program`'s run for the epoch ending at `epoch`. Called once a run succeeded,
+    so checkpoints only ever resume failed runs and a rerun fetches the BAL price and voting list afresh
+    """
+    shutil.rmtree(
+        os.path.join(get_checkpoint_dir(), program, epoch), ignore_errors=True
+    )
+
+
+def checkpoint_path(program: str, epoch: str, stage_name: str, inputs: Any) -> str:
+    """
+    Checkpoint file of a stage, named by a hash of the program, epoch and everything the stage's result
+    depends on, so a stage whose inputs changed upstream never picks up a stale result
+    """
+    digest = hashlib.sha256(
+        json.dumps([program, epoch, stage_name, inputs], sort_keys=True).encode()
+    ).hexdigest()
+    return os.path.join(
+        get_checkpoint_dir(), program, epoch, f"{stage_name}-{digest}.json"
+    )
+
+
+def checkpointed(stage_name: str, inputs: Any, fetch: Callable[[], Any]) -> Any:
+    """
+    Result of a stage from its checkpoint if an earlier run got past it, otherwise run `fetch` and save a
+    checkpoint of its result. `inputs` and the result have to be JSON serializable. Outside of
+    use_checkpoints this just runs `fetch`
+    """
+    run_key = _run_key.get()
+    if run_key is None:
+        return fetch()
+    path = checkpoint_path(*run_key, stage_name, inputs)
+    if not _is_forced(stage_name) and os.path.exists(path):
+        with open(path) as f:
+            print(f"Resuming {stage_name} from checkpoint {os.path.basename(path)}")
+            return json.load(f)["result"]
+    result = fetch()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so an interrupted run never leaves a truncated checkpoint behind
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"stage": stage_name, "inputs": inputs, "result": result}, f)
+    os.replace(tmp_path, path)
+    return result
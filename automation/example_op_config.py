@@ -1,4 +1,3 @@
-from web3 import Web3
 from automation.constants import (
     FIXED_INCENTIVE_TOKENS_PER_EPOCH,
     DESIRED_DEFAULT_VOTE_CAP,
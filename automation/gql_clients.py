@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict
+from typing import Optional
+from typing import TYPE_CHECKING
+
+from automation.cache import get_cache_dir
+
+if TYPE_CHECKING:
+    from gql import Client
+    from graphql import DocumentNode
+    from graphql import GraphQLSchema
+
+SCHEMA_CACHE_SUBDIR = "gql_schemas"
+# Schemas of the endpoints we use change rarely, re-introspect once a day to pick up changes
+SCHEMA_TTL_SECONDS = 24 * 60 * 60
+
+_schemas: Dict[str, GraphQLSchema] = {}
+# Guards _schemas and _schema_locks only, loading a schema holds the lock of its endpoint
+_schemas_lock = threading.Lock()
+_schema_locks: Dict[str, threading.Lock] = {}
+# Sync gql clients can't run two requests at the same time, so every thread gets its own set
+_thread_clients = threading.local()
+
+
+def _schema_cache_path(url: str) -> str:
+    return os.path.join(
+        get_cache_dir(),
+        SCHEMA_CACHE_SUBDIR,
+        f"{hashlib.sha256(url.encode()).hexdigest()[:16]}.json",
+    )
+
+
+def parse_query(query: str) -> DocumentNode:
+    """
+    gql(query). Like every other use of gql and graphql-core in this module it is imported on first use,
+    so importing the pipeline modules stays cheap
+    """
+    from gql import gql
+
+    return gql(query)
+
+
+def _introspect(url: str, headers: Optional[Dict]) -> Dict:
+    from gql import Client
+
+    from automation.transports import make_gql_transport
+
+    client = Client(
+        transport=make_gql_transport(url, headers=headers),
+        fetch_schema_from_transport=True,
+    )
+    # Connecting a client with fetch_schema_from_transport runs the introspection query
+    with client:
+        pass
+    return client.introspection
+
+
+def get_gql_schema(url: str, headers: Optional[Dict] = None) -> GraphQLSchema:
+    """
+    Returns the schema of a GraphQL endpoint. It is introspected at most once per TTL and persisted
+    under data/cache/gql_schemas, so most runs never send an introspection query at all. Loading is
+    locked per endpoint, so a slow endpoint never holds up the clients of the others
+    """
+    from graphql import build_client_schema
+
+    cache_path = _schema_cache_path(url)
+    with _schemas_lock:
+        if cache_path in _schemas:
+            return _schemas[cache_path]
+        url_lock = _schema_locks.setdefault(cache_path, threading.Lock())
+    with url_lock:
+        # Another thread may have loaded it while this one waited
+        with _schemas_lock:
+            if cache_path in _schemas:
+                return _schemas[cache_path]
+        introspection = None
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if time.time() - cached["fetchedAt"] < SCHEMA_TTL_SECONDS:
+                introspection = cached["introspection"]
+        if introspection is None:
+            introspection = _introspect(url, headers)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {
+                        "url": url,
+                        "fetchedAt": time.time(),
+                        "introspection": introspection,
+                    },
+                    f,
+                )
+            os.replace(tmp_path, cache_path)
+        schema = build_client_schema(introspection)
+        with _schemas_lock:
+            _schemas[cache_path] = schema
+        return schema
+
+
+def get_gql_client(
+    url: str,
+    headers: Optional[Dict] = None,
+    execute_timeout: Optional[int] = 10,
+) -> Client:
+    """
+    Returns a shared gql Client for the endpoint, built on the cached schema so no introspection query is
+    sent. Clients are shared per thread, since a sync client can't execute concurrent requests
+    """
+    key = (url, tuple(sorted((headers or {}).items())), execute_timeout)
+    clients = getattr(_thread_clients, "clients", None)
+    if clients is None:
+        clients = _thread_clients.clients = {}
+    if key not in clients:
+        from gql import Client
+
+        from automation.transports import make_gql_transport
+
+        clients[key] = Client(
+            transport=make_gql_transport(url, headers=headers),
+            schema=get_gql_schema(url, headers),
+            execute_timeout=execute_timeout,
+        )
+    return clients[key]
@@ -1,20 +1,42 @@
+from __future__ import annotations
+
+import bisect
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from datetime import timedelta
 from decimal import Decimal
+from functools import lru_cache
+from typing import Callable
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import TYPE_CHECKING
+from typing import Tuple
 from typing import Union
-from bal_tools import Subgraph
 
-from gql import Client
-from gql import gql
-from gql.transport.requests import RequestsHTTPTransport
-from web3 import Web3
-from web3.exceptions import BadFunctionCallOutput
+from eth_utils import to_checksum_address
+
+from automation.block_index import NodeBehindError
+from automation.block_index import get_block_index
+from automation.cache import get_fact_cache
+from automation.cassette import cassette_call
+from automation.cassette import now as cassette_now
+from automation.gql_clients import get_gql_client
+from automation.gql_clients import parse_query
+from automation.metrics import propagate
+from automation.metrics import stage
+from automation.multicall import multicall
+from automation.price_store import get_price_store
+
+if TYPE_CHECKING:
+    from web3 import Web3
+    from web3.contract import Contract
 
 BAL_GQL_URL = "https://api-v3.balancer.fi/"
 CHAINS = [
@@ -25,10 +47,8 @@ CHAINS = [
     "gnosis",
     "avalanche",
 ]
-BLOCKS_BY_CHAIN = {}
-for chain in CHAINS:
-    BLOCKS_BY_CHAIN[chain] = Subgraph(chain).get_subgraph_url("blocks")
 
+BAL_TOKEN_ADDRESS = "0xba100000625a3754423978a60c9317c58a424e3D"
 VE_BAL_CONTRACT = "0xC128a9954e6c874eA3d62ce62B468bA073093F25"
 AURA_VEBAL_HOLDER = "0xaF52695E1bB01A16D33D7194C28C42b10e0Dbec2"
 
@@ -63,20 +83,42 @@ CHAIN_TO_CHAIN_ID_MAP = {
     "avalanche": "43114",
 }
 
-BAL_GQL_QUERY = """
-query {{
-  tokenGetPriceChartData(address:"{token_addr}", range: NINETY_DAY)   
+# One aliased tokenGetPriceChartData field per token, so a whole chain is priced with a single request
+BAL_GQL_PRICE_FIELD = """
+  {alias}: tokenGetPriceChartData(address:"{token_addr}", range: {chart_range})
    {{
-    id
     price
     timestamp
   }}
-}}
 """
 
+# Smallest chart range covering a number of days back from now
+BAL_GQL_CHART_RANGES = [
+    (7, "SEVEN_DAY"),
+    (30, "THIRTY_DAY"),
+    (90, "NINETY_DAY"),
+    (180, "ONE_HUNDRED_EIGHTY_DAY"),
+    (365, "ONE_YEAR"),
+]
+
+# Fetches the blocks right before and right at/after a timestamp, so the answer can be pinned exactly
 BLOCKS_QUERY = """
 query {{
-    blocks(where:{{timestamp_gt: {ts_gt}, timestamp_lt: {ts_lt} }}) {{
+    before: blocks(
+        first: 1
+        orderBy: number
+        orderDirection: desc
+        where: {{timestamp_lt: {ts}, timestamp_gt: {ts_gt} }}
+    ) {{
+    number
+    timestamp
+    }}
+    after: blocks(
+        first: 1
+        orderBy: number
+        orderDirection: asc
+        where: {{timestamp_gte: {ts}, timestamp_lt: {ts_lt} }}
+    ) {{
     number
     timestamp
     }}
@@ -109,16 +151,20 @@ query VeBalGetVotingList {
 }
 """
 
+# Snapshot queries page with an id cursor (id_gt) instead of skip, which gets slower the deeper it goes
+# and is capped by graph-node
+SNAPSHOTS_PAGE_SIZE = 1000
+
 POOLS_SNAPSHOTS_QUERY = """
 {{
   poolSnapshots(
     first: {first}
-    skip: {skip}
-    orderBy: timestamp
-    orderDirection: desc
+    orderBy: id
+    orderDirection: asc
     block: {{ number: {block} }}
-    where: {{ protocolFee_not: null }}
+    where: {{ protocolFee_not: null, id_gt: "{last_id}" }}
   ) {{
+    id
     pool {{
       address
       id
@@ -140,6 +186,25 @@ POOLS_SNAPSHOTS_QUERY = """
 """
 
 
+POOLS_SNAPSHOTS_BETWEEN_TIMESTAMPS_QUERY = """
+{{
+  poolSnapshots(
+    first: {first}
+    orderBy: id
+    orderDirection: asc
+    where: {{timestamp_gte: {start_ts}, timestamp_lt: {end_ts}, id_gt: "{last_id}"}}
+  ) {{
+    id
+    pool {{
+      address
+    }}
+    timestamp
+    protocolFee
+  }}
+}}
+"""
+
+
 @dataclass
 class PoolBalance:
     token_addr: str
@@ -149,81 +214,497 @@ class PoolBalance:
     balance: Decimal
 
 
+@dataclass
+class PoolState:
+    pool_id: str
+    pool_address: str
+    total_supply: Decimal
+    balances: List[PoolBalance]
+
+
+@lru_cache(maxsize=None)
+def get_subgraph_url(chain: str, subgraph: str) -> str:
+    """
+    Subgraph url from bal_tools. It is only imported here, since importing it pulls in web3
+    """
+
+    def _lookup() -> str:
+        from bal_tools import Subgraph
+
+        return Subgraph(chain).get_subgraph_url(subgraph)
+
+    return cassette_call(
+        "subgraph_url", {"chain": chain, "subgraph": subgraph}, _lookup
+    )
+
+
+@lru_cache(maxsize=None)
 def get_abi(contract_name: str) -> Union[Dict, List[Dict]]:
+    """
+    Loads an ABI from the abi/ directory. Parsed once per process, the returned object is shared
+    so it must not be mutated
+    """
     project_root_dir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
     with open(f"{project_root_dir}/abi/{contract_name}.json") as f:
         return json.load(f)
 
 
-def get_balancer_pool_snapshots(block: int, graph_url: str) -> Optional[List[Dict]]:
-    transport = RequestsHTTPTransport(url=graph_url, retries=3)
-    client = Client(
-        transport=transport, fetch_schema_from_transport=True, execute_timeout=60
+_contracts: Dict[Tuple[str, str, str], Contract] = {}
+_contracts_lock = threading.Lock()
+
+
+def get_contract(web3: Web3, chain: str, address: str, abi_name: str) -> Contract:
+    """
+    Returns a web3 Contract for `address` with the ABI from abi/`abi_name`.json. Contract objects are cached
+    per (chain, address, abi) and only rebuilt when asked for with a different web3 instance
+    """
+    key = (chain, address.lower(), abi_name)
+    with _contracts_lock:
+        contract = _contracts.get(key)
+        if contract is None or contract.w3 is not web3:
+            contract = web3.eth.contract(
+                address=to_checksum_address(address), abi=get_abi(abi_name)
+            )
+            _contracts[key] = contract
+    return contract
+
+
+@stage("recipient_lookups")
+def get_root_gauge_recipients(
+    web3: Web3, gauge_addrs: List[str], chain: str = "mainnet"
+) -> Dict[str, str]:
+    """
+    Returns child chain recipient for each root gauge. Recipients never change, so they are served from
+    the persistent fact cache and only unknown gauges are read on chain, in a single multicall
+    """
+
+    def _fetch(missing: List[str]) -> Dict[str, str]:
+        # ArbRootGauge ABI works for the root gauges of all chains given we only need getRecipient
+        recipients = multicall(
+            web3,
+            [
+                get_contract(web3, chain, addr, "ArbRootGauge").functions.getRecipient()
+                for addr in missing
+            ],
+            allow_failure=False,
+        )
+        return dict(zip(missing, recipients))
+
+    return get_fact_cache().get_or_fetch_many(
+        f"{chain}:root_gauge_recipient",
+        [to_checksum_address(addr) for addr in gauge_addrs],
+        _fetch,
     )
+
+
+def get_pool_addresses(web3: Web3, chain: str, pool_ids: List[str]) -> Dict[str, str]:
+    """
+    Returns pool address for each balancer pool id, as reported by Vault.getPool
+    """
+
+    def _fetch(missing: List[str]) -> Dict[str, str]:
+        balancer_vault = get_contract(
+            web3,
+            chain,
+            BALANCER_CONTRACTS[chain]["BALANCER_VAULT_ADDRESS"],
+            "BalancerVault",
+        )
+        pools = multicall(
+            web3,
+            [balancer_vault.functions.getPool(pool_id) for pool_id in missing],
+            allow_failure=False,
+        )
+        return {
+            pool_id: to_checksum_address(pool_addr)
+            for pool_id, (pool_addr, _) in zip(missing, pools)
+        }
+
+    return get_fact_cache().get_or_fetch_many(
+        f"{chain}:pool_address", [pool_id.lower() for pool_id in pool_ids], _fetch
+    )
+
+
+def get_tokens_metadata(
+    web3: Web3, chain: str, token_addrs: List[str]
+) -> Dict[str, Dict]:
+    """
+    Returns decimals, name and symbol for each token. Tokens that fail to report decimals are left out
+    and not cached, name or symbol that can't be decoded are stored as None
+    """
+
+    def _fetch(missing: List[str]) -> Dict[str, Dict]:
+        calls = []
+        for token_addr in missing:
+            token_contract = get_contract(web3, chain, token_addr, "ERC20")
+            calls.extend(
+                [
+                    token_contract.functions.decimals(),
+                    token_contract.functions.name(),
+                    token_contract.functions.symbol(),
+                ]
+            )
+        results = multicall(web3, calls)
+        metadata = {}
+        for index, token_addr in enumerate(missing):
+            decimals, name, symbol = results[index * 3 : index * 3 + 3]
+            if decimals is None:
+                print(f"WARNING: Could not fetch decimals for token {token_addr}")
+                continue
+            metadata[token_addr] = {
+                "decimals": decimals,
+                "name": name,
+                "symbol": symbol,
+            }
+        return metadata
+
+    return get_fact_cache().get_or_fetch_many(
+        f"{chain}:token_metadata",
+        [to_checksum_address(addr) for addr in token_addrs],
+        _fetch,
+    )
+
+
+def get_balancer_pool_snapshots(block: int, graph_url: str) -> Optional[List[Dict]]:
+    client = get_gql_client(graph_url, execute_timeout=60)
     all_pools = []
-    limit = 1000
-    offset = 0
+    last_id = ""
     while True:
         result = client.execute(
-            gql(POOLS_SNAPSHOTS_QUERY.format(first=limit, skip=offset, block=block))
+            parse_query(
+                POOLS_SNAPSHOTS_QUERY.format(
+                    first=SNAPSHOTS_PAGE_SIZE, block=block, last_id=last_id
+                )
+            )
         )
         all_pools.extend(result["poolSnapshots"])
-        offset += limit
-        if offset >= 5000:
-            break
-        if len(result["poolSnapshots"]) < limit - 1:
+        if len(result["poolSnapshots"]) < SNAPSHOTS_PAGE_SIZE:
             break
+        last_id = result["poolSnapshots"][-1]["id"]
     return all_pools
 
 
+def iter_pool_snapshots_between_timestamps(
+    graph_url: str, start_ts: int, end_ts: int
+) -> Iterator[Dict]:
+    """
+    Yield pool snapshots with start_ts <= timestamp < end_ts page by page, without holding more than one page
+    """
+    client = get_gql_client(graph_url, execute_timeout=60)
+    last_id = ""
+    while True:
+        result = client.execute(
+            parse_query(
+                POOLS_SNAPSHOTS_BETWEEN_TIMESTAMPS_QUERY.format(
+                    first=SNAPSHOTS_PAGE_SIZE,
+                    start_ts=start_ts,
+                    end_ts=end_ts,
+                    last_id=last_id,
+                )
+            )
+        )
+        yield from result["poolSnapshots"]
+        if len(result["poolSnapshots"]) < SNAPSHOTS_PAGE_SIZE:
+            break
+        last_id = result["poolSnapshots"][-1]["id"]
+
+
+@dataclass
+class PoolFeeRange:
+    """
+    Oldest and newest cumulative protocol fee seen for a pool
+    """
+
+    __slots__ = ("oldest_ts", "oldest_fee", "newest_ts", "newest_fee", "count")
+    oldest_ts: int
+    oldest_fee: float
+    newest_ts: int
+    newest_fee: float
+    count: int
+
+
+class ProtocolFeeReducer:
+    """
+    Streaming reducer over pool snapshots that only keeps the oldest and newest protocolFee per pool,
+    so memory is bounded by the number of pools rather than the number of snapshots
+    """
+
+    def __init__(self):
+        self.pools: Dict[str, PoolFeeRange] = {}
+
+    def add(self, snapshot: Dict) -> None:
+        pool_addr = snapshot["pool"]["address"].lower()
+        timestamp = int(snapshot["timestamp"])
+        # Convert to float with respect that there might be null values and string values
+        fee = float(snapshot["protocolFee"]) if snapshot.get("protocolFee") else 0
+        fee_range = self.pools.get(pool_addr)
+        if fee_range is None:
+            self.pools[pool_addr] = PoolFeeRange(timestamp, fee, timestamp, fee, 1)
+            return
+        fee_range.count += 1
+        if timestamp < fee_range.oldest_ts:
+            fee_range.oldest_ts, fee_range.oldest_fee = timestamp, fee
+        if timestamp > fee_range.newest_ts:
+            fee_range.newest_ts, fee_range.newest_fee = timestamp, fee
+
+    def consume(self, snapshots: Iterable[Dict]) -> "ProtocolFeeReducer":
+        for snapshot in snapshots:
+            self.add(snapshot)
+        return self
+
+    def merge(self, other: "ProtocolFeeReducer") -> "ProtocolFeeReducer":
+        for pool_addr, other_range in other.pools.items():
+            fee_range = self.pools.get(pool_addr)
+            if fee_range is None:
+                self.pools[pool_addr] = other_range
+                continue
+            fee_range.count += other_range.count
+            if other_range.oldest_ts < fee_range.oldest_ts:
+                fee_range.oldest_ts = other_range.oldest_ts
+                fee_range.oldest_fee = other_range.oldest_fee
+            if other_range.newest_ts > fee_range.newest_ts:
+                fee_range.newest_ts = other_range.newest_ts
+                fee_range.newest_fee = other_range.newest_fee
+        return self
+
+    def fees_collected(self) -> Dict[str, float]:
+        """
+        Protocol fees collected per pool between its oldest and newest snapshot. Pools with a single
+        snapshot are left out since there is nothing to diff against
+        """
+        fees = {}
+        for pool_addr, fee_range in self.pools.items():
+            if fee_range.count > 1:
+                fee_collected = fee_range.newest_fee - fee_range.oldest_fee
+                assert (
+                    fee_collected >= 0
+                ), f"Fee collected for pool {pool_addr} is negative"
+                fees[pool_addr] = fee_collected
+        return fees
+
+
+class EpochProtocolFeeReducer:
+    """
+    ProtocolFeeReducer per epoch, for streaming snapshots spanning several consecutive epochs in one pass.
+    `edges` are the sorted epoch boundaries, epoch i covers edges[i] <= timestamp < edges[i + 1]
+    """
+
+    def __init__(self, edges: List[int]):
+        self.edges = edges
+        self.reducers = [ProtocolFeeReducer() for _ in edges[:-1]]
+
+    def add(self, snapshot: Dict) -> None:
+        epoch_index = bisect.bisect_right(self.edges, int(snapshot["timestamp"])) - 1
+        if 0 <= epoch_index < len(self.reducers):
+            self.reducers[epoch_index].add(snapshot)
+
+    def consume(self, snapshots: Iterable[Dict]) -> "EpochProtocolFeeReducer":
+        for snapshot in snapshots:
+            self.add(snapshot)
+        return self
+
+    def merge(self, other: "EpochProtocolFeeReducer") -> "EpochProtocolFeeReducer":
+        for reducer, other_reducer in zip(self.reducers, other.reducers):
+            reducer.merge(other_reducer)
+        return self
+
+
+def reduce_pool_snapshots_between_timestamps(
+    graph_url: str,
+    start_ts: int,
+    end_ts: int,
+    num_slices: int = 7,
+    reducer_factory: Callable[[], ProtocolFeeReducer] = ProtocolFeeReducer,
+    max_workers: Optional[int] = None,
+) -> ProtocolFeeReducer:
+    """
+    Stream all pool snapshots with start_ts <= timestamp < end_ts into a reducer, a ProtocolFeeReducer by
+    default. The window is split into disjoint time slices which are paged through and reduced concurrently,
+    then merged. By default every slice gets its own worker
+    """
+    edges = sorted(
+        set(
+            start_ts + (end_ts - start_ts) * index // num_slices
+            for index in range(num_slices + 1)
+        )
+    )
+    slice_bounds = list(zip(edges[:-1], edges[1:]))
+    reducer = reducer_factory()
+    with ThreadPoolExecutor(
+        max_workers=max_workers or len(slice_bounds) or 1
+    ) as executor:
+        for slice_reducer in executor.map(
+            propagate(
+                lambda bounds: reducer_factory().consume(
+                    iter_pool_snapshots_between_timestamps(graph_url, *bounds)
+                )
+            ),
+            slice_bounds,
+        ):
+            reducer.merge(slice_reducer)
+    return reducer
+
+
+@stage("voting_list")
 def fetch_all_pools_info(chain: str) -> List[Dict]:
     """
     Fetches all pools info from balancer graphql api
     """
-    transport = RequestsHTTPTransport(
-        url=BAL_GQL_URL,
-        retries=2,
+    client = get_gql_client(
+        BAL_GQL_URL,
         headers={"chainId": CHAIN_TO_CHAIN_ID_MAP[chain]} if chain != "mainnet" else {},
     )
-    client = Client(transport=transport, fetch_schema_from_transport=True)
-    query = gql(BAL_GET_VOTING_LIST_QUERY)
+    query = parse_query(BAL_GET_VOTING_LIST_QUERY)
     result = client.execute(query)
     return result["veBalGetVotingList"]
 
 
+def get_pools_state(
+    web3: Web3, chain: str, pool_ids: List[str], block_number: Optional[int] = None
+) -> Dict[str, Optional[PoolState]]:
+    """
+    Reads token balances and BPT total supply of many pools at one block. Pool addresses and token metadata
+    come from the fact cache, balances and supplies are read with a single multicall, so the number of RPC
+    calls doesn't grow with the number of pools or tokens. Pools that didn't exist at the block map to None
+    """
+    if not block_number:
+        block_number = web3.eth.block_number
+    pool_addresses = get_pool_addresses(web3, chain, pool_ids)
+    vault_addr = BALANCER_CONTRACTS[chain]["BALANCER_VAULT_ADDRESS"]
+    balancer_vault = get_contract(web3, chain, vault_addr, "BalancerVault")
+    calls = []
+    for pool_id in pool_ids:
+        calls.append(balancer_vault.functions.getPoolTokens(pool_id))
+        calls.append(
+            get_contract(
+                web3, chain, pool_addresses[pool_id.lower()], "WeighedPool"
+            ).functions.totalSupply()
+        )
+    results = multicall(web3, calls, block_identifier=block_number)
+    all_tokens = set(pool_addresses[pool_id.lower()] for pool_id in pool_ids)
+    for pool_tokens in results[::2]:
+        if pool_tokens is not None:
+            all_tokens.update(pool_tokens[0])
+    tokens_metadata = get_tokens_metadata(web3, chain, list(all_tokens))
+
+    pools_state = {}
+    for index, pool_id in enumerate(pool_ids):
+        pool_tokens, total_supply = results[index * 2 : index * 2 + 2]
+        if pool_tokens is None or total_supply is None:
+            print(f"Pool {pool_id} wasn't created at block {block_number}")
+            pools_state[pool_id] = None
+            continue
+        tokens, balances, _ = pool_tokens
+        token_balances = []
+        for token, balance in zip(tokens, balances):
+            token_metadata = tokens_metadata[web3.to_checksum_address(token)]
+            token_balances.append(
+                PoolBalance(
+                    token_addr=token,
+                    token_name=token_metadata["name"],
+                    token_symbol=token_metadata["symbol"],
+                    pool_id=pool_id,
+                    balance=Decimal(balance)
+                    / Decimal(10 ** token_metadata["decimals"]),
+                )
+            )
+        pool_address = pool_addresses[pool_id.lower()]
+        pools_state[pool_id] = PoolState(
+            pool_id=pool_id,
+            pool_address=pool_address,
+            total_supply=Decimal(total_supply)
+            / Decimal(10 ** tokens_metadata[pool_address]["decimals"]),
+            balances=token_balances,
+        )
+    return pools_state
+
+
 def _get_balancer_pool_tokens_balances(
     balancer_pool_id: str, web3: Web3, chain: str, block_number: Optional[int] = None
 ) -> Optional[List[PoolBalance]]:
     """
     Returns all token balances for a given balancer pool
     """
-    if not block_number:
-        block_number = web3.eth.block_number
-    vault_addr = BALANCER_CONTRACTS[chain]["BALANCER_VAULT_ADDRESS"]
-    balancer_vault = web3.eth.contract(
-        address=web3.to_checksum_address(vault_addr), abi=get_abi("BalancerVault")
-    )
+    pool_state = get_pools_state(web3, chain, [balancer_pool_id], block_number)[
+        balancer_pool_id
+    ]
+    return pool_state.balances if pool_state else None
 
-    # Get all tokens in the pool and their balances
-    tokens, balances, _ = balancer_vault.functions.getPoolTokens(balancer_pool_id).call(
-        block_identifier=block_number
+
+def _get_chart_range(oldest_ts: int) -> Tuple[int, str]:
+    days_back = (cassette_now() - oldest_ts) // (24 * 60 * 60) + 1
+    for range_days, chart_range in BAL_GQL_CHART_RANGES:
+        if days_back <= range_days:
+            return range_days, chart_range
+    return BAL_GQL_CHART_RANGES[-1]
+
+
+def fetch_token_prices_balgql(
+    tokens: List[Tuple[str, str]],
+    start_date: Optional[datetime] = None,
+    twap_days: Optional[int] = 14,
+) -> Dict[Tuple[str, str], Optional[Decimal]]:
+    """
+    Calculates twap over `twap_days` days up to start_date for many (token address, chain) pairs.
+    Prices come from the local price store, which is topped up from balancer graphql api with one request
+    per chain covering only the history that is missing.
+    Returns twap keyed by (lower case token address, chain), None when there are no prices in the window
+    """
+    start_date = start_date or datetime.fromtimestamp(cassette_now())
+    start_date_ts = int(start_date.strftime("%s"))
+    end_date_ts = int((start_date - timedelta(days=twap_days)).strftime("%s"))
+    price_store = get_price_store()
+    tokens_by_chain = {}
+    for token_addr, chain in tokens:
+        tokens_by_chain.setdefault(chain, set()).add(token_addr.lower())
+
+    twap_prices = {}
+    for chain, chain_tokens in tokens_by_chain.items():
+        missing_since = {}
+        for token_addr in chain_tokens:
+            since = price_store.missing_since(
+                chain, token_addr, end_date_ts, start_date_ts
+            )
+            if since is not None:
+                missing_since[token_addr] = since
+        if missing_since:
+            _fetch_price_history(chain, missing_since)
+        for token_addr in chain_tokens:
+            twap = price_store.twap(chain, token_addr, end_date_ts, start_date_ts)
+            twap_prices[(token_addr, chain)] = (
+                Decimal(str(twap)) if twap is not None else None
+            )
+    return twap_prices
+
+
+def _fetch_price_history(chain: str, missing_since: Dict[str, int]) -> None:
+    """
+    Fetch price charts for the tokens of one chain in a single request and append them to the price store
+    """
+    fetched_until = cassette_now()
+    range_days, chart_range = _get_chart_range(min(missing_since.values()))
+    token_addrs = sorted(missing_since.keys())
+    client = get_gql_client(
+        BAL_GQL_URL,
+        headers={"chainId": CHAIN_TO_CHAIN_ID_MAP[chain]} if chain != "mainnet" else {},
     )
-    token_balances = []
-    for index, token in enumerate(tokens):
-        token_contract = web3.eth.contract(
-            address=web3.to_checksum_address(token), abi=get_abi("ERC20")
-        )
-        decimals = token_contract.functions.decimals().call()
-        balance = Decimal(balances[index]) / Decimal(10**decimals)
-        pool_token_balance = PoolBalance(
-            token_addr=token,
-            token_name=token_contract.functions.name().call(),
-            token_symbol=token_contract.functions.symbol().call(),
-            pool_id=balancer_pool_id,
-            balance=balance,
+    fields = "".join(
+        [
+            BAL_GQL_PRICE_FIELD.format(
+                alias=f"t{index}", token_addr=token_addr, chart_range=chart_range
+            )
+            for index, token_addr in enumerate(token_addrs)
+        ]
+    )
+    result = client.execute(parse_query(f"query {{{fields}}}"))
+    for index, token_addr in enumerate(token_addrs):
+        get_price_store().append(
+            chain,
+            token_addr,
+            [item["timestamp"] for item in result[f"t{index}"]],
+            [float(item["price"]) for item in result[f"t{index}"]],
+            fetched_from=fetched_until - range_days * 24 * 60 * 60,
+            fetched_until=fetched_until,
         )
-        token_balances.append(pool_token_balance)
-    return token_balances
 
 
 def fetch_token_price_balgql(
@@ -233,33 +714,56 @@ def fetch_token_price_balgql(
     twap_days: Optional[int] = 14,
 ) -> Optional[Decimal]:
     """
-    Fetches 30 days of token prices from balancer graphql api and calculate twap over 14 days
+    Fetches token prices from balancer graphql api and calculate twap over 14 days
     """
-    start_date_ts = int(start_date.strftime("%s"))
-    end_date_ts = int((start_date - timedelta(days=twap_days)).strftime("%s"))
-    transport = RequestsHTTPTransport(
-        url=BAL_GQL_URL,
-        retries=2,
-        headers={"chainId": CHAIN_TO_CHAIN_ID_MAP[chain]} if chain != "mainnet" else {},
-    )
-    client = Client(transport=transport, fetch_schema_from_transport=True)
-    query = gql(BAL_GQL_QUERY.format(token_addr=token_addr.lower()))
-    result = client.execute(query)
-    # Sort result by timestamp desc
-    result["tokenGetPriceChartData"].sort(key=lambda x: x["timestamp"], reverse=True)
-    # Filter results so they are in between start_date and end_date timestamps
-    result_slice = [
-        item
-        for item in result["tokenGetPriceChartData"]
-        if start_date_ts >= item["timestamp"] >= end_date_ts
+    return fetch_token_prices_balgql([(token_addr, chain)], start_date, twap_days)[
+        (token_addr.lower(), chain)
     ]
-    if len(result_slice) == 0:
-        return None
-    # Sum all prices and divide by number of days
-    twap_price = Decimal(
-        sum([Decimal(item["price"]) for item in result_slice]) / len(result_slice)
+
+
+def get_twap_bpt_prices(
+    balancer_pool_ids: List[str],
+    chain: str,
+    web3: Web3,
+    start_date: Optional[datetime] = datetime.now(),
+    block_number: Optional[int] = None,
+    twap_days: Optional[int] = 14,
+) -> Dict[str, Optional[Decimal]]:
+    """
+    BPT dollar price equals to Sum of all underlying ERC20 tokens in the Balancer pool divided by
+    total supply of BPT token. On chain state for all pools is read in bulk at the same block
+    """
+    pools_state = get_pools_state(web3, chain, balancer_pool_ids, block_number)
+    # Price every underlying token of every pool in one request
+    twap_prices = fetch_token_prices_balgql(
+        [
+            (balance.token_addr, chain)
+            for pool_state in pools_state.values()
+            if pool_state is not None
+            for balance in pool_state.balances
+        ],
+        start_date,
+        twap_days,
     )
-    return twap_price
+    bpt_prices = {}
+    for pool_id, pool_state in pools_state.items():
+        if pool_state is None:
+            bpt_prices[pool_id] = None
+            continue
+        balances = pool_state.balances
+        # Now let's calculate price with twap
+        for balance in balances:
+            balance.twap_price = twap_prices[(balance.token_addr.lower(), chain)]
+        # Make sure we have all prices
+        if not all([balance.twap_price for balance in balances]):
+            bpt_prices[pool_id] = None
+            continue
+        # Now we have all prices, let's calculate total price
+        total_price = sum(
+            [balance.balance * balance.twap_price for balance in balances]
+        )
+        bpt_prices[pool_id] = total_price / pool_state.total_supply
+    return bpt_prices
 
 
 def get_twap_bpt_price(
@@ -274,54 +778,16 @@ def get_twap_bpt_price(
     BPT dollar price equals to Sum of all underlying ERC20 tokens in the Balancer pool divided by
     total supply of BPT token
     """
-    balancer_vault = web3.eth.contract(
-        address=web3.to_checksum_address(
-            BALANCER_CONTRACTS[chain]["BALANCER_VAULT_ADDRESS"]
-        ),
-        abi=get_abi("BalancerVault"),
-    )
-    balancer_pool_address, _ = balancer_vault.functions.getPool(balancer_pool_id).call()
-    weighed_pool_contract = web3.eth.contract(
-        address=web3.to_checksum_address(balancer_pool_address),
-        abi=get_abi("WeighedPool"),
-    )
-    decimals = weighed_pool_contract.functions.decimals().call()
-    try:
-        total_supply = Decimal(
-            weighed_pool_contract.functions.totalSupply().call(
-                block_identifier=block_number
-            )
-            / 10**decimals
-        )
-    except BadFunctionCallOutput:
-        print("Pool wasn't created at the block number")
-        return None
-    balances = _get_balancer_pool_tokens_balances(
-        balancer_pool_id=balancer_pool_id,
-        web3=web3,
-        chain=chain,
-        block_number=block_number or web3.eth.block_number,
-    )
-    # Now let's calculate price with twap
-    for balance in balances:
-        balance.twap_price = fetch_token_price_balgql(
-            balance.token_addr, chain, start_date, twap_days
-        )
-    # Make sure we have all prices
-    if not all([balance.twap_price for balance in balances]):
-        return None
-    # Now we have all prices, let's calculate total price
-    total_price = sum([balance.balance * balance.twap_price for balance in balances])
-    return total_price / Decimal(total_supply)
+    return get_twap_bpt_prices(
+        [balancer_pool_id], chain, web3, start_date, block_number, twap_days
+    )[balancer_pool_id]
 
 
 def calculate_aura_vebal_share(web3: Web3, block_number: int) -> Decimal:
     """
     Function that calculate veBAL share of AURA auraBAL from the total supply of veBAL
     """
-    ve_bal_contract = web3.eth.contract(
-        address=web3.to_checksum_address(VE_BAL_CONTRACT), abi=get_abi("ERC20")
-    )
+    ve_bal_contract = get_contract(web3, "mainnet", VE_BAL_CONTRACT, "ERC20")
     total_supply = ve_bal_contract.functions.totalSupply().call(
         block_identifier=block_number
     )
@@ -331,31 +797,58 @@ def calculate_aura_vebal_share(web3: Web3, block_number: int) -> Decimal:
     return Decimal(aura_vebal_balance) / Decimal(total_supply)
 
 
-def get_block_by_ts(timestamp: int, chain: str) -> int:
+@stage("block_lookup")
+def get_block_by_ts(timestamp: int, chain: str, web3: Optional[Web3] = None) -> int:
     """
-    Returns block number for a given timestamp
+    Returns the first block with a timestamp at or after the given timestamp.
+    Lookups are answered from the local block index when possible. Otherwise, when a web3 instance for
+    the chain is given the block is found with eth_getBlockByNumber, if not or if the node is behind the
+    blocks subgraph is queried
     """
-    if timestamp > int(datetime.now().strftime("%s")):
-        timestamp = int(datetime.now().strftime("%s")) - 2000
-    transport = RequestsHTTPTransport(
-        url=BLOCKS_BY_CHAIN[chain],
-        retries=2,
-    )
-    query = gql(
+    if timestamp > cassette_now():
+        timestamp = cassette_now() - 2000
+    block_index = get_block_index(chain)
+    block_number = block_index.lookup(timestamp)
+    if block_number is not None:
+        return block_number
+    if web3 is not None:
+        try:
+            block_number = block_index.find_with_rpc(web3, timestamp)
+        except NodeBehindError as e:
+            # With several RPC urls the node that answered first may be the one lagging behind
+            print(f"WARNING: {e}, looking the block up in the blocks subgraph instead")
+        else:
+            block_index.set_resolved(timestamp, block_number)
+            return block_number
+    query = parse_query(
         BLOCKS_QUERY.format(
+            ts=timestamp,
             ts_gt=timestamp - 2000,
             ts_lt=timestamp + 2000,
         )
     )
-    client = Client(transport=transport, fetch_schema_from_transport=True)
-    result = client.execute(query)
-    # Sort result by timestamp desc
-    result["blocks"].sort(key=lambda x: x["timestamp"], reverse=True)
-    return int(result["blocks"][0]["number"])
+    result = get_gql_client(get_subgraph_url(chain, "blocks")).execute(query)
+    block_index.add_anchors(
+        {
+            int(block["number"]): int(block["timestamp"])
+            for block in result["before"] + result["after"]
+        }
+    )
+    if not result["after"]:
+        raise ValueError(
+            f"Blocks subgraph of {chain} has no block at or after timestamp {timestamp}"
+        )
+    block_number = int(result["after"][0]["number"])
+    block_index.set_resolved(timestamp, block_number)
+    return block_number
 
 
 if __name__ == "__main__":
-    web3 = Web3(Web3.HTTPProvider("https://rpc.gnosischain.com"))
+    from automation.transports import make_web3
+
+    web3 = make_web3(
+        os.environ.get("GNOSISNODEURL") or "https://rpc.gnosischain.com", "gnosis"
+    )
     bpt_price = get_twap_bpt_price(
         "0xbad20c15a773bf03ab973302f61fabcea5101f0a000000000000000000000034",
         "gnosis",
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import os
+from datetime import date
+from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import TYPE_CHECKING
+from typing import Union
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from automation.lstGrant import EpochInputs
+    from automation.program_config import ProgramConfig
+
+# Parquet dataset with one row per gauge per program epoch, partitioned as program=<prefix>/epoch=<end date>
+DEFAULT_HISTORY_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "output", "history"
+)
+PARTITION_FILE = "part-0.parquet"
+
+
+@lru_cache(maxsize=None)
+def _pyarrow_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("WARNING: pyarrow is not installed, epoch history is not recorded")
+        return False
+    return True
+
+
+def _schema():
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("epochStart", pa.int64()),
+            ("epochEnd", pa.int64()),
+            ("chain", pa.string()),
+            ("targetBlock", pa.int64()),
+            ("gaugeAddress", pa.string()),
+            ("recipientGaugeAddr", pa.string()),
+            ("poolId", pa.string()),
+            ("poolAddress", pa.string()),
+            ("symbol", pa.string()),
+            # Inputs
+            ("gaugeWeight", pa.int64()),
+            ("protocolFees", pa.float64()),
+            ("balPriceUsd", pa.float64()),
+            ("emissionsPerWeek", pa.float64()),
+            # Outputs
+            ("voteWeightNoBoost", pa.float64()),
+            ("staticBoost", pa.float64()),
+            ("dynamicBoost", pa.float64()),
+            ("boost", pa.float64()),
+            ("voteWeight", pa.float64()),
+            ("capPct", pa.float64()),
+            ("fixedIncentive", pa.float64()),
+            ("distribution", pa.float64()),
+            ("pctDistribution", pa.float64()),
+            ("distributionWei", pa.decimal128(38, 0)),
+        ]
+    )
+
+
+def _partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(
+        pa.schema([("program", pa.string()), ("epoch", pa.string())]), flavor="hive"
+    )
+
+
+def _epoch_key(epoch: Union[str, date, datetime]) -> str:
+    if isinstance(epoch, datetime):
+        epoch = epoch.date()
+    return epoch.isoformat() if isinstance(epoch, date) else epoch
+
+
+def append_epoch_history(
+    config: ProgramConfig,
+    gauge_distributions: Dict,
+    start_date: datetime,
+    end_date: datetime,
+    inputs: EpochInputs,
+    history_dir: str = DEFAULT_HISTORY_DIR,
+) -> Optional[str]:
+    """
+    Write a program epoch's per gauge inputs and outputs to its partition of the history dataset, replacing
+    what an earlier run of the same epoch wrote. Needs pyarrow, returns the partition file written or None
+    """
+    if not _pyarrow_available():
+        return None
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rows = []
+    for gauge_addr, gauge in gauge_distributions.items():
+        gauge_data = inputs.gauges[gauge_addr]
+        rows.append(
+            {
+                "epochStart": int(start_date.timestamp()),
+                "epochEnd": int(end_date.timestamp()),
+                "chain": config.chain_name,
+                "targetBlock": inputs.target_block,
+                "gaugeAddress": gauge_addr,
+                "recipientGaugeAddr": gauge["recipientGaugeAddr"],
+                "poolId": gauge_data["id"],
+                "poolAddress": gauge["poolAddress"],
+                "symbol": gauge["symbol"],
+                "gaugeWeight": inputs.gauge_weights[gauge_addr],
+                "protocolFees": inputs.pool_fees.get(gauge_data["pool"].lower(), 0.0),
+                "balPriceUsd": inputs.bal_token_price,
+                "emissionsPerWeek": inputs.emissions_per_week,
+                "voteWeightNoBoost": gauge["voteWeightNoBoost"],
+                "staticBoost": gauge["staticBoost"],
+                "dynamicBoost": gauge["dynamicBoost"],
+                "boost": gauge["boost"],
+                "voteWeight": gauge["voteWeight"],
+                "capPct": float(gauge["cap"].rstrip("%")),
+                "fixedIncentive": gauge["fixedIncentive"],
+                "distribution": gauge["distribution"],
+                "pctDistribution": gauge["pctDistribution"],
+                "distributionWei": Decimal(gauge["distributionWei"]),
+            }
+        )
+    partition_dir = os.path.join(
+        history_dir, f"program={config.file_prefix}", f"epoch={_epoch_key(end_date)}"
+    )
+    os.makedirs(partition_dir, exist_ok=True)
+    path = os.path.join(partition_dir, PARTITION_FILE)
+    # Files starting with a dot are skipped when the dataset is read, so readers never see a partial file
+    tmp_path = os.path.join(partition_dir, f".{PARTITION_FILE}.{os.getpid()}.tmp")
+    pq.write_table(pa.Table.from_pylist(rows, schema=_schema()), tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def query_history(
+    columns: Optional[List[str]] = None,
+    programs: Optional[List[str]] = None,
+    from_epoch: Optional[Union[str, date, datetime]] = None,
+    to_epoch: Optional[Union[str, date, datetime]] = None,
+    gauges: Optional[List[str]] = None,
+    history_dir: str = DEFAULT_HISTORY_DIR,
+) -> pd.DataFrame:
+    """
+    Rows of the history dataset as a DataFrame. Only the requested `columns` are read, and only from the
+    partitions of `programs` with epochs ending between `from_epoch` and `to_epoch` inclusive. `program`
+    and `epoch` (end date) can be selected like any other column, e.g. the dynamic boost of a gauge over time:
+
+        query_history(["epoch", "dynamicBoost"], programs=["example_op_config"], gauges=["0x..."])
+    """
+    import pandas as pd
+
+    if not _pyarrow_available() or not os.path.isdir(history_dir):
+        return pd.DataFrame(columns=columns)
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(
+        history_dir,
+        format="parquet",
+        partitioning=_partitioning(),
+    )
+    conditions = []
+    if programs:
+        conditions.append(ds.field("program").isin(programs))
+    if from_epoch is not None:
+        conditions.append(ds.field("epoch") >= _epoch_key(from_epoch))
+    if to_epoch is not None:
+        conditions.append(ds.field("epoch") <= _epoch_key(to_epoch))
+    if gauges:
+        conditions.append(ds.field("gaugeAddress").isin(gauges))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
@@ -1,231 +1,296 @@
+from __future__ import annotations
+
 import json
 import os
-from collections import defaultdict
+from dataclasses import dataclass
+from dataclasses import field
 from datetime import datetime
 from datetime import timedelta
 from decimal import Decimal
+from functools import lru_cache
 from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import Optional
+from typing import TYPE_CHECKING
+from typing import Tuple
 
-import pandas as pd
 from dotenv import load_dotenv
-from gql import Client
-from gql import gql
-from gql.transport.requests import RequestsHTTPTransport
-from pycoingecko import CoinGeckoAPI
-from web3 import Web3
-import importlib
-
-from automation.constants import TOTAL_TOKENS_PER_EPOCH
-from automation.constants import TOKENS_TO_FOLLOW_VOTING
-from automation.constants import BALANCER_GAUGE_CONTROLLER_ABI
-from automation.constants import CHAIN_NAME
-from automation.constants import DYNAMIC_BOOST_CAP
-from automation.constants import MIN_BAL_IN_USD_FOR_BOOST
-from automation.constants import POOLS_SNAPSHOTS_QUERY
-from automation.constants import DESIRED_DEFAULT_VOTE_CAP
-from automation.constants import FILE_PREFIX
+from eth_utils import to_checksum_address
+
+from automation.allocation import WEI
+from automation.allocation import apportion
+from automation.allocation import boost_to_int
+from automation.allocation import percent_of_wei
+from automation.allocation import to_wei
+from automation.allocation import water_fill_wei
+from automation.cassette import cassette_call
+from automation.checkpoints import checkpointed
+from automation.checkpoints import clear_checkpoints
+from automation.checkpoints import use_checkpoints
 from automation.emissions_per_year import (
     get_emissions_per_week,
 )
+from automation.gql_clients import get_gql_client
+from automation.helpers import BAL_TOKEN_ADDRESS
 from automation.helpers import fetch_all_pools_info
-from automation.helpers import get_abi
+from automation.helpers import fetch_token_prices_balgql
 from automation.helpers import get_block_by_ts
+from automation.helpers import reduce_pool_snapshots_between_timestamps
+from automation.helpers import get_root_gauge_recipients
+from automation.helpers import get_subgraph_url
+from automation.history import append_epoch_history
+from automation.metrics import record_metrics
+from automation.metrics import stage
+from automation.multicall import multicall
+from automation.program_config import ProgramConfig
+from automation.program_config import load_program_config
 
-from .payload_builders import generate_and_save_bal_injector_transaction
-
-# import boost_data, cap_override_data and fixed_emissions_per_pool from the python file specified in POOL_CONFIG
-pool_config = importlib.import_module(f"automation.{FILE_PREFIX}")
-boost_data = pool_config.boost_data
-cap_override_data = pool_config.cap_override_data
-fixed_emissions_per_pool = pool_config.fixed_emissions_per_pool
-from bal_addresses import AddrBook
-from bal_tools import Subgraph
-from bal_addresses import to_checksum_address
-
-# Configure Library objects for chain
-addressbook = AddrBook(CHAIN_NAME)
-subgraph = Subgraph(CHAIN_NAME)
-BALANCER_GAUGE_CONTROLLER_ADDR = (
-    AddrBook("mainnet").search_unique("GaugeController").address
-)
+from .payload_builders import INJECTOR_PERIODS
+from .payload_builders import generate_and_save_payloads
 
-# Build the whitelist
-whitelist = []
-for _pid in fixed_emissions_per_pool.keys():
-    whitelist.append(_pid.lower())
+# pandas, web3, gql, pycoingecko and bal_addresses take seconds to import between them, so they are only
+# imported by the functions that use them
+if TYPE_CHECKING:
+    from bal_addresses import AddrBook
+    from gql import Client
+    from web3 import Web3
 
-# Make sure we have enough capacity to distribute all our votes.
-# There is still an edge case here when some pools are capped under the final default cap and hence there is not
-# capacity to distribute 100% of tokens
-default_vote_cap = max(DESIRED_DEFAULT_VOTE_CAP, 100 / len(whitelist))
-if not default_vote_cap == DESIRED_DEFAULT_VOTE_CAP:
-    print(
-        f"WARNING: Default vote cap was set to {DESIRED_DEFAULT_VOTE_CAP} but was overridden to {default_vote_cap} to ensure all tokens are distributed"
+
+@dataclass
+class MainnetEpochData:
+    """
+    Mainnet side inputs of an epoch. They are the same for every program, so when several programs run for
+    the same epoch they are fetched once and shared
+    """
+
+    target_block: int
+    bal_token_price: float
+    # veBAL voting list of all chains from the Balancer API
+    voting_list: List[Dict]
+    # Raw gauge_relative_weight at target_block (1e18 = 100%), keyed by checksum root gauge address
+    gauge_weights: Dict[str, int] = field(default_factory=dict)
+
+
+@dataclass
+class EpochInputs:
+    """
+    Everything one program's allocation for an epoch is computed from, once fetched
+    """
+
+    target_block: int
+    # Program gauges from get_program_gauges, keyed by checksum root gauge address
+    gauges: Dict[str, Dict]
+    # Protocol fees collected during the epoch, keyed by lower case pool address
+    pool_fees: Dict[str, float]
+    # Raw gauge_relative_weight at target_block (1e18 = 100%), keyed by checksum root gauge address
+    gauge_weights: Dict[str, int]
+    bal_token_price: float
+    emissions_per_week: float
+    # L2 recipient gauge of every root gauge
+    recipient_gauges: Dict[str, str]
+
+
+@lru_cache(maxsize=None)
+def get_addressbook(chain: str) -> AddrBook:
+    from bal_addresses import AddrBook
+
+    return AddrBook(chain)
+
+
+@lru_cache(maxsize=None)
+def get_chain_name(chain: str) -> str:
+    """
+    Chain name as used by the Balancer API for an address book chain name
+    """
+    return cassette_call(
+        "addressbook",
+        {"chain": chain, "lookup": "chain"},
+        lambda: get_addressbook(chain).chain,
     )
-else:
-    print(
-        f"Default vote cap set to {DESIRED_DEFAULT_VOTE_CAP} which should be sufficient to distribute all tokens"
+
+
+@lru_cache(maxsize=None)
+def get_gauge_controller_address() -> str:
+    return cassette_call(
+        "addressbook",
+        {"chain": "mainnet", "lookup": "GaugeController"},
+        lambda: get_addressbook("mainnet").search_unique("GaugeController").address,
     )
 
 
+def get_mainnet_web3() -> Web3:
+    from automation.transports import make_web3
+
+    load_dotenv()
+    return make_web3(os.environ.get("ETHNODEURL"), "mainnet")
+
+
+def get_epoch_dates(end_date: int) -> Tuple[datetime, datetime]:
+    """
+    Start and end of the two week epoch ending at the `end_date` timestamp
+    """
+    end_date = datetime.fromtimestamp(end_date)
+    return end_date - timedelta(days=14), end_date
+
+
 def get_root_dir() -> str:
     return os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
 
 ## Todo: remove once all subgraph interactions have moved to bal_tools
 def make_gql_client(url: str) -> Optional[Client]:
-    transport = RequestsHTTPTransport(url=url, retries=3)
-    return Client(
-        transport=transport, fetch_schema_from_transport=True, execute_timeout=60
-    )
+    return get_gql_client(url, execute_timeout=60)
 
 
-def get_balancer_pool_fees_between_timestamps(start_ts: int, end_ts: int) -> List[Dict]:
+@stage("fee_snapshots")
+def get_balancer_pool_fees_between_timestamps(
+    start_ts: int, end_ts: int, chain: str
+) -> Dict[str, float]:
     """
     Fetch balancer pool snapshots from the subgraph and calculate protocol fees collected for each pool.
-    This works like this: fetch snapshots by time range from the graph, then find the first and last snapshot
-    and calculate the difference between them. This will give us the protocol fees collected for the period.
+    This works like this: stream snapshots by time range from the graph, keeping only the oldest and newest
+    snapshot per pool, and calculate the difference between them. This will give us the protocol fees
+    collected for the period.
+    Returns protocol fees collected keyed by lower case pool address
     """
     ## TODO: move to bal_tools
-    client = make_gql_client(subgraph.get_subgraph_url("core"))
-    all_snapthots = []
-    limit = 100
-    offset = 0
-    while True:
-        result = client.execute(
-            gql(
-                POOLS_SNAPSHOTS_QUERY.format(
-                    first=limit, skip=offset, start_ts=start_ts, end_ts=end_ts
-                )
-            )
-        )
-        all_snapthots.extend(result["poolSnapshots"])
-        offset += limit
-        if len(result["poolSnapshots"]) < limit - 1:
-            break
-    # Need to group by pool address, since there are multiple snapshots per pool and we need to calculate
-    # difference between first and last snapshot
-    pools = defaultdict(list)
-    for snapshot in all_snapthots:
-        pools[snapshot["pool"]["address"]].append(snapshot.get("protocolFee", 0))
-    # Now calculate the difference between first and last snapshot
-    fees_snapshots = []
-    for pool_addr, snapshots in pools.items():
-        if len(snapshots) > 1:
-            # Convert to int with respect that there might be null values and string values
-            first_snapshot = float(snapshots[0]) if snapshots[0] else 0
-            last_snapshot = float(snapshots[-1]) if snapshots[-1] else 0
-            fee_collected = first_snapshot - last_snapshot
-            assert fee_collected >= 0, f"Fee collected for pool {pool_addr} is negative"
-            fees_snapshots.append(
-                {
-                    "pool": {
-                        "address": pool_addr,
-                    },
-                    "protocolFee": fee_collected,
-                }
-            )
-    return fees_snapshots
+    return reduce_pool_snapshots_between_timestamps(
+        get_subgraph_url(chain, "core"), start_ts, end_ts
+    ).fees_collected()
 
 
-def get_bal_token_price() -> float:
+@stage("bal_price")
+def get_bal_token_price(
+    start_date: Optional[datetime] = None, twap_days: int = 14
+) -> float:
     """
-    Fetch bal token price from coingecko
+    Fetch bal token price. Spot price from coingecko by default, or the twap up to start_date from the
+    balancer api when a date is given
     """
+    if start_date is not None:
+        bal_twap = fetch_token_prices_balgql(
+            [(BAL_TOKEN_ADDRESS, "mainnet")], start_date, twap_days
+        )[(BAL_TOKEN_ADDRESS.lower(), "mainnet")]
+        if bal_twap is not None:
+            return float(bal_twap)
+        print(f"WARNING: No BAL price history up to {start_date}, using coingecko")
     # fetch balancer token usd price:
-    cg = CoinGeckoAPI()
-    return cg.get_price(ids="balancer", vs_currencies="usd")["balancer"]["usd"]
+    from automation.transports import get_coingecko_price
 
+    return get_coingecko_price(ids="balancer", vs_currencies="usd")["balancer"]["usd"]
 
-def recur_distribute_unspend_tokens(
-    max_tokens_per_pool: Dict, tokens_gauge_distributions: Dict
-) -> None:
+
+def distribute_unspent_tokens(
+    max_wei_per_pool: Dict,
+    tokens_gauge_distributions: Dict,
+    total_wei: int,
+    vote_weights: Dict[str, int],
+    unit: int = 1,
+) -> int:
     """
-    Recursively distribute unspent tokens to uncapped gauges proportionally to their voting weight until
-    there is no unspent tokens left
+    Distribute unspent wei to uncapped gauges proportionally to their integer voting weight, respecting caps.
+    Distributions are multiples of `unit` wei and stay that way. Returns the wei that could not be distributed
+    because all gauges are capped, plus the dust below one unit
     """
-    unspent_tokens = TOTAL_TOKENS_PER_EPOCH - sum(
-        [gauge["distribution"] for gauge in tokens_gauge_distributions.values()]
+    addrs = list(tokens_gauge_distributions.keys())
+    unspent_wei = total_wei - sum(
+        gauge["distributionWei"] for gauge in tokens_gauge_distributions.values()
     )
-    print(f"recursively distributing {unspent_tokens} unspent tokens")
-    if unspent_tokens > 0:
-        # Find out total voting weight of uncapped gauges and mark it as 100%:
-        total_uncapped_weight = sum(
-            [
-                g["voteWeight"]
-                for g in [
-                    gauge
-                    for addr, gauge in tokens_gauge_distributions.items()
-                    if gauge["distribution"] < max_tokens_per_pool[addr]
-                ]
-            ]
+    print(f"Distributing {unspent_wei / WEI} unspent tokens")
+    distributions, leftover = water_fill_wei(
+        [tokens_gauge_distributions[addr]["distributionWei"] // unit for addr in addrs],
+        [max_wei_per_pool[addr] // unit for addr in addrs],
+        [vote_weights[addr] for addr in addrs],
+        unspent_wei // unit,
+    )
+    for addr, distribution in zip(addrs, distributions):
+        tokens_gauge_distributions[addr]["distributionWei"] = distribution * unit
+    if leftover > 0:
+        print(
+            f"WARNING: Was not able to get all tokens under the cap due to a lack of capacity, {leftover * unit / WEI} tokens left undistributed. Double check that final distributions are sensible"
         )
-        # if total uncapped weight is 0, then we can not continue
-        print(f"Distributing {total_uncapped_weight} of vote weight is still uncapped.")
-        if total_uncapped_weight == 0:
-            print(
-                f"WARNING: Was not able to get all tokens under the cap due to a lack of capacity. Double check that final distributions are sensible"
-            )
-        # Iterate over uncapped gauges and distribute unspent tokens
-        # proportionally to their voting weight which is total uncapped weight
-        for a, uncap_gauge in {
-            addr: gauge
-            for addr, gauge in tokens_gauge_distributions.items()
-            if gauge["distribution"] < max_tokens_per_pool[addr]
-        }.items():
-            # For each loop calculate unspent tokens
-            unspent_tokens = TOTAL_TOKENS_PER_EPOCH - sum(
-                [gauge["distribution"] for gauge in tokens_gauge_distributions.values()]
-            )
-            # Don't distribute more than vote cap
-            distribution = min(
-                uncap_gauge["distribution"]
-                + unspent_tokens * uncap_gauge["voteWeight"] / total_uncapped_weight,
-                max_tokens_per_pool[a],
-            )
-            uncap_gauge["distribution"] = distribution
-            uncap_gauge["pctDistribution"] = (
-                uncap_gauge["distribution"] / TOTAL_TOKENS_PER_EPOCH * 100
-            )
-    # Call recursively if there is still unspent tokens
-    if (
-        TOTAL_TOKENS_PER_EPOCH
-        - sum([g["distribution"] for g in tokens_gauge_distributions.values()])
-        > 0
-    ):
-        recur_distribute_unspend_tokens(max_tokens_per_pool, tokens_gauge_distributions)
+    return leftover * unit + unspent_wei % unit
 
 
-def run_stip_pipeline(end_date: int) -> None:
+@stage("gauge_weights")
+def fetch_gauge_weights(
+    web3: Web3, gauge_addrs: Iterable[str], target_block: int
+) -> Dict[str, int]:
     """
-    Main function to execute STIP calculations
+    Read raw gauge_relative_weight of all gauges at the target block in as few multicall round trips as possible
     """
-    load_dotenv()
-    ####
-    # Collect data
-    ####
-    web3_mainnet = Web3(Web3.HTTPProvider(os.environ["ETHNODEURL"]))
-    end_date = datetime.fromtimestamp(end_date)
-    start_date = end_date - timedelta(days=14)
-    start_ts = int(start_date.timestamp())
-    end_ts = int(end_date.timestamp())
-    target_block = get_block_by_ts(end_ts, chain="mainnet")
-    pool_snapshots = get_balancer_pool_fees_between_timestamps(start_ts, end_ts)
-    print(f"Collected data for dates: {start_date.date()} - {end_date.date()}")
-    print(f"Block height at the end date: {target_block}")
-    emissions_per_week = get_emissions_per_week()
+    from automation.constants import BALANCER_GAUGE_CONTROLLER_ABI
+
+    gauge_addrs = [to_checksum_address(addr) for addr in gauge_addrs]
+    gauge_c_contract = web3.eth.contract(
+        address=get_gauge_controller_address(),
+        abi=BALANCER_GAUGE_CONTROLLER_ABI,
+    )
+    raw_gauge_weights = multicall(
+        web3,
+        [
+            gauge_c_contract.functions.gauge_relative_weight(gauge_addr)
+            for gauge_addr in gauge_addrs
+        ],
+        block_identifier=target_block,
+        allow_failure=False,
+    )
+    return dict(zip(gauge_addrs, raw_gauge_weights))
+
+
+def fetch_checkpointed_gauge_weights(
+    web3: Web3, gauge_addrs: Iterable[str], target_block: int
+) -> Dict[str, int]:
+    """
+    fetch_gauge_weights, resumed from the run's checkpoint when the same gauges were already read
+    """
+    gauge_addrs = sorted(to_checksum_address(addr) for addr in gauge_addrs)
+    if not gauge_addrs:
+        return {}
+    return checkpointed(
+        "gauge_weights",
+        {"gauges": gauge_addrs, "targetBlock": target_block},
+        lambda: fetch_gauge_weights(web3, gauge_addrs, target_block),
+    )
 
+
+def fetch_mainnet_epoch_data(
+    web3: Web3, end_ts: int, gauge_addrs: Iterable[str] = ()
+) -> MainnetEpochData:
+    """
+    Fetch the mainnet side of an epoch: target block, BAL price, voting list and weights for `gauge_addrs`
+    """
+    target_block = checkpointed(
+        "block_lookup",
+        {"timestamp": end_ts, "chain": "mainnet"},
+        lambda: get_block_by_ts(end_ts, chain="mainnet", web3=web3),
+    )
+    print(f"Block height at the end date: {target_block}")
+    bal_token_price = checkpointed("bal_price", {}, get_bal_token_price)
     # Fetch all pools from Balancer API
-    all_pools = fetch_all_pools_info(addressbook.chain)
+    voting_list = checkpointed(
+        "voting_list", {"chain": "mainnet"}, lambda: fetch_all_pools_info("mainnet")
+    )
+    return MainnetEpochData(
+        target_block=target_block,
+        bal_token_price=bal_token_price,
+        voting_list=voting_list,
+        gauge_weights=fetch_checkpointed_gauge_weights(web3, gauge_addrs, target_block),
+    )
 
-    # Collect gauges
+
+def get_program_gauges(config: ProgramConfig, voting_list: List[Dict]) -> Dict:
+    """
+    Collect gauges for the whitelisted pools of a program from the voting list
+    """
+    chain = get_chain_name(config.chain_name)
+    whitelist = config.whitelist
     gauges = {}
-    for pool in all_pools:
+    for pool in voting_list:
         # Only collect gauges for the whitelisted pools on the proper chain that are not killed
         if (
-            pool["chain"].lower() == addressbook.chain
+            pool["chain"].lower() == chain
             and pool["gauge"]["isKilled"] is False
             and pool["id"].lower() in whitelist
         ):
@@ -237,44 +302,39 @@ def run_stip_pipeline(end_date: int) -> None:
                 "symbol": pool["symbol"],
                 "id": pool["id"],
             }
-    print(f"Total gauges eligible for STIP emissions: {len(gauges)}")
+    return gauges
 
+
+@stage("allocation")
+def calculate_gauge_distributions(
+    config: ProgramConfig, inputs: EpochInputs, num_periods: int = INJECTOR_PERIODS
+) -> Dict:
+    """
+    Apply boosts and caps to the gauge weights of a program and split the epoch's tokens between its gauges.
+    Returns every eligible gauge, also those that get nothing. Every distribution is a multiple of `num_periods` wei, so the injector pays it out in equal periods.
+    The gauges of `inputs` are annotated with their vote weights
+    """
+    gauges = inputs.gauges
+    pool_fees = inputs.pool_fees
+    gauge_weights = inputs.gauge_weights
+    bal_token_price = inputs.bal_token_price
+    emissions_per_week = inputs.emissions_per_week
+    recipient_gauges = inputs.recipient_gauges
     pool_protocol_fees = {}
     # Collect protocol fees from the pool snapshots:
     for gauge_addr, gauge_data in gauges.items():
-        for pool_snapshot in pool_snapshots:
-            if Web3.to_checksum_address(
-                pool_snapshot["pool"]["address"]
-            ) == Web3.to_checksum_address(gauge_data["pool"]):
-                # Since snapshots are sorted by timestamp descending,
-                # we can just take the first one we find for each pool and break
-                protocol_fee = (
-                    float(pool_snapshot["protocolFee"])
-                    if pool_snapshot["protocolFee"]
-                    else 0
-                )
-                pool_protocol_fees[Web3.to_checksum_address(gauge_addr)] = protocol_fee
-                break
+        protocol_fee = pool_fees.get(gauge_data["pool"].lower())
+        if protocol_fee is not None:
+            pool_protocol_fees[gauge_addr] = protocol_fee
     print(f"Total protocol fees collected: {sum(pool_protocol_fees.values())}")
     # Apply boost data to gauges
     vote_weights = {}
+    int_vote_weights = {}
     combined_boost = {}
     # Dynamic boost data to print out in the final table
     dynamic_boosts = {}
-    # Collect gauge voting weights from the gauge controller on chain
-    gauge_c_contract = web3_mainnet.eth.contract(
-        address=BALANCER_GAUGE_CONTROLLER_ADDR,
-        abi=BALANCER_GAUGE_CONTROLLER_ABI,
-    )
-    bal_token_price = get_bal_token_price()
     for gauge_addr, gauge_data in gauges.items():
-        weight = (
-            gauge_c_contract.functions.gauge_relative_weight(
-                Web3.to_checksum_address(gauge_addr)
-            ).call(block_identifier=target_block)
-            / 1e18
-            * 100
-        )
+        weight = gauge_weights[gauge_addr] / 1e18 * 100
         gauges[gauge_addr]["weightNoBoost"] = weight
         # Calculate dynamic boost. Formula is `[Fees earned*multipler/value of bal emitted per pool]`
         # Value of bal earned must always be >1 to allow for the desired effect from division.
@@ -282,12 +342,12 @@ def run_stip_pipeline(end_date: int) -> None:
             (weight / 100) * emissions_per_week * bal_token_price
         )
         if (
-            dollar_value_of_bal_emitted >= MIN_BAL_IN_USD_FOR_BOOST
+            dollar_value_of_bal_emitted >= config.min_bal_in_usd_for_boost
             and dollar_value_of_bal_emitted > 1
         ):
             dynamic_boost = min(
                 pool_protocol_fees.get(gauge_addr, 0) / dollar_value_of_bal_emitted,
-                DYNAMIC_BOOST_CAP,
+                config.dynamic_boost_cap,
             )
             print(
                 f"Gauge {gauge_addr} has a fees of {pool_protocol_fees.get(gauge_addr, 0)} and earned {dollar_value_of_bal_emitted} in USD BAL rendering a raw dynamic boost of {dynamic_boost}"
@@ -299,83 +359,218 @@ def run_stip_pipeline(end_date: int) -> None:
         dynamic_boosts[gauge_addr] = dynamic_boost
 
         # Now calculate the final boost value, which uses formula - (dynamic boost + fixed boost) - 1
-        boost = (dynamic_boost + boost_data.get(gauge_data["id"], 1)) - 1
+        boost = (dynamic_boost + config.boost_data.get(gauge_data["id"], 1)) - 1
         combined_boost[gauge_addr] = boost
         weight *= boost
         vote_weights[gauge_addr] = weight
         gauges[gauge_addr]["voteWeight"] = weight
+        # Tokens are split on the exact on-chain weight times the boost in fixed point, the float above
+        # is only reported
+        int_vote_weights[gauge_addr] = gauge_weights[gauge_addr] * boost_to_int(boost)
     print(
-        f"Total boosted %veBAL vote weight across eligible ARB gauges: {sum(vote_weights.values())}"
+        f"Total boosted %veBAL vote weight across eligible gauges: {sum(vote_weights.values())}"
     )
 
     ####
     # Handle Caps
     ####
 
-    # Vote caps in percents are calculated as a percentage of the total amount of arb to distribute
-    # Custom gauge caps taken from override data in constants.py, calculated as a percentage of the total amount of
-    # arb to distribute
+    # Vote caps in percents are calculated as a percentage of the total amount of tokens to distribute
+    # Custom gauge caps taken from override data in the pool config, calculated as a percentage of the total
+    # amount of tokens to distribute. All amounts are integer wei from here on, so the distributions add up
+    # to the total exactly. They are split in units of num_periods wei, which the injector pays out evenly
+    total_tokens = config.total_tokens_per_epoch
+    total_wei = to_wei(total_tokens)
+    tokens_to_follow_wei = total_wei - to_wei(config.fixed_incentive_tokens_per_epoch)
+    default_vote_cap = config.default_vote_cap
     percent_vote_caps_per_gauge = {}
-    max_tokens_per_gauge = {}
+    max_wei_per_gauge = {}
     for gauge_addr in gauges.keys():
-        percent_vote_caps_per_gauge[gauge_addr] = cap_override_data.get(
+        percent_vote_caps_per_gauge[gauge_addr] = config.cap_override_data.get(
             gauges[gauge_addr]["id"].lower(), default_vote_cap
         )
-        max_tokens_per_gauge[gauge_addr] = (
-            percent_vote_caps_per_gauge[gauge_addr] / 100 * TOTAL_TOKENS_PER_EPOCH
+        max_wei_per_gauge[gauge_addr] = percent_of_wei(
+            total_wei, percent_vote_caps_per_gauge[gauge_addr]
+        )
+    # Split the tokens following votes by vote weight
+    voting_wei = dict(
+        zip(
+            gauges.keys(),
+            apportion(
+                tokens_to_follow_wei // num_periods, list(int_vote_weights.values())
+            )
+            * num_periods,
         )
-    # Calculate total weight
-    total_weight = sum([gauge["voteWeight"] for gauge in gauges.values()])
+    )
     gauge_distributions = {}
     for gauge_addr, gauge_data in gauges.items():
-        gauge_addr = Web3.to_checksum_address(gauge_addr)
-        # Calculate distribution based on vote weight and total weight
-        to_distribute = (
-            TOKENS_TO_FOLLOW_VOTING * gauge_data["voteWeight"] / total_weight
-        )
+        gauge_addr = to_checksum_address(gauge_addr)
         # Add in fixed incentives
-        to_distribute += fixed_emissions_per_pool.get(gauge_data["id"], 0)
+        fixed_wei = to_wei(config.fixed_emissions_per_pool.get(gauge_data["id"], 0))
+        to_distribute = voting_wei[gauge_addr] + fixed_wei // num_periods * num_periods
         # Cap distribution
-        to_distribute = (
-            to_distribute
-            if to_distribute < max_tokens_per_gauge[gauge_addr]
-            else max_tokens_per_gauge[gauge_addr]
-        )
-        # Get L2 gauge addr
-
-        ## Note this ABI should work for most chains given the functions we need
-        mainnet_root_gauge_contract = web3_mainnet.eth.contract(
-            address=Web3.to_checksum_address(gauge_addr), abi=get_abi("ArbRootGauge")
+        to_distribute = min(
+            to_distribute,
+            max_wei_per_gauge[gauge_addr] // num_periods * num_periods,
         )
-        to_distribute = min(to_distribute, max_tokens_per_gauge[gauge_addr])
         gauge_distributions[gauge_addr] = {
-            "recipientGaugeAddr": mainnet_root_gauge_contract.functions.getRecipient().call(),
+            "recipientGaugeAddr": recipient_gauges[gauge_addr],
             "poolAddress": gauge_data["poolAddress"],
             "symbol": gauge_data["symbol"],
-            "distribution": to_distribute,
-            "pctDistribution": to_distribute / TOTAL_TOKENS_PER_EPOCH * 100,
-            "distroToBalancer": to_distribute * pct_to_bal,
+            "distribution": to_distribute / WEI,
+            "pctDistribution": to_distribute / total_wei * 100,
+            "distributionWei": to_distribute,
             "voteWeightNoBoost": gauge_data["weightNoBoost"],
-            "staticBoost": boost_data.get(gauges[gauge_addr]["id"], 1),
+            "staticBoost": config.boost_data.get(gauges[gauge_addr]["id"], 1),
             "dynamicBoost": dynamic_boosts.get(gauge_addr, 1),
             "boost": combined_boost.get(gauge_addr, 1),
             "voteWeight": gauge_data["voteWeight"],
             "cap": f"{percent_vote_caps_per_gauge[gauge_addr]}%",
-            "fixedIncentive": fixed_emissions_per_pool[gauge_data["id"]],
+            "fixedIncentive": config.fixed_emissions_per_pool[gauge_data["id"]],
         }
-    recur_distribute_unspend_tokens(max_tokens_per_gauge, gauge_distributions)
-    print(
-        f"Unspent arb: {TOTAL_TOKENS_PER_EPOCH - sum([gauge['distribution'] for gauge in gauge_distributions.values()])}"
+    distribute_unspent_tokens(
+        max_wei_per_gauge,
+        gauge_distributions,
+        total_wei,
+        int_vote_weights,
+        unit=num_periods,
     )
-    print(
-        f"Tokens distributed: {sum([gauge['distribution'] for gauge in gauge_distributions.values()])}"
+    # Everything goes through the balancer injector, the split is taken after redistribution so
+    # injected amounts include redistributed tokens
+    for gauge in gauge_distributions.values():
+        gauge["distribution"] = gauge["distributionWei"] / WEI
+        gauge["pctDistribution"] = gauge["distributionWei"] / total_wei * 100
+        gauge["distroToBalancerWei"] = gauge["distributionWei"]
+    distributed_wei = sum(
+        gauge["distributionWei"] for gauge in gauge_distributions.values()
+    )
+    print(f"Unspent tokens: {(total_wei - distributed_wei) / WEI}")
+    print(f"Tokens distributed: {distributed_wei / WEI}")
+    return gauge_distributions
+
+
+def run_stip_pipeline(
+    end_date: int,
+    config: Optional[ProgramConfig] = None,
+    mainnet_data: Optional[MainnetEpochData] = None,
+) -> None:
+    """
+    Main function to execute STIP calculations for one program. `config` defaults to the program selected in
+    constants.py. `mainnet_data` lets several programs share the mainnet fetches of the same epoch.
+    Timing and request counts per stage are written to a _metrics.json file next to the csv. Fetched
+    stages are checkpointed under data/cache/checkpoints, so a rerun of a failed epoch resumes where the
+    last run stopped. The checkpoints are deleted once the run succeeded
+    """
+    config = config or load_program_config()
+    start_date, epoch_end = get_epoch_dates(end_date)
+    with record_metrics(
+        f"{get_root_dir()}/output/{config.file_prefix}_{start_date.date()}_{epoch_end.date()}_metrics.json",
+        program=config.file_prefix,
+        epochStart=int(start_date.timestamp()),
+        epochEnd=int(epoch_end.timestamp()),
+    ), use_checkpoints(config.file_prefix, str(epoch_end.date())):
+        _run_stip_pipeline(end_date, config, mainnet_data)
+    clear_checkpoints(config.file_prefix, str(epoch_end.date()))
+
+
+def fetch_epoch_inputs(
+    end_date: int,
+    config: ProgramConfig,
+    mainnet_data: Optional[MainnetEpochData] = None,
+) -> EpochInputs:
+    """
+    Fetch everything a program's allocation for the epoch ending at `end_date` is computed from
+    """
+    web3_mainnet = get_mainnet_web3()
+    start_date, end_date = get_epoch_dates(end_date)
+    start_ts = int(start_date.timestamp())
+    end_ts = int(end_date.timestamp())
+    if mainnet_data is None:
+        mainnet_data = fetch_mainnet_epoch_data(web3_mainnet, end_ts)
+    pool_fees = checkpointed(
+        "fee_snapshots",
+        {"startTs": start_ts, "endTs": end_ts, "chain": config.chain_name},
+        lambda: get_balancer_pool_fees_between_timestamps(
+            start_ts, end_ts, config.chain_name
+        ),
+    )
+    print(f"Collected data for dates: {start_date.date()} - {end_date.date()}")
+    emissions_per_week = get_emissions_per_week()
+
+    # Collect gauges
+    gauges = get_program_gauges(config, mainnet_data.voting_list)
+    print(f"Total gauges eligible for STIP emissions: {len(gauges)}")
+
+    # Collect gauge voting weights from the gauge controller on chain, unless already fetched for the epoch
+    missing_weights = [
+        addr for addr in gauges.keys() if addr not in mainnet_data.gauge_weights
+    ]
+    gauge_weights = {
+        **mainnet_data.gauge_weights,
+        **fetch_checkpointed_gauge_weights(
+            web3_mainnet, missing_weights, mainnet_data.target_block
+        ),
+    }
+    # Resolve L2 recipient gauges for all root gauges at once, these are served from the local cache on warm runs
+    recipient_gauges = checkpointed(
+        "recipient_lookups",
+        {"gauges": sorted(gauges.keys())},
+        lambda: get_root_gauge_recipients(web3_mainnet, list(gauges.keys())),
+    )
+    return EpochInputs(
+        target_block=mainnet_data.target_block,
+        gauges=gauges,
+        pool_fees=pool_fees,
+        gauge_weights=gauge_weights,
+        bal_token_price=mainnet_data.bal_token_price,
+        emissions_per_week=emissions_per_week,
+        recipient_gauges=recipient_gauges,
     )
 
-    # # Remove  gauges with 0 distribution
+
+def _run_stip_pipeline(
+    end_date: int, config: ProgramConfig, mainnet_data: Optional[MainnetEpochData]
+) -> None:
+    if not config.default_vote_cap == config.desired_default_vote_cap:
+        print(
+            f"WARNING: Default vote cap was set to {config.desired_default_vote_cap} but was overridden to {config.default_vote_cap} to ensure all tokens are distributed"
+        )
+    else:
+        print(
+            f"Default vote cap set to {config.desired_default_vote_cap} which should be sufficient to distribute all tokens"
+        )
+    ####
+    # Collect data
+    ####
+    inputs = fetch_epoch_inputs(end_date, config, mainnet_data)
+    gauge_distributions = calculate_gauge_distributions(config, inputs)
+
+    start_date, end_date = get_epoch_dates(end_date)
+    save_program_outputs(config, gauge_distributions, start_date, end_date, inputs)
+
+
+@stage("payload_build")
+def save_program_outputs(
+    config: ProgramConfig,
+    gauge_distributions: Dict,
+    start_date: datetime,
+    end_date: datetime,
+    inputs: Optional[EpochInputs] = None,
+    output_dir: Optional[str] = None,
+) -> None:
+    """
+    Write the epoch's distribution table to csv, build the payloads and, given the epoch's inputs, add the
+    epoch to the history dataset under <output_dir>/history. `output_dir` defaults to output/.
+    The csv and payloads only hold gauges that get tokens, the history has every eligible gauge
+    """
+    import pandas as pd
+
+    output_dir = output_dir or f"{get_root_dir()}/output"
+    all_gauge_distributions = gauge_distributions
     gauge_distributions = {
         addr: gauge
-        for addr, gauge in gauge_distributions.items()
-        if gauge["distribution"] > 0
+        for addr, gauge in all_gauge_distributions.items()
+        if gauge["distributionWei"] > 0
     }
 
     gauge_distributions_df = pd.DataFrame.from_dict(gauge_distributions, orient="index")
@@ -383,15 +578,30 @@ def run_stip_pipeline(end_date: int) -> None:
         by="pctDistribution", ascending=False
     )
     print(
-        f"Total arb distributed incl bonus: "
-        f"{sum([gauge['distribution'] for gauge in gauge_distributions.values()])}"
+        f"Total tokens distributed incl bonus: "
+        f"{sum(gauge['distributionWei'] for gauge in gauge_distributions.values()) / WEI}"
     )
     # Export to csv
+    os.makedirs(output_dir, exist_ok=True)
     gauge_distributions_df.to_csv(
-        f"{get_root_dir()}/output/{FILE_PREFIX}_{start_date.date()}_{end_date.date()}.csv",
+        f"{output_dir}/{config.file_prefix}_{start_date.date()}_{end_date.date()}.csv",
         index=False,
     )
 
-    bal_tx = generate_and_save_bal_injector_transaction(
-        gauge_distributions, start_date, end_date
+    generate_and_save_payloads(
+        gauge_distributions,
+        start_date,
+        end_date,
+        config.chain_name,
+        config.file_prefix,
+        output_dir=output_dir,
     )
+    if inputs is not None:
+        append_epoch_history(
+            config,
+            all_gauge_distributions,
+            start_date,
+            end_date,
+            inputs,
+            history_dir=os.path.join(output_dir, "history"),
+        )
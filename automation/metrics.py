@@ -0,0 +1,317 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextlib import nullcontext
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+
+try:
+    from opentelemetry import trace as otel_trace
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+except ImportError:
+    otel_trace = None
+
+# Upper bounds of the request latency histogram buckets, the last bucket catches everything slower
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+UNATTRIBUTED_STAGE = "unattributed"
+
+
+class RequestStats:
+    """
+    Counters of the outside requests of one kind (rpc, graphql, price_api) made in one stage
+    """
+
+    __slots__ = (
+        "requests",
+        "http_errors",
+        "failures",
+        "retries",
+        "bytes_sent",
+        "bytes_received",
+        "latency_ms_total",
+        "latency_counts",
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.http_errors = 0
+        self.failures = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_ms_total = 0.0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(
+        self,
+        latency_ms: float,
+        bytes_sent: int,
+        bytes_received: int,
+        retries: int,
+        http_error: bool,
+    ) -> None:
+        self.requests += 1
+        self.http_errors += int(http_error)
+        self.retries += retries
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.latency_ms_total += latency_ms
+        bucket = 0
+        while (
+            bucket < len(LATENCY_BUCKETS_MS) and latency_ms > LATENCY_BUCKETS_MS[bucket]
+        ):
+            bucket += 1
+        self.latency_counts[bucket] += 1
+
+    def to_dict(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "httpErrors": self.http_errors,
+            "failures": self.failures,
+            "retries": self.retries,
+            "bytesSent": self.bytes_sent,
+            "bytesReceived": self.bytes_received,
+            "latencyMsTotal": round(self.latency_ms_total, 3),
+            "latencyMsHistogram": {
+                "bucketsLe": list(LATENCY_BUCKETS_MS) + ["inf"],
+                "counts": self.latency_counts,
+            },
+        }
+
+
+class StageStats:
+    __slots__ = ("calls", "wall_time", "requests")
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_time = 0.0
+        self.requests: Dict[str, RequestStats] = {}
+
+    def to_dict(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "wallTime": round(self.wall_time, 6),
+            "requests": {
+                kind: stats.to_dict() for kind, stats in sorted(self.requests.items())
+            },
+        }
+
+
+class MetricsRecorder:
+    """
+    Wall time per stage and the outside requests made in each, for one pipeline run
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.stages: Dict[str, StageStats] = {}
+        self._lock = threading.Lock()
+
+    def _stage(self, name: str) -> StageStats:
+        if name not in self.stages:
+            self.stages[name] = StageStats()
+        return self.stages[name]
+
+    def stage_finished(self, name: str, wall_time: float) -> None:
+        with self._lock:
+            stats = self._stage(name)
+            stats.calls += 1
+            stats.wall_time += wall_time
+
+    def _request_stats(self, stage_name: str, kind: str) -> RequestStats:
+        stage_stats = self._stage(stage_name)
+        if kind not in stage_stats.requests:
+            stage_stats.requests[kind] = RequestStats()
+        return stage_stats.requests[kind]
+
+    def record_request(self, stage_name: str, kind: str, *args) -> None:
+        with self._lock:
+            self._request_stats(stage_name, kind).add(*args)
+
+    def record_failure(self, stage_name: str, kind: str) -> None:
+        with self._lock:
+            self._request_stats(stage_name, kind).failures += 1
+
+    def record_retry(self, stage_name: str, kind: str) -> None:
+        with self._lock:
+            self._request_stats(stage_name, kind).retries += 1
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "startedAt": self.started_at,
+                "wallTime": round(time.perf_counter() - self._started, 6),
+                "stages": {
+                    name: stats.to_dict() for name, stats in self.stages.items()
+                },
+            }
+
+    def save(self, path: str, **fields) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({**fields, **self.to_dict()}, f, indent=2)
+
+
+_recorder: contextvars.ContextVar = contextvars.ContextVar(
+    "metrics_recorder", default=None
+)
+_stage_name: contextvars.ContextVar = contextvars.ContextVar(
+    "metrics_stage", default=UNATTRIBUTED_STAGE
+)
+_tracer = None
+
+
+@contextmanager
+def record_metrics(path: str, **fields) -> Iterator[MetricsRecorder]:
+    """
+    Collect the metrics of everything run inside the block and write them to `path` as JSON on exit,
+    also when the block fails. `fields` are added to the top level of the file
+    """
+    recorder = MetricsRecorder()
+    token = _recorder.set(recorder)
+    status = "failed"
+    try:
+        yield recorder
+        status = "ok"
+    finally:
+        _recorder.reset(token)
+        recorder.save(path, status=status, **fields)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time a pipeline stage and attribute the requests made inside it to the stage. Works as a context
+    manager and as a decorator. Stages nest, requests count towards the innermost one
+    """
+    recorder = _recorder.get()
+    token = _stage_name.set(name)
+    started = time.perf_counter()
+    try:
+        with _tracer.start_as_current_span(name) if _tracer else nullcontext():
+            yield
+    finally:
+        _stage_name.reset(token)
+        if recorder is not None:
+            recorder.stage_finished(name, time.perf_counter() - started)
+
+
+def propagate(fn: Callable) -> Callable:
+    """
+    Wrap `fn` to run with the caller's metrics context. Worker threads start with an empty context,
+    so functions handed to a thread pool are wrapped with this to keep their requests attributed
+    """
+    context = contextvars.copy_context()
+
+    def _run(*args, **kwargs):
+        # A context can only be entered by one thread at a time, every call gets its own copy
+        return context.copy().run(fn, *args, **kwargs)
+
+    return _run
+
+
+def record_request(
+    kind: str,
+    latency_ms: float,
+    bytes_sent: int,
+    bytes_received: int,
+    retries: int = 0,
+    http_error: bool = False,
+) -> None:
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.record_request(
+            _stage_name.get(),
+            kind,
+            latency_ms,
+            bytes_sent,
+            bytes_received,
+            retries,
+            http_error,
+        )
+    if _tracer is not None:
+        otel_trace.get_current_span().add_event(
+            "request",
+            {
+                "kind": kind,
+                "latencyMs": latency_ms,
+                "bytesSent": bytes_sent,
+                "bytesReceived": bytes_received,
+                "retries": retries,
+            },
+        )
+
+
+def record_failure(kind: str) -> None:
+    """
+    Count a request that failed without a response, like a connection error or a timeout
+    """
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.record_failure(_stage_name.get(), kind)
+
+
+def record_retry(kind: str) -> None:
+    """
+    Count a request the scheduler is about to retry
+    """
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.record_retry(_stage_name.get(), kind)
+
+
+def response_hook(kind: str) -> Callable:
+    """
+    requests response hook recording latency, bytes both ways and the retries urllib3 made
+    """
+
+    def _on_response(response, *args, **kwargs):
+        body = response.request.body or b""
+        retries = getattr(response.raw, "retries", None)
+        record_request(
+            kind,
+            response.elapsed.total_seconds() * 1000,
+            len(body.encode() if isinstance(body, str) else body),
+            len(response.content),
+            len(retries.history) if retries is not None else 0,
+            not response.ok,
+        )
+
+    return _on_response
+
+
+def instrument_session(session, kind: str) -> None:
+    """
+    Record every response of a requests.Session
+    """
+    session.hooks["response"].append(response_hook(kind))
+
+
+def enable_otel_export(path: str) -> bool:
+    """
+    Export every stage as an OpenTelemetry span, with its requests as span events, to a local file of
+    JSON spans. Needs opentelemetry-sdk, returns False when it isn't installed
+    """
+    global _tracer
+    if otel_trace is None:
+        print("WARNING: opentelemetry-sdk is not installed, not exporting spans")
+        return False
+    provider = TracerProvider()
+    spans_file = open(path, "a")
+    provider.add_span_processor(
+        SimpleSpanProcessor(
+            ConsoleSpanExporter(
+                out=spans_file,
+                formatter=lambda span: span.to_json(indent=None) + os.linesep,
+            )
+        )
+    )
+    _tracer = provider.get_tracer("vote_following_incentives_director")
+    return True
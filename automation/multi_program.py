@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from typing import List
+from typing import Optional
+
+from automation.checkpoints import clear_checkpoints
+from automation.checkpoints import use_checkpoints
+from automation.lstGrant import fetch_checkpointed_gauge_weights
+from automation.lstGrant import fetch_mainnet_epoch_data
+from automation.lstGrant import get_epoch_dates
+from automation.lstGrant import get_mainnet_web3
+from automation.lstGrant import get_program_gauges
+from automation.lstGrant import get_root_dir
+from automation.lstGrant import run_stip_pipeline
+from automation.metrics import record_metrics
+from automation.program_config import ProgramConfig
+
+
+def run_programs(
+    end_date: int, configs: List[ProgramConfig], max_workers: Optional[int] = None
+) -> None:
+    """
+    Run several programs for the same epoch concurrently from one process. The mainnet side of the epoch
+    (target block, BAL price, voting list and the weights of every program's gauges) is fetched once up
+    front and shared by all of them. Its metrics are written to output/shared_<start>_<end>_metrics.json
+    and its checkpoints kept under the program name "shared" until every program succeeded
+    """
+    web3_mainnet = get_mainnet_web3()
+    start_date, epoch_end = get_epoch_dates(end_date)
+    with record_metrics(
+        f"{get_root_dir()}/output/shared_{start_date.date()}_{epoch_end.date()}_metrics.json",
+        programs=[config.file_prefix for config in configs],
+        epochStart=int(start_date.timestamp()),
+        epochEnd=int(epoch_end.timestamp()),
+    ), use_checkpoints("shared", str(epoch_end.date())):
+        mainnet_data = fetch_mainnet_epoch_data(
+            web3_mainnet, int(epoch_end.timestamp())
+        )
+        gauge_addrs = set()
+        for config in configs:
+            gauge_addrs.update(
+                get_program_gauges(config, mainnet_data.voting_list).keys()
+            )
+        mainnet_data.gauge_weights = fetch_checkpointed_gauge_weights(
+            web3_mainnet, gauge_addrs, mainnet_data.target_block
+        )
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers or len(configs)) as executor:
+        futures = {
+            executor.submit(run_stip_pipeline, end_date, config, mainnet_data): config
+            for config in configs
+        }
+        for future in as_completed(futures):
+            config = futures[future]
+            try:
+                future.result()
+                print(f"Finished program {config.file_prefix}")
+            except Exception as e:
+                print(f"ERROR: Program {config.file_prefix} failed: {e!r}")
+                failed.append(config.file_prefix)
+    if failed:
+        raise RuntimeError(f"Programs failed: {', '.join(failed)}")
+    clear_checkpoints("shared", str(epoch_end.date()))
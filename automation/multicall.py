@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import TYPE_CHECKING
+from typing import Union
+
+from eth_utils import to_checksum_address
+
+if TYPE_CHECKING:
+    from web3 import Web3
+    from web3.contract.contract import ContractFunction
+
+# Multicall3 is deployed at the same address on every chain we run programs on
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+# Number of calls packed into a single aggregate3 eth_call. Large enough to keep round trips low,
+# small enough to stay under the gas cap most RPC providers apply to eth_call
+DEFAULT_CHUNK_SIZE = 500
+
+MULTICALL3_ABI = [
+    {
+        "stateMutability": "payable",
+        "type": "function",
+        "name": "aggregate3",
+        "inputs": [
+            {
+                "name": "calls",
+                "type": "tuple[]",
+                "components": [
+                    {"name": "target", "type": "address"},
+                    {"name": "allowFailure", "type": "bool"},
+                    {"name": "callData", "type": "bytes"},
+                ],
+            }
+        ],
+        "outputs": [
+            {
+                "name": "returnData",
+                "type": "tuple[]",
+                "components": [
+                    {"name": "success", "type": "bool"},
+                    {"name": "returnData", "type": "bytes"},
+                ],
+            }
+        ],
+    },
+]
+
+
+class MulticallError(Exception):
+    pass
+
+
+def _collapse_type(output: Dict) -> str:
+    """
+    Turn an ABI output entry into the type string understood by the abi codec, expanding tuples
+    """
+    if not output["type"].startswith("tuple"):
+        return output["type"]
+    inner = ",".join([_collapse_type(c) for c in output["components"]])
+    return f"({inner}){output['type'][len('tuple'):]}"
+
+
+def _decode_output(web3: Web3, fn: ContractFunction, return_data: bytes) -> Any:
+    output_types = [_collapse_type(o) for o in fn.abi["outputs"]]
+    decoded = web3.codec.decode(output_types, return_data)
+    # Mirror ContractFunction.call(): single return values are unwrapped
+    if len(decoded) == 1:
+        return decoded[0]
+    return list(decoded)
+
+
+def multicall(
+    web3: Web3,
+    calls: Sequence[ContractFunction],
+    block_identifier: Optional[Union[int, str]] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    allow_failure: bool = True,
+) -> List[Any]:
+    """
+    Execute a list of bound contract function calls through Multicall3 aggregate3, pinned to a single block.
+    Calls are sent in chunks of `chunk_size`, so N calls cost ceil(N / chunk_size) RPC round trips.
+    Results are returned in the same order as `calls`. When `allow_failure` is True a reverted call
+    yields None in its slot, otherwise MulticallError is raised
+    """
+    if not calls:
+        return []
+    from eth_abi.exceptions import DecodingError
+    from web3.exceptions import ContractLogicError
+
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+    multicall_contract = web3.eth.contract(
+        address=to_checksum_address(MULTICALL3_ADDRESS), abi=MULTICALL3_ABI
+    )
+    results = []
+    for chunk_start in range(0, len(calls), chunk_size):
+        chunk = calls[chunk_start : chunk_start + chunk_size]
+        call_structs = [
+            (fn.address, allow_failure, fn._encode_transaction_data()) for fn in chunk
+        ]
+        try:
+            responses = multicall_contract.functions.aggregate3(call_structs).call(
+                block_identifier=block_identifier
+            )
+        except ContractLogicError as e:
+            # aggregate3 only reverts as a whole when a call with allowFailure=False fails
+            raise MulticallError(
+                f"Multicall batch starting at call {chunk_start} reverted: {e}"
+            ) from e
+        for fn, (success, return_data) in zip(chunk, responses):
+            if success and len(return_data) > 0:
+                try:
+                    results.append(_decode_output(web3, fn, return_data))
+                    continue
+                except DecodingError:
+                    # e.g. old tokens returning bytes32 where the ABI says string
+                    pass
+            if not allow_failure:
+                raise MulticallError(f"Call {fn.fn_name} on {fn.address} failed")
+            print(
+                f"WARNING: multicall to {fn.fn_name} on {fn.address} failed at block {block_identifier}"
+            )
+            results.append(None)
+    return results
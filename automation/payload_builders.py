@@ -1,76 +1,249 @@
-from bal_tools import Aura
 import json
 import os
-import copy
-import math
 from datetime import datetime
-from decimal import Decimal, ROUND_DOWN
+from decimal import Decimal
+from functools import lru_cache
 from typing import Dict
-from automation.constants import FILE_PREFIX
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
 
-precision = Decimal(
-    "0." + "0" * 9 + "1"
-)  # 10 0s after the dot is insignificant for our purposes and takes care of rounding errors.
+from automation.allocation import WEI
+from automation.allocation import to_wei
+
+INJECTOR_TEMPLATE = "output_tx_template.json"
+AURA_DIRECT_TEMPLATE = "aura_direct_stream.json"
+# Template transactions are picked by the contract method they call, not by position
+SET_RECIPIENT_LIST_METHOD = "setRecipientList"
+TRANSFER_METHOD = "transfer"
+APPROVE_METHOD = "approve"
+# Periods the balancer injector spreads a gauge's tokens over
+INJECTOR_PERIODS = 2
 
 
 def get_root_dir() -> str:
     return os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
 
+@lru_cache(maxsize=None)
+def load_template(name: str) -> Optional[Dict]:
+    """
+    Parsed payload template from data/, read once per process. None if the template doesn't exist.
+    The result is shared between calls and must not be modified
+    """
+    path = f"{get_root_dir()}/data/{name}"
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=None)
+def get_aura_pids(chain_name: str) -> Dict[str, int]:
+    from bal_tools import Aura
+
+    return Aura(chain_name).aura_pids_by_address
+
+
+def _method_name(tx: Dict) -> Optional[str]:
+    return (tx.get("contractMethod") or {}).get("name")
+
+
+def _with_inputs(tx: Dict, **inputs) -> Dict:
+    """
+    Template transaction with some of its contractInputsValues replaced, sharing everything else
+    """
+    return {**tx, "contractInputsValues": {**tx["contractInputsValues"], **inputs}}
+
+
+def _indented(value, level: int) -> str:
+    return json.dumps(value, indent=2).replace("\n", "\n" + "  " * level)
+
+
+def write_payload(path: str, template: Dict, transactions: Iterable[Dict]) -> None:
+    """
+    Write a transaction builder payload with the template's fields and `transactions` to `path`. Transactions
+    are written one at a time as they are generated, so a payload is never held in memory as a whole.
+    The file is the same as json.dump(..., indent=2) would write
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        separator = "{\n"
+        for key, value in template.items():
+            f.write(f"{separator}  {json.dumps(key)}: ")
+            separator = ",\n"
+            if key != "transactions":
+                f.write(_indented(value, 1))
+                continue
+            written = 0
+            for tx in transactions:
+                f.write(",\n    " if written else "[\n    ")
+                f.write(_indented(tx, 2))
+                written += 1
+            f.write("\n  ]" if written else "[]")
+        f.write("\n}")
+
+
+def save_bal_injector_payload(
+    records: List[Tuple[str, int]], num_periods: int, path: str
+) -> int:
+    """
+    Fill the injector template with (recipient gauge, wei per period) records: setRecipientList gets the
+    gauges and their amounts, transfer the total the injector will pay out over all periods. Other
+    template transactions are kept as they are. Returns the total
+    """
+    template = load_template(INJECTOR_TEMPLATE)
+    total_amount = sum(amount for _, amount in records) * num_periods
+    recipient_inputs = {
+        "gaugeAddresses": f"[{','.join(gauge for gauge, _ in records)}]",
+        "amountsPerPeriod": f"[{','.join(str(amount) for _, amount in records)}]",
+        "maxPeriods": f"[{','.join([str(num_periods)] * len(records))}]",
+    }
+
+    def _transactions() -> Iterable[Dict]:
+        for tx in template["transactions"]:
+            method = _method_name(tx)
+            if method == SET_RECIPIENT_LIST_METHOD:
+                yield _with_inputs(tx, **recipient_inputs)
+            elif method == TRANSFER_METHOD:
+                yield _with_inputs(tx, amount=str(total_amount))
+            else:
+                yield tx
+
+    write_payload(path, template, _transactions())
+    print(
+        f"{total_amount}({total_amount / WEI}) $ARB transferred for balancer injector"
+    )
+    return total_amount
+
+
+def save_aura_direct_payload(
+    records: List[Tuple[str, int]], chain_name: str, num_periods: int, path: str
+) -> Optional[int]:
+    """
+    Fill the aura direct template with (recipient gauge, wei) records: one stream per gauge, by aura pid,
+    after an approve of the total. Returns the total, or None if there is no aura direct template
+    """
+    template = load_template(AURA_DIRECT_TEMPLATE)
+    if template is None:
+        print(
+            f"WARNING: No data/{AURA_DIRECT_TEMPLATE} template, not building the aura direct payload"
+        )
+        return None
+    approve_tx = next(
+        tx for tx in template["transactions"] if _method_name(tx) == APPROVE_METHOD
+    )
+    stream_tx = next(
+        tx for tx in template["transactions"] if "_pid" in tx["contractInputsValues"]
+    )
+    aura_pids = get_aura_pids(chain_name)
+    total_amount = sum(amount for _, amount in records)
+
+    def _transactions() -> Iterable[Dict]:
+        yield _with_inputs(approve_tx, amount=str(total_amount))
+        for gauge, amount in records:
+            aura_pid = aura_pids.get(gauge)
+            if not aura_pid:
+                print(
+                    f"WARNING: No aura pid found for gauge {gauge}, using gauge address in payload instead for easy debugging."
+                )
+                aura_pid = gauge
+            yield _with_inputs(
+                stream_tx, _pid=aura_pid, _amount=str(amount), _periods=str(num_periods)
+            )
+
+    write_payload(path, template, _transactions())
+    print(f"{total_amount}({total_amount / WEI}) $ARB approved for aura direct")
+    return total_amount
+
+
+def generate_and_save_payloads(
+    tokens_gauge_distributions: Dict,
+    start_date: datetime,
+    end_date: datetime,
+    chain_name: str,
+    file_prefix: str,
+    num_periods: int = INJECTOR_PERIODS,
+    output_dir: Optional[str] = None,
+) -> None:
+    """
+    Build the epoch's balancer injector and aura direct payloads in a single pass over the distributions,
+    from each gauge's distroToBalancerWei and distroToAuraWei. Injector amounts have to be multiples of
+    `num_periods` wei, so the payload pays out exactly what was allocated. Payloads are written to
+    `output_dir`, output/ by default
+    """
+    injector_records = []
+    aura_records = []
+    for gauge in tokens_gauge_distributions.values():
+        if gauge.get("distroToBalancerWei", 0) > 0:
+            # The injector pays the same amount every period, anything else would lose wei to rounding
+            if gauge["distroToBalancerWei"] % num_periods:
+                raise ValueError(
+                    f"Distribution of {gauge['recipientGaugeAddr']} can't be split evenly over {num_periods} periods"
+                )
+            injector_records.append(
+                (
+                    gauge["recipientGaugeAddr"],
+                    gauge["distroToBalancerWei"] // num_periods,
+                )
+            )
+        if gauge.get("distroToAuraWei", 0) > 0:
+            aura_records.append((gauge["recipientGaugeAddr"], gauge["distroToAuraWei"]))
+    output_dir = output_dir or f"{get_root_dir()}/output"
+    path_prefix = f"{output_dir}/{file_prefix}_{start_date.date()}_{end_date.date()}"
+    if injector_records:
+        save_bal_injector_payload(
+            injector_records, num_periods, f"{path_prefix}_bal_injector_stream.json"
+        )
+    else:
+        print("No distributions to send to the balancer injector")
+    if aura_records:
+        save_aura_direct_payload(
+            aura_records,
+            chain_name,
+            num_periods,
+            f"{path_prefix}_aura_direct_stream.json",
+        )
+
+
+def _read_payload(path: str) -> Dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def _default_path(start_date: datetime, end_date: datetime, suffix: str) -> str:
+    from automation.constants import FILE_PREFIX
+
+    return f"{get_root_dir()}/output/{FILE_PREFIX}_{start_date.date()}_{end_date.date()}_{suffix}"
+
+
 def generate_and_save_aura_transaction(
     tokens_gauge_distributions: Dict,
     start_date: datetime,
     end_date: datetime,
     chain_name: str,
     pct_of_distribution: Decimal = Decimal(1),
-    num_periods: int = 2,
-) -> Dict:
+    num_periods: int = INJECTOR_PERIODS,
+) -> Optional[Dict]:
     """
-    Take a set of distributions and send them to aura direct
-    """
-    aura = Aura(chain_name)
-    # Dump into output.json using:
-    with open(f"{get_root_dir()}/data/aura_direct_stream.json") as f:
-        output_data = json.load(f)
-    # Find transaction with func name `setRecipientList` and dump gauge
-    gauge_distributions = tokens_gauge_distributions.values()
-    tx_template = output_data["transactions"][1]
-    tx_list = []
-    total_amount = 0
-    # Inject list of gauges addresses:
-    for gauge in gauge_distributions:
-        aura_pid = aura.aura_pids_by_address.get(gauge["recipientGaugeAddr"])
-        if not aura_pid:
-            print(
-                f"WARNING: No aura pid found for gauge {gauge['recipientGaugeAddr']}, using gauge address in payload instead for easy debugging."
-            )
-            aura_pid = gauge["recipientGaugeAddr"]
-        tx = copy.deepcopy(tx_template)
-        tx["contractInputsValues"]["_pid"] = aura_pid
-        amount = (
+    Take a set of distributions and send `pct_of_distribution` of each gauge's distroToAura to aura direct.
+    Returns the payload, None if there is nothing to send or no aura direct template
+    """
+    records = []
+    for gauge in tokens_gauge_distributions.values():
+        wei_amount = to_wei(
             Decimal(gauge["distroToAura"]) * Decimal(pct_of_distribution)
-        ).quantize(precision, rounding=ROUND_DOWN)
-        wei_amount = (amount * Decimal(1e18)).to_integral_value()
-        tx["contractInputsValues"]["_amount"] = str(wei_amount)
-        tx["contractInputsValues"]["_periods"] = str(num_periods)
+        )
         if wei_amount > 0:
-            tx_list.append(tx)
-            total_amount += wei_amount
-    if not tx_list:
+            records.append((gauge["recipientGaugeAddr"], wei_amount))
+    if not records:
         print("No distributions to send to aura direct")
-        return
-    # Add approve tx
-    approve_tx = output_data["transactions"][0]
-    approve_tx["contractInputsValues"]["amount"] = str(total_amount)
-    tx_list.insert(0, approve_tx)
-    output_data["transactions"] = tx_list
-    with open(
-        f"{get_root_dir()}/output/{FILE_PREFIX}_{start_date.date()}_{end_date.date()}_aura_direct_stream.json",
-        "w",
-    ) as _f:
-        json.dump(output_data, _f, indent=2)
-    print(f"{total_amount}({total_amount/Decimal(1e18)}) $ARB approved for aura direct")
-    return output_data
+        return None
+    path = _default_path(start_date, end_date, "aura_direct_stream.json")
+    if save_aura_direct_payload(records, chain_name, num_periods, path) is None:
+        return None
+    return _read_payload(path)
 
 
 def generate_and_save_bal_injector_transaction(
@@ -78,50 +251,20 @@ def generate_and_save_bal_injector_transaction(
     start_date: datetime,
     end_date: datetime,
     pct_of_distribution: Decimal = Decimal(1),
-    num_periods: int = 2,
+    num_periods: int = INJECTOR_PERIODS,
 ) -> Dict:
     """
-    Take tx template and inject data into it
-    """
-    # Dump into output.json using:
-    with open(f"{get_root_dir()}/data/output_tx_template.json") as f:
-        output_data = json.load(f)
-
-    # Find transaction with func name `setRecipientList` and dump gauge
-    gauge_distributions = tokens_gauge_distributions.values()
-    claim_tx = output_data["transactions"][0]
-    tx_template = output_data["transactions"][1]
-    transfer_tx = output_data["transactions"][2]
-    tx_list = []
-    gauges_list = []
-    amounts_list = []
-    max_periods_list = []
-    total_amount = 0
-    # Inject list of gauges addresses:
-    for gauge in gauge_distributions:
-        gauges_list.append(gauge["recipientGaugeAddr"])
-        epoch_amount = (
-            Decimal(gauge["distroToBalancer"]) * Decimal(pct_of_distribution)
-        ).quantize(precision, rounding=ROUND_DOWN)
-        period_amount = epoch_amount / Decimal(num_periods)
-        wei_amount = (period_amount * Decimal(1e18)).to_integral_value()
-        total_amount += (epoch_amount * Decimal(1e18)).to_integral_value()
-        amounts_list.append(str(wei_amount))
-        max_periods_list.append(str(num_periods))
-    tx = copy.deepcopy(tx_template)
-    tx["contractInputsValues"]["gaugeAddresses"] = f"[{','.join(gauges_list)}]"
-    tx["contractInputsValues"]["amountsPerPeriod"] = f"[{','.join(amounts_list)}]"
-    tx["contractInputsValues"]["maxPeriods"] = f"[{','.join(max_periods_list)}]"
-    tx_list.append(tx)
-
-    transfer_tx["contractInputsValues"]["amount"] = str(int(total_amount))
-    tx_list.append(transfer_tx)
-    tx_list.insert(0, claim_tx)
-    output_data["transactions"] = tx_list
-    with open(
-        f"{get_root_dir()}/output/{FILE_PREFIX}_{start_date.date()}_{end_date.date()}_bal_injector_stream.json",
-        "w",
-    ) as _f:
-        json.dump(output_data, _f, indent=2)
-    print(f"{total_amount} $ARB transferred for balancer injector")
-    return output_data
+    Take tx template and inject `pct_of_distribution` of each gauge's distroToBalancer into it, split
+    evenly over `num_periods`. Returns the payload
+    """
+    records = [
+        (
+            gauge["recipientGaugeAddr"],
+            to_wei(Decimal(gauge["distroToBalancer"]) * Decimal(pct_of_distribution))
+            // num_periods,
+        )
+        for gauge in tokens_gauge_distributions.values()
+    ]
+    path = _default_path(start_date, end_date, "bal_injector_stream.json")
+    save_bal_injector_payload(records, num_periods, path)
+    return _read_payload(path)
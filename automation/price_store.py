@@ -0,0 +1,188 @@
+import os
+import threading
+from typing import Dict
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+import numpy as np
+
+from automation.cache import get_cache_dir
+from automation.cassette import now as cassette_now
+
+PRICE_STORE_SUBDIR = "prices"
+# The price API serves at most one year of history back from now
+MAX_HISTORY_SECONDS = 365 * 24 * 60 * 60
+# Prices are daily points, a series fetched within the last hour is treated as up to date
+PRICE_REFRESH_SECONDS = 60 * 60
+
+
+class PriceSeries:
+    """
+    Price history of one token as sorted, de-duplicated columns, plus the time span that has been fetched
+    """
+
+    __slots__ = ("timestamps", "prices", "fetched_from", "fetched_until")
+
+    def __init__(
+        self,
+        timestamps: np.ndarray,
+        prices: np.ndarray,
+        fetched_from: int,
+        fetched_until: int,
+    ):
+        self.timestamps = timestamps
+        self.prices = prices
+        self.fetched_from = fetched_from
+        self.fetched_until = fetched_until
+
+
+class PriceStore:
+    """
+    Append-only local store of token price series, one .npz file of numpy columns per (chain, token).
+    Tracks which span of history has been fetched, so callers only need to fetch what is missing, and
+    computes TWAPs with binary search over the sorted timestamps
+    """
+
+    def __init__(self, root: Optional[str] = None):
+        self.root = root or os.path.join(get_cache_dir(), PRICE_STORE_SUBDIR)
+        self._series: Dict[Tuple[str, str], Optional[PriceSeries]] = {}
+        self._lock = threading.Lock()
+        # Held for a whole read-merge-write, so concurrent appends never drop each other's points
+        self._write_lock = threading.Lock()
+
+    def _path(self, chain: str, token_addr: str) -> str:
+        return os.path.join(self.root, chain, f"{token_addr.lower()}.npz")
+
+    def get(self, chain: str, token_addr: str) -> Optional[PriceSeries]:
+        key = (chain, token_addr.lower())
+        with self._lock:
+            if key not in self._series:
+                path = self._path(chain, token_addr)
+                if os.path.exists(path):
+                    with np.load(path) as data:
+                        self._series[key] = PriceSeries(
+                            data["timestamps"],
+                            data["prices"],
+                            int(data["fetched_from"]),
+                            int(data["fetched_until"]),
+                        )
+                else:
+                    self._series[key] = None
+            return self._series[key]
+
+    def missing_since(
+        self, chain: str, token_addr: str, window_from: int, window_to: int
+    ) -> Optional[int]:
+        """
+        Oldest timestamp that has to be fetched to cover [window_from, window_to], or None when the store
+        already covers it
+        """
+        now = cassette_now()
+        window_from = max(window_from, now - MAX_HISTORY_SECONDS)
+        window_to = min(window_to, now)
+        series = self.get(chain, token_addr)
+        if series is None or window_from < series.fetched_from:
+            return window_from
+        if window_to > series.fetched_until + PRICE_REFRESH_SECONDS:
+            return series.fetched_until
+        return None
+
+    def append(
+        self,
+        chain: str,
+        token_addr: str,
+        timestamps: Sequence[int],
+        prices: Sequence[float],
+        fetched_from: int,
+        fetched_until: int,
+    ) -> None:
+        """
+        Merge freshly fetched points into the stored series, newer values win on equal timestamps. The file
+        is replaced atomically, readers see either the old or the merged series
+        """
+        with self._write_lock:
+            self._append(
+                chain, token_addr, timestamps, prices, fetched_from, fetched_until
+            )
+
+    def _append(
+        self,
+        chain: str,
+        token_addr: str,
+        timestamps: Sequence[int],
+        prices: Sequence[float],
+        fetched_from: int,
+        fetched_until: int,
+    ) -> None:
+        series = self.get(chain, token_addr)
+        new_timestamps = np.asarray(timestamps, dtype=np.int64)
+        new_prices = np.asarray(prices, dtype=np.float64)
+        if series is not None:
+            # Newer points go first so np.unique keeps them on duplicate timestamps
+            new_timestamps = np.concatenate([new_timestamps, series.timestamps])
+            new_prices = np.concatenate([new_prices, series.prices])
+            fetched_from = min(fetched_from, series.fetched_from)
+            fetched_until = max(fetched_until, series.fetched_until)
+        new_timestamps, first_index = np.unique(new_timestamps, return_index=True)
+        merged = PriceSeries(
+            new_timestamps, new_prices[first_index], fetched_from, fetched_until
+        )
+        path = self._path(chain, token_addr)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            timestamps=merged.timestamps,
+            prices=merged.prices,
+            fetched_from=fetched_from,
+            fetched_until=fetched_until,
+        )
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._series[(chain, token_addr.lower())] = merged
+
+    def twaps(
+        self,
+        chain: str,
+        token_addr: str,
+        windows_from: Sequence[int],
+        windows_to: Sequence[int],
+    ) -> np.ndarray:
+        """
+        Average price over each [window_from, window_to] window (inclusive), NaN where a window holds no
+        points. All windows are answered with two searchsorted calls over a cumulative sum
+        """
+        windows_from = np.asarray(windows_from, dtype=np.int64)
+        series = self.get(chain, token_addr)
+        if series is None:
+            return np.full(windows_from.shape, np.nan)
+        cumulative = np.concatenate([[0.0], np.cumsum(series.prices)])
+        lo = np.searchsorted(series.timestamps, windows_from, side="left")
+        hi = np.searchsorted(
+            series.timestamps, np.asarray(windows_to, dtype=np.int64), side="right"
+        )
+        counts = hi - lo
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(
+                counts > 0, (cumulative[hi] - cumulative[lo]) / counts, np.nan
+            )
+
+    def twap(
+        self, chain: str, token_addr: str, window_from: int, window_to: int
+    ) -> Optional[float]:
+        twap = self.twaps(chain, token_addr, [window_from], [window_to])[0]
+        return None if np.isnan(twap) else float(twap)
+
+
+_price_store = None
+_price_store_lock = threading.Lock()
+
+
+def get_price_store() -> PriceStore:
+    global _price_store
+    with _price_store_lock:
+        root = os.path.join(get_cache_dir(), PRICE_STORE_SUBDIR)
+        if _price_store is None or _price_store.root != root:
+            _price_store = PriceStore(root)
+        return _price_store
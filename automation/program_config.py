@@ -0,0 +1,79 @@
+import importlib
+from dataclasses import dataclass
+from typing import Dict
+from typing import List
+from typing import Optional
+
+
+@dataclass
+class ProgramConfig:
+    """
+    Everything that defines one incentive program: the chain, the token budget, the boost/cap rules and the
+    per pool overrides from its pool config module
+    """
+
+    file_prefix: str
+    chain_name: str
+    total_tokens_per_epoch: float
+    fixed_incentive_tokens_per_epoch: float
+    dynamic_boost_cap: float
+    min_bal_in_usd_for_boost: float
+    desired_default_vote_cap: float
+    boost_data: Dict[str, float]
+    cap_override_data: Dict[str, float]
+    fixed_emissions_per_pool: Dict[str, float]
+
+    @property
+    def tokens_to_follow_voting(self) -> float:
+        return self.total_tokens_per_epoch - self.fixed_incentive_tokens_per_epoch
+
+    @property
+    def whitelist(self) -> List[str]:
+        return [pool_id.lower() for pool_id in self.fixed_emissions_per_pool.keys()]
+
+    @property
+    def default_vote_cap(self) -> float:
+        # Make sure we have enough capacity to distribute all our votes.
+        # There is still an edge case here when some pools are capped under the final default cap and hence
+        # there is not capacity to distribute 100% of tokens
+        return max(self.desired_default_vote_cap, 100 / len(self.whitelist))
+
+    @classmethod
+    def from_module(cls, file_prefix: str) -> "ProgramConfig":
+        """
+        Build the config from automation/<file_prefix>.py. Program level settings (CHAIN_NAME,
+        TOTAL_TOKENS_PER_EPOCH, ...) defined in that module take precedence over the ones in constants.py,
+        so several programs can be configured side by side
+        """
+        # constants.py is the user's own copy of the example, and older copies import web3. It is only
+        # imported once a config is loaded, so it never slows down starting up
+        from automation import constants
+
+        pool_config = importlib.import_module(f"automation.{file_prefix}")
+
+        def _setting(name: str):
+            return getattr(pool_config, name, getattr(constants, name))
+
+        return cls(
+            file_prefix=file_prefix,
+            chain_name=_setting("CHAIN_NAME"),
+            total_tokens_per_epoch=_setting("TOTAL_TOKENS_PER_EPOCH"),
+            fixed_incentive_tokens_per_epoch=_setting(
+                "FIXED_INCENTIVE_TOKENS_PER_EPOCH"
+            ),
+            dynamic_boost_cap=_setting("DYNAMIC_BOOST_CAP"),
+            min_bal_in_usd_for_boost=_setting("MIN_BAL_IN_USD_FOR_BOOST"),
+            desired_default_vote_cap=_setting("DESIRED_DEFAULT_VOTE_CAP"),
+            boost_data=pool_config.boost_data,
+            cap_override_data=pool_config.cap_override_data,
+            fixed_emissions_per_pool=pool_config.fixed_emissions_per_pool,
+        )
+
+
+def load_program_config(file_prefix: Optional[str] = None) -> ProgramConfig:
+    """
+    Load a program config, by default the one selected by FILE_PREFIX in constants.py
+    """
+    from automation import constants
+
+    return ProgramConfig.from_module(file_prefix or constants.FILE_PREFIX)
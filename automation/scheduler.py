@@ -0,0 +1,214 @@
+import random
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+from urllib.parse import urlparse
+
+import requests
+
+from automation.metrics import record_retry
+
+# Responses worth retrying: throttling and the errors overloaded nodes, gateways and subgraphs answer with
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUS = 429
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+# Retry-After values above this are not waited for, the request fails instead
+RETRY_AFTER_MAX_SECONDS = 120.0
+
+
+@dataclass(frozen=True)
+class HostLimits:
+    """
+    Request budget of one host: a token bucket refilled at `rate` requests per second holding up to `burst`
+    tokens, and at most `max_concurrency` requests in flight
+    """
+
+    rate: float
+    burst: int
+    max_concurrency: int
+
+
+DEFAULT_LIMITS = HostLimits(rate=50.0, burst=100, max_concurrency=16)
+# Hosts known to throttle well below the default
+HOST_LIMITS: Dict[str, HostLimits] = {
+    # The public CoinGecko API allows a few dozen requests a minute
+    "api.coingecko.com": HostLimits(rate=0.5, burst=5, max_concurrency=1),
+    "api.thegraph.com": HostLimits(rate=10.0, burst=20, max_concurrency=8),
+    "gateway.thegraph.com": HostLimits(rate=10.0, burst=20, max_concurrency=8),
+    "gateway-arbitrum.network.thegraph.com": HostLimits(
+        rate=10.0, burst=20, max_concurrency=8
+    ),
+}
+
+
+class HostBudget:
+    """
+    Adaptive token bucket and concurrency limit of one host. Every 429 halves the refill rate, every
+    success wins back a twentieth of the configured rate, so the rate settles just under what the host
+    accepts. A Retry-After pauses all requests to the host, not just the one that got it
+    """
+
+    def __init__(self, limits: HostLimits):
+        self.limits = limits
+        self.rate = limits.rate
+        self.tokens = float(limits.burst)
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(limits.max_concurrency)
+
+    def _wait_time(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(
+            self.limits.burst, self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> None:
+        """
+        Block until the host's budget allows another request
+        """
+        while True:
+            with self._lock:
+                wait = self._wait_time()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def throttled(self, retry_after: Optional[float]) -> None:
+        with self._lock:
+            self.rate = max(self.limits.rate / 64, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+        if retry_after is not None:
+            self.pause(retry_after)
+
+    def succeeded(self) -> None:
+        if self.rate < self.limits.rate:
+            with self._lock:
+                self.rate = min(self.limits.rate, self.rate + self.limits.rate / 20)
+
+
+def _retry_after_seconds(response: requests.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _classify(error: BaseException) -> Tuple[bool, Optional[requests.Response]]:
+    """
+    Whether a failed request is worth retrying, and the HTTP response it failed with if any. web3 raises the
+    requests errors as they are, gql and pycoingecko wrap them, so the whole exception chain is searched
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            return error.response.status_code in RETRY_STATUSES, error.response
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return True, None
+        error = error.__cause__ or error.__context__
+    return False, None
+
+
+class RequestScheduler:
+    """
+    Runs every outside request of the process under its host's budget, retrying throttled and failed
+    requests with jittered exponential backoff or after the Retry-After the host asked for
+    """
+
+    def __init__(self, max_retries: int = MAX_RETRIES):
+        self.max_retries = max_retries
+        self._hosts: Dict[str, HostBudget] = {}
+        self._limits: Dict[str, HostLimits] = dict(HOST_LIMITS)
+        self._lock = threading.Lock()
+
+    def set_limits(self, host: str, limits: HostLimits) -> None:
+        with self._lock:
+            self._limits[host] = limits
+            self._hosts.pop(host, None)
+
+    def budget(self, host: str) -> HostBudget:
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostBudget(self._limits.get(host, DEFAULT_LIMITS))
+            return self._hosts[host]
+
+    def call(self, url: str, kind: str, fetch: Callable[[], Any]) -> Any:
+        """
+        Run `fetch`, a request to `url`, once the host's budget allows it. Requests that fail with a
+        retryable status or a connection error are retried up to max_retries times, anything else is
+        raised right away. Retries are counted in the run metrics under `kind`
+        """
+        budget = self.budget(urlparse(url).hostname or url)
+        attempt = 0
+        while True:
+            budget.acquire()
+            try:
+                with budget.slots:
+                    result = fetch()
+            except Exception as e:
+                retryable, response = _classify(e)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                retry_after = None
+                if response is not None:
+                    retry_after = _retry_after_seconds(response)
+                    if (
+                        retry_after is not None
+                        and retry_after > RETRY_AFTER_MAX_SECONDS
+                    ):
+                        raise
+                    if response.status_code == THROTTLE_STATUS:
+                        budget.throttled(retry_after)
+                    elif retry_after is not None:
+                        budget.pause(retry_after)
+                # Full jitter, so clients throttled at the same time don't all come back at once
+                delay = random.uniform(
+                    0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt)
+                )
+                time.sleep(delay + (retry_after or 0.0))
+                attempt += 1
+                record_retry(kind)
+                continue
+            budget.succeeded()
+            return result
+
+
+_scheduler = RequestScheduler()
+
+
+def get_scheduler() -> RequestScheduler:
+    return _scheduler
+
+
+def scheduled(url: str, kind: str, fetch: Callable[[], Any]) -> Any:
+    """
+    Run the request `fetch` to `url` through the process wide scheduler
+    """
+    return _scheduler.call(url, kind, fetch)
@@ -0,0 +1,340 @@
+"""
+What-if simulator for the program parameters: captures the fetched inputs of one epoch, then evaluates any
+number of combinations of DYNAMIC_BOOST_CAP, DESIRED_DEFAULT_VOTE_CAP, MIN_BAL_IN_USD_FOR_BOOST and per
+pool fixedBoost, capOverride and fixedEmissions at once, without touching the network.
+
+    python -m automation.simulator capture --ts_bound 1718143200 --program example_op_config --inputs inputs.json
+    python -m automation.simulator run --inputs inputs.json --grid grid.json --output scenarios.npz
+"""
+import argparse
+import itertools
+import json
+import time
+from dataclasses import asdict
+from datetime import datetime
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+
+from automation.lstGrant import EpochInputs
+from automation.program_config import ProgramConfig
+
+SCALAR_PARAMETERS = (
+    "dynamic_boost_cap",
+    "desired_default_vote_cap",
+    "min_bal_in_usd_for_boost",
+)
+# Per pool parameters, keyed by pool id like the pool config overrides they stand in for
+POOL_PARAMETERS = ("fixed_boost", "cap_override", "fixed_emissions")
+
+ParameterValues = Union[float, List[float], np.ndarray]
+
+
+def save_epoch_inputs(
+    path: str, config: ProgramConfig, end_date: int, inputs: EpochInputs
+) -> None:
+    with open(path, "w") as f:
+        json.dump(
+            {"config": asdict(config), "endDate": end_date, "inputs": asdict(inputs)},
+            f,
+        )
+
+
+def load_epoch_inputs(path: str) -> Tuple[ProgramConfig, int, EpochInputs]:
+    with open(path) as f:
+        data = json.load(f)
+    return (
+        ProgramConfig(**data["config"]),
+        data["endDate"],
+        EpochInputs(**data["inputs"]),
+    )
+
+
+def batch_water_fill(
+    amounts: np.ndarray,
+    caps: np.ndarray,
+    weights: np.ndarray,
+    to_distribute: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    allocation.water_fill_wei for a batch of scenarios at once, in floats: every row of `amounts` gets
+    its `to_distribute` on top, proportionally to `weights` and never past `caps`. Returns the new
+    amounts and the leftover of every row that could not be placed
+    """
+    headrooms = np.maximum(caps - amounts, 0.0)
+    eligible = (weights > 0) & (headrooms > 0)
+    safe_weights = np.where(eligible, weights, 1.0)
+    saturation = np.where(eligible, headrooms / safe_weights, np.inf)
+    # Per row, entries in the order they fill up. Ineligible ones sort last and add nothing
+    order = np.argsort(saturation, axis=1)
+    sorted_headrooms = np.take_along_axis(np.where(eligible, headrooms, 0.0), order, 1)
+    sorted_weights = np.take_along_axis(np.where(eligible, weights, 0.0), order, 1)
+    sorted_eligible = np.take_along_axis(eligible, order, 1)
+    sorted_saturation = np.where(
+        sorted_eligible, np.take_along_axis(saturation, order, 1), 0.0
+    )
+    filled_before = np.cumsum(sorted_headrooms, axis=1) - sorted_headrooms
+    active_weights = np.cumsum(sorted_weights[:, ::-1], axis=1)[:, ::-1]
+    settles = sorted_eligible & (
+        filled_before + sorted_saturation * active_weights >= to_distribute[:, None]
+    )
+    has_level = settles.any(axis=1)
+    position = np.argmax(settles, axis=1)
+    rows = np.arange(len(amounts))
+    level = np.where(
+        has_level,
+        (to_distribute - filled_before[rows, position])
+        / np.where(has_level, active_weights[rows, position], 1.0),
+        np.inf,
+    )
+    level = np.where(to_distribute > 0, level, 0.0)
+    added = np.where(eligible, np.minimum(level[:, None] * safe_weights, headrooms), 0)
+    leftover = np.where(
+        has_level | (to_distribute <= 0), 0.0, to_distribute - added.sum(axis=1)
+    )
+    return amounts + added, leftover
+
+
+class EpochSimulator:
+    """
+    One program epoch's inputs, ready to be allocated under many parameter sets at once. Scenarios are rows
+    and gauges are columns of every array. Allocation follows calculate_gauge_distributions in float64,
+    so results match the pipeline's to within float precision rather than to the wei
+    """
+
+    def __init__(self, config: ProgramConfig, inputs: EpochInputs):
+        self.config = config
+        self.inputs = inputs
+        self.gauges = list(inputs.gauges.keys())
+        self.pool_ids = [inputs.gauges[addr]["id"] for addr in self.gauges]
+        self.weights = np.array(
+            [inputs.gauge_weights[addr] / 1e18 * 100 for addr in self.gauges]
+        )
+        self.fees = np.array(
+            [
+                inputs.pool_fees.get(inputs.gauges[addr]["pool"].lower(), 0.0)
+                for addr in self.gauges
+            ]
+        )
+        self.usd_emitted = (
+            self.weights / 100 * inputs.emissions_per_week * inputs.bal_token_price
+        )
+
+    def _scalar(self, values: Optional[ParameterValues], default: float) -> np.ndarray:
+        return np.atleast_1d(np.asarray(default if values is None else values, float))
+
+    def _per_pool(
+        self,
+        values: Optional[Dict[str, ParameterValues]],
+        defaults: Dict[str, float],
+        fallback: float,
+    ) -> np.ndarray:
+        """
+        (scenarios, gauges) array of a per pool parameter: `values` where given, else the config's value
+        """
+        values = values or {}
+        columns = []
+        for pool_id in self.pool_ids:
+            if pool_id in values:
+                columns.append(np.atleast_1d(np.asarray(values[pool_id], float)))
+            else:
+                columns.append(np.atleast_1d(float(defaults.get(pool_id, fallback))))
+        if not columns:
+            return np.zeros((1, 0))
+        return np.stack(np.broadcast_arrays(*columns), axis=-1)
+
+    def run(
+        self,
+        dynamic_boost_cap: Optional[ParameterValues] = None,
+        desired_default_vote_cap: Optional[ParameterValues] = None,
+        min_bal_in_usd_for_boost: Optional[ParameterValues] = None,
+        fixed_boost: Optional[Dict[str, ParameterValues]] = None,
+        cap_override: Optional[Dict[str, ParameterValues]] = None,
+        fixed_emissions: Optional[Dict[str, ParameterValues]] = None,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Allocate the epoch for every scenario. Every parameter is either left out, to use the config's
+        value, a single value, or one value per scenario. The per pool ones map pool ids to such values.
+        Returns (scenarios, gauges) arrays of the dynamic boosts, the boosts and the distributions, and
+        the undistributed tokens of every scenario
+        """
+        config = self.config
+        boost_cap = self._scalar(dynamic_boost_cap, config.dynamic_boost_cap)
+        default_cap = self._scalar(
+            desired_default_vote_cap, config.desired_default_vote_cap
+        )
+        min_usd = self._scalar(
+            min_bal_in_usd_for_boost, config.min_bal_in_usd_for_boost
+        )
+        static_boosts = self._per_pool(fixed_boost, config.boost_data, 1)
+        cap_pcts = self._per_pool(cap_override, {}, np.nan)
+        fixed = self._per_pool(fixed_emissions, config.fixed_emissions_per_pool, 0)
+        boost_cap, default_cap, min_usd = (
+            values[:, None]
+            for values in np.broadcast_arrays(boost_cap, default_cap, min_usd)
+        )
+        # Cap overrides given in the config apply where the sweep doesn't set one
+        config_caps = np.array(
+            [
+                config.cap_override_data.get(pool_id.lower(), np.nan)
+                for pool_id in self.pool_ids
+            ]
+        )
+        cap_pcts = np.where(np.isnan(cap_pcts), config_caps, cap_pcts)
+        (
+            boost_cap,
+            default_cap,
+            min_usd,
+            static_boosts,
+            cap_pcts,
+            fixed,
+        ) = np.broadcast_arrays(
+            boost_cap, default_cap, min_usd, static_boosts, cap_pcts, fixed
+        )
+
+        # Dynamic boost: fees over the USD value of the BAL emitted to the gauge, capped and at least 1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            raw_boosts = np.where(
+                self.usd_emitted > 0, self.fees / self.usd_emitted, 0.0
+            )
+        boosted = (self.usd_emitted >= min_usd) & (self.usd_emitted > 1)
+        dynamic_boosts = np.where(
+            boosted, np.maximum(np.minimum(raw_boosts, boost_cap), 1.0), 1.0
+        )
+        boosts = dynamic_boosts + static_boosts - 1
+        vote_weights = self.weights * boosts
+
+        total_tokens = config.total_tokens_per_epoch
+        # Same as ProgramConfig.default_vote_cap, per scenario
+        default_cap = np.maximum(default_cap, 100 / len(config.whitelist))
+        caps = np.where(np.isnan(cap_pcts), default_cap, cap_pcts) / 100 * total_tokens
+        total_weights = vote_weights.sum(axis=1, keepdims=True)
+        distributions = np.minimum(
+            config.tokens_to_follow_voting
+            * vote_weights
+            / np.where(total_weights > 0, total_weights, 1.0)
+            + fixed,
+            caps,
+        )
+        distributions, leftover = batch_water_fill(
+            distributions,
+            caps,
+            vote_weights,
+            total_tokens - distributions.sum(axis=1),
+        )
+        return {
+            "dynamicBoosts": dynamic_boosts,
+            "boosts": boosts,
+            "distributions": distributions,
+            "undistributed": leftover,
+        }
+
+
+def expand_grid(grid: Dict) -> Dict:
+    """
+    Every combination of the values listed in `grid`, as one value per scenario for each parameter.
+    Scalar parameters map to lists of values, per pool parameters to {pool id: list of values}
+    """
+    axes = []
+    for name in SCALAR_PARAMETERS:
+        if name in grid:
+            axes.append(((name, None), grid[name]))
+    for name in POOL_PARAMETERS:
+        for pool_id, values in grid.get(name, {}).items():
+            axes.append(((name, pool_id), values))
+    unknown = set(grid) - set(SCALAR_PARAMETERS) - set(POOL_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown parameters in grid: {', '.join(sorted(unknown))}")
+    combinations = np.array(list(itertools.product(*(values for _, values in axes))))
+    parameters = {}
+    for column, ((name, pool_id), _) in enumerate(axes):
+        if pool_id is None:
+            parameters[name] = combinations[:, column]
+        else:
+            parameters.setdefault(name, {})[pool_id] = combinations[:, column]
+    return parameters
+
+
+def _capture(args: argparse.Namespace) -> None:
+    from automation.lstGrant import fetch_epoch_inputs
+    from automation.program_config import load_program_config
+
+    config = load_program_config(args.program)
+    inputs = fetch_epoch_inputs(args.ts_bound, config)
+    save_epoch_inputs(args.inputs, config, args.ts_bound, inputs)
+    print(f"Inputs of {len(inputs.gauges)} gauges saved to {args.inputs}")
+
+
+def _run(args: argparse.Namespace) -> None:
+    config, end_date, inputs = load_epoch_inputs(args.inputs)
+    with open(args.grid) as f:
+        parameters = expand_grid(json.load(f))
+    simulator = EpochSimulator(config, inputs)
+    started = time.perf_counter()
+    results = simulator.run(**parameters)
+    distributions = results["distributions"]
+    print(
+        f"{len(distributions)} scenarios of {len(simulator.gauges)} gauges for the epoch ending "
+        f"{datetime.fromtimestamp(end_date).date()} in {time.perf_counter() - started:.2f}s"
+    )
+    flat_parameters = {}
+    for name, values in parameters.items():
+        if isinstance(values, dict):
+            for pool_id, pool_values in values.items():
+                flat_parameters[f"{name}:{pool_id}"] = pool_values
+        else:
+            flat_parameters[name] = values
+    np.savez_compressed(
+        args.output,
+        gauges=np.array(simulator.gauges),
+        poolIds=np.array(simulator.pool_ids),
+        **results,
+        **flat_parameters,
+    )
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    capture = commands.add_parser(
+        "capture", help="Fetch the inputs of an epoch and save them for simulation"
+    )
+    capture.add_argument(
+        "--ts_bound", help="Timestamp the epoch ends at", type=int, required=True
+    )
+    capture.add_argument(
+        "--program",
+        help="Pool config file prefix, defaults to FILE_PREFIX in constants.py",
+        type=str,
+        required=False,
+    )
+    capture.add_argument(
+        "--inputs", help="File to save the inputs to", type=str, required=True
+    )
+    run = commands.add_parser(
+        "run", help="Allocate saved epoch inputs under every combination of a grid"
+    )
+    run.add_argument(
+        "--inputs", help="Inputs saved by capture", type=str, required=True
+    )
+    run.add_argument(
+        "--grid",
+        help='JSON file of the values to combine, e.g. {"dynamic_boost_cap": [2, 3], "cap_override": {"<pool id>": [5, 10]}}',
+        type=str,
+        required=True,
+    )
+    run.add_argument(
+        "--output", help="Results file (.npz)", type=str, default="scenarios.npz"
+    )
+    args = parser.parse_args()
+    if args.command == "capture":
+        _capture(args)
+    else:
+        _run(args)
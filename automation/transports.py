@@ -0,0 +1,393 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Union
+
+from gql.transport.requests import RequestsHTTPTransport
+from requests.adapters import HTTPAdapter
+from gql.transport.transport import Transport
+from graphql import ExecutionResult
+from graphql import print_ast
+from pycoingecko import CoinGeckoAPI
+from web3 import Web3
+from web3.middleware import construct_simple_cache_middleware
+from web3.types import RPCEndpoint
+from web3.types import RPCResponse
+
+from automation.cassette import cassette_call
+from automation.cassette import get_cassette
+from automation.metrics import instrument_session
+from automation.metrics import propagate
+from automation.metrics import record_failure
+from automation.metrics import response_hook
+from automation.scheduler import scheduled
+
+
+def _without_retries(provider: Web3.HTTPProvider) -> Web3.HTTPProvider:
+    # web3 retries failed requests in a provider middleware of its own, with a flat sleep. Retries are left
+    # to the request scheduler, so a request is never tried more than its policy allows
+    provider.middlewares = ()
+    return provider
+
+
+class CassetteHTTPProvider(Web3.HTTPProvider):
+    """
+    HTTP JSON-RPC provider whose requests go through the active cassette, if any. Requests are keyed by
+    chain rather than node url, so node urls with API keys never end up in a cassette
+    """
+
+    def __init__(self, endpoint_uri: Optional[str], chain: str, **kwargs):
+        super().__init__(endpoint_uri, **kwargs)
+        _without_retries(self)
+        self.chain = chain
+
+    def _make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        make_request = super().make_request
+        try:
+            return scheduled(
+                self.endpoint_uri, "rpc", lambda: make_request(method, params)
+            )
+        except Exception:
+            record_failure("rpc")
+            raise
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        return cassette_call(
+            "jsonrpc",
+            {"chain": self.chain, "method": method, "params": params},
+            lambda: self._make_request(method, params),
+        )
+
+
+# Position of the block parameter of the JSON-RPC methods that read state at a given block
+BLOCK_PARAM_INDEX = {
+    "eth_getBlockByNumber": 0,
+    "eth_call": 1,
+    "eth_getBalance": 1,
+    "eth_getCode": 1,
+    "eth_getTransactionCount": 1,
+    "eth_getStorageAt": 2,
+}
+# Errors of nodes that don't have the state of the requested block, yet or anymore. Another node may have it
+MISSING_STATE_ERRORS = ("header not found", "missing trie node", "unknown block")
+# Latency samples kept per endpoint, and how many are needed before its p95 is trusted as the hedge delay
+LATENCY_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+DEFAULT_HEDGE_DELAY_SECONDS = 1.0
+HEAD_BLOCK_TTL_SECONDS = 12.0
+UNHEALTHY_COOLDOWN_SECONDS = 30.0
+HEDGE_WORKERS_PER_ENDPOINT = 8
+
+
+def _pinned_block(method: str, params: Any) -> Optional[int]:
+    index = BLOCK_PARAM_INDEX.get(method)
+    if index is None or not isinstance(params, (list, tuple)) or len(params) <= index:
+        return None
+    block = params[index]
+    if isinstance(block, int):
+        return block
+    if isinstance(block, str) and block.startswith("0x"):
+        return int(block, 16)
+    # latest, pending, safe, finalized or a block hash
+    return None
+
+
+def _missing_state(response: RPCResponse) -> bool:
+    error = response.get("error") if isinstance(response, dict) else None
+    message = str(error.get("message", "")).lower() if isinstance(error, dict) else ""
+    return any(text in message for text in MISSING_STATE_ERRORS)
+
+
+class RpcEndpoint:
+    """
+    One node of a chain with multiple RPC urls: its recent latencies, the last head block it reported and
+    whether it failed recently
+    """
+
+    def __init__(self, url: str, request_kwargs: Optional[Dict] = None):
+        self.url = url
+        self.provider = _without_retries(
+            Web3.HTTPProvider(url, request_kwargs=request_kwargs)
+        )
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.head_block: Optional[int] = None
+        self.head_checked_at = 0.0
+        self.unhealthy_until = 0.0
+        self._lock = threading.Lock()
+
+    def request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        started = time.perf_counter()
+        try:
+            response = scheduled(
+                self.url, "rpc", lambda: self.provider.make_request(method, params)
+            )
+        except Exception:
+            self.unhealthy_until = time.monotonic() + UNHEALTHY_COOLDOWN_SECONDS
+            raise
+        self.latencies.append(time.perf_counter() - started)
+        return response
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def p95(self) -> Optional[float]:
+        """
+        95th percentile of the recent latencies in seconds, None until there are enough of them
+        """
+        latencies = sorted(self.latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def expected_latency(self) -> float:
+        """
+        p95 latency once known, the mean of the few samples there are before that, 0 for an unused endpoint
+        """
+        p95 = self.p95()
+        if p95 is not None:
+            return p95
+        latencies = list(self.latencies)
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    def synced_to(self, block: int) -> bool:
+        """
+        Whether the node has `block`. Its head block is asked for again at most every HEAD_BLOCK_TTL_SECONDS
+        while it is behind
+        """
+        with self._lock:
+            if self.head_block is not None and self.head_block >= block:
+                return True
+            if time.monotonic() - self.head_checked_at < HEAD_BLOCK_TTL_SECONDS:
+                return False
+            # Claim the check, so concurrent requests don't all ask the node at once
+            self.head_checked_at = time.monotonic()
+        try:
+            response = self.request(RPCEndpoint("eth_blockNumber"), [])
+            head_block = int(response["result"], 16)
+        except Exception as e:
+            print(f"WARNING: Could not get the head block of {self.url}: {e!r}")
+            return False
+        with self._lock:
+            self.head_block = max(self.head_block or 0, head_block)
+            return self.head_block >= block
+
+
+class HedgedHTTPProvider(CassetteHTTPProvider):
+    """
+    JSON-RPC provider spreading requests over several nodes of the same chain. Each request goes to the
+    healthy node with the lowest p95 latency, and is sent again to the next one if no answer came within
+    that p95, the first answer wins. Requests pinned to a block only go to nodes whose head has reached it.
+    Failed nodes are skipped for a while, and requests they fail are sent to the next node right away
+    """
+
+    def __init__(
+        self,
+        endpoint_uris: Sequence[str],
+        chain: str,
+        request_kwargs: Optional[Dict] = None,
+    ):
+        super().__init__(endpoint_uris[0], chain, request_kwargs=request_kwargs)
+        self.endpoints = [RpcEndpoint(url, request_kwargs) for url in endpoint_uris]
+        self._executor = ThreadPoolExecutor(
+            max_workers=HEDGE_WORKERS_PER_ENDPOINT * len(self.endpoints),
+            thread_name_prefix=f"rpc-{chain}",
+        )
+
+    def _candidates(self, method: RPCEndpoint, params: Any) -> List[RpcEndpoint]:
+        endpoints = list(self.endpoints)
+        block = _pinned_block(method, params)
+        if block is not None:
+            # Sync comes first: a node that failed recently still beats one that doesn't have the block
+            endpoints = [
+                endpoint for endpoint in endpoints if endpoint.synced_to(block)
+            ]
+            if not endpoints:
+                raise ValueError(
+                    f"No {self.chain} RPC endpoint has synced block {block}"
+                )
+        endpoints = [
+            endpoint for endpoint in endpoints if endpoint.healthy()
+        ] or endpoints
+        # Unused endpoints go first, so every endpoint gets measured
+        return sorted(endpoints, key=lambda endpoint: endpoint.expected_latency())
+
+    def _make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        try:
+            candidates = self._candidates(method, params)
+        except Exception:
+            record_failure("rpc")
+            raise
+        # Transactions are sent once, everything else is a read that is safe to duplicate
+        hedge = not method.startswith("eth_send")
+        pending = {}
+        errors = []
+        missing_state_response = None
+
+        def _send_next() -> None:
+            endpoint = candidates.pop(0)
+            future = self._executor.submit(propagate(endpoint.request), method, params)
+            pending[future] = endpoint
+
+        _send_next()
+        while pending:
+            hedge_delay = None
+            if hedge and candidates:
+                hedge_delay = (
+                    list(pending.values())[-1].p95() or DEFAULT_HEDGE_DELAY_SECONDS
+                )
+            done, _ = wait(pending, timeout=hedge_delay, return_when=FIRST_COMPLETED)
+            failed = False
+            for future in done:
+                pending.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    failed = True
+                    continue
+                if _missing_state(response):
+                    missing_state_response = response
+                    failed = True
+                    continue
+                return response
+            if candidates and (failed or not done):
+                _send_next()
+        if missing_state_response is not None:
+            return missing_state_response
+        record_failure("rpc")
+        raise errors[-1]
+
+
+class CassetteTransport(Transport):
+    """
+    gql transport wrapper whose queries go through the active cassette, if any
+    """
+
+    def __init__(self, transport: Transport, url: str, headers: Optional[Dict]):
+        self.transport = transport
+        self.url = url
+        self.headers = headers or {}
+
+    def connect(self):
+        self.transport.connect()
+        session = getattr(self.transport, "session", None)
+        if session is not None:
+            instrument_session(session, "graphql")
+
+    def close(self):
+        self.transport.close()
+
+    def execute(self, request, *args, **kwargs) -> ExecutionResult:
+        if hasattr(request, "payload"):
+            payload = request.payload
+        else:
+            # gql < 4 passes the document and the variables separately
+            payload = {
+                "query": print_ast(request),
+                "variables": kwargs.get("variable_values"),
+                "operationName": kwargs.get("operation_name"),
+            }
+
+        def _execute() -> Dict:
+            try:
+                result = scheduled(
+                    self.url,
+                    "graphql",
+                    lambda: self.transport.execute(request, *args, **kwargs),
+                )
+            except Exception:
+                record_failure("graphql")
+                raise
+            return {
+                "data": result.data,
+                "errors": result.errors,
+                "extensions": result.extensions,
+            }
+
+        result = cassette_call(
+            "graphql",
+            {"url": self.url, "headers": self.headers, "payload": payload},
+            _execute,
+        )
+        return ExecutionResult(**result)
+
+
+def parse_rpc_urls(urls: Union[str, Sequence[str], None]) -> List[str]:
+    """
+    RPC urls from a comma separated string, like ETHNODEURL, or a list
+    """
+    if not urls:
+        return []
+    if isinstance(urls, str):
+        urls = urls.split(",")
+    return [url.strip() for url in urls if url.strip()]
+
+
+def make_web3(urls: Union[str, Sequence[str], None], chain: str) -> Web3:
+    """
+    Web3 instance for a chain's nodes, given as one url, a comma separated string of urls or a list. With
+    several urls requests are routed and hedged between them by HedgedHTTPProvider. The urls may be left
+    out when replaying a cassette
+    """
+    urls = parse_rpc_urls(urls)
+    cassette = get_cassette()
+    if not urls and (cassette is None or cassette.mode != "replay"):
+        raise ValueError(f"No RPC url configured for {chain}")
+    # Sessions are pooled per thread by web3, so responses are hooked per request instead
+    request_kwargs = {"hooks": {"response": [response_hook("rpc")]}}
+    if len(urls) > 1:
+        provider = HedgedHTTPProvider(urls, chain, request_kwargs=request_kwargs)
+    else:
+        provider = CassetteHTTPProvider(
+            urls[0] if urls else None, chain, request_kwargs=request_kwargs
+        )
+    web3 = Web3(provider)
+    # We only ever use hex addresses. Without an explicit value web3 builds a fresh ENS instance, with two
+    # contracts of its own, every time a contract object is created
+    web3.ens = None
+    # web3's validation middleware asks the node for its chain id before every eth_call. A node's chain id
+    # never changes, so it is fetched once per instance instead of once per call
+    web3.middleware_onion.add(
+        construct_simple_cache_middleware(rpc_whitelist={"eth_chainId"}),
+        name="chain_id_cache",
+    )
+    return web3
+
+
+def make_gql_transport(url: str, headers: Optional[Dict] = None) -> Transport:
+    """
+    gql transport for an endpoint. Retries are left to the request scheduler, like for every other request
+    """
+    return CassetteTransport(
+        RequestsHTTPTransport(url=url, headers=headers), url, headers
+    )
+
+
+def get_coingecko_price(ids: str, vs_currencies: str) -> Dict:
+    def _get_price() -> Dict:
+        cg = CoinGeckoAPI()
+        # pycoingecko mounts an adapter retrying on its own, the scheduler retries instead
+        for prefix in ("http://", "https://"):
+            cg.session.mount(prefix, HTTPAdapter(max_retries=0))
+        instrument_session(cg.session, "price_api")
+        try:
+            return scheduled(
+                cg.api_base_url,
+                "price_api",
+                lambda: cg.get_price(ids=ids, vs_currencies=vs_currencies),
+            )
+        except Exception:
+            record_failure("price_api")
+            raise
+
+    return cassette_call(
+        "coingecko", {"ids": ids, "vs_currencies": vs_currencies}, _get_price
+    )
@@ -0,0 +1,106 @@
+"""
+Startup time benchmark: how long the CLI and the pipeline modules take to import, measured with
+python -X importtime, against a time budget.
+
+Run from the repository root:
+    python -m benchmarks.importtime
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict
+from typing import List
+from typing import Set
+from typing import Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Commands measured, with the time budget each has to stay under
+TARGETS: Dict[str, Tuple[List[str], float]] = {
+    "main.py --help": (["main.py", "--help"], 300),
+    "import automation.helpers": (["-c", "import automation.helpers"], 250),
+    "import automation.lstGrant": (["-c", "import automation.lstGrant"], 250),
+}
+# Libraries that take up to seconds to import. They are only needed once a pipeline actually runs,
+# so none of them may be imported by the targets
+HEAVY_MODULES = (
+    "web3",
+    "pandas",
+    "gql",
+    "graphql",
+    "pycoingecko",
+    "bal_tools",
+    "bal_addresses",
+)
+
+
+def measure(args: List[str]) -> Tuple[float, Dict[str, float], Set[str]]:
+    """
+    Run python -X importtime with `args`. Returns the total import time in ms, the import time in ms of
+    every package outside automation including what it imports itself, and the names of all packages
+    imported
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total_us = 0
+    packages = {}
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        total_us += int(self_us)
+        package = name.strip().split(".")[0]
+        imported.add(package)
+        if package != "automation":
+            packages[package] = max(packages.get(package, 0), int(cumulative_us) / 1000)
+    return total_us / 1000, packages, imported
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--runs",
+        help="Runs per target, the fastest one counts",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--top", help="Slowest packages to show per target", type=int, default=5
+    )
+    args = parser.parse_args()
+    if not os.path.exists(os.path.join(REPO_ROOT, "automation", "constants.py")):
+        sys.exit(
+            "automation/constants.py is missing, copy automation/constants.py.example to create it"
+        )
+
+    failures = []
+    for name, (target_args, budget_ms) in TARGETS.items():
+        runs = [measure(target_args) for _ in range(args.runs)]
+        total_ms, packages, imported = min(runs, key=lambda run: run[0])
+        print(f"\n{name}: {total_ms:.1f} ms (budget {budget_ms} ms)")
+        for package, cumulative_ms in sorted(
+            packages.items(), key=lambda item: -item[1]
+        )[: args.top]:
+            print(f"  {package:<40} {cumulative_ms:>8.1f} ms")
+        if total_ms > budget_ms:
+            failures.append(f"{name} took {total_ms:.1f} ms, budget {budget_ms} ms")
+        heavy = sorted(set(HEAVY_MODULES) & imported)
+        if heavy:
+            failures.append(f"{name} imports {', '.join(heavy)}")
+
+    if failures:
+        print("\nStartup regressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("\nAll targets within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+import bisect
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from eth_abi import decode
+from eth_abi import encode
+from graphql import build_schema
+from graphql import OperationDefinitionNode
+from graphql import graphql_sync
+from graphql import parse
+from web3 import Web3
+
+from automation.multicall import MULTICALL3_ADDRESS
+
+BLOCK_TIME_SECONDS = 12
+GENESIS_TIMESTAMP = 1_500_000_000
+DAY_SECONDS = 24 * 60 * 60
+
+
+def _selector(signature: str) -> bytes:
+    return bytes(Web3.keccak(text=signature)[:4])
+
+
+def _address(index: int, prefix: str) -> str:
+    return Web3.to_checksum_address(f"0x{prefix}{index:038x}")
+
+
+class MockWorld:
+    """
+    Synthetic chain state shared by the mock servers: pools with tokens, balances, gauges, gauge weights
+    and fee snapshots. Everything is derived from `seed`, so runs with the same sizes see the same data
+    """
+
+    def __init__(
+        self,
+        chain: str,
+        epoch_end: int,
+        n_gauges: int,
+        n_pools: int,
+        snapshots_per_pool: int,
+        tokens_per_pool: int,
+        seed: int = 1,
+    ):
+        rnd = random.Random(seed)
+        self.chain = chain
+        self.epoch_end = epoch_end
+        self.snapshots_per_pool = snapshots_per_pool
+        # The head is always "now", so lookups of past epochs resolve like on a live node
+        self.head = (int(time.time()) - GENESIS_TIMESTAMP) // BLOCK_TIME_SECONDS
+        self.pools = []
+        for index in range(max(n_pools, n_gauges)):
+            self.pools.append(
+                {
+                    "id": f"0x{index + 1:040x}0002{0:020x}",
+                    "address": _address(index + 1, "bb"),
+                    "symbol": f"BPT-{index}",
+                    "gauge": _address(index + 1, "cc"),
+                    "recipient": _address(index + 1, "dd"),
+                    "tokens": [
+                        _address(index * tokens_per_pool + token + 1, "ee")
+                        for token in range(tokens_per_pool)
+                    ],
+                    "weight": rnd.randint(10**14, 10**16),
+                    "fee_per_day": rnd.uniform(1, 1000),
+                }
+            )
+        self.gauge_pools = self.pools[:n_gauges]
+        self.pools_by_gauge = {pool["gauge"].lower(): pool for pool in self.pools}
+        self.pools_by_id = {bytes.fromhex(pool["id"][2:]): pool for pool in self.pools}
+        self.pools_by_address = {pool["address"].lower(): pool for pool in self.pools}
+
+    def block_timestamp(self, number: int) -> int:
+        return GENESIS_TIMESTAMP + number * BLOCK_TIME_SECONDS
+
+    def token_price(self, token_addr: str) -> float:
+        return 1 + int(token_addr[-4:], 16) / 1000
+
+
+class MockServer:
+    """
+    Threaded HTTP server with a fixed latency per request, counting requests and bytes per stage
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = defaultdict(int)
+        self.bytes: Dict[str, int] = defaultdict(int)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers["Content-Length"]))
+                stage, response = server.handle(json.loads(raw))
+                body = json.dumps(response).encode()
+                if server.latency:
+                    time.sleep(server.latency)
+                with server.lock:
+                    server.requests[stage] += 1
+                    server.bytes[stage] += len(raw) + len(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_port}/"
+
+    def handle(self, body: Dict) -> Tuple[str, Dict]:
+        raise NotImplementedError
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.requests.clear()
+            self.bytes.clear()
+
+    def __enter__(self) -> "MockServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class MockJsonRpcServer(MockServer):
+    """
+    JSON-RPC node answering the block and eth_call requests the pipeline makes, including Multicall3
+    aggregate3 batches of them
+    """
+
+    def __init__(self, world: MockWorld, latency: float = 0.0):
+        super().__init__(latency)
+        self.world = world
+        self.calls: Dict[bytes, Tuple[str, Callable[[str, bytes], Optional[bytes]]]] = {
+            _selector("gauge_relative_weight(address)"): (
+                "gauge_relative_weight",
+                self._gauge_relative_weight,
+            ),
+            _selector("getRecipient()"): ("getRecipient", self._get_recipient),
+            _selector("getPool(bytes32)"): ("getPool", self._get_pool),
+            _selector("getPoolTokens(bytes32)"): (
+                "getPoolTokens",
+                self._get_pool_tokens,
+            ),
+            _selector("totalSupply()"): ("totalSupply", self._total_supply),
+            _selector("decimals()"): (
+                "decimals",
+                lambda to, args: encode(["uint8"], [18]),
+            ),
+            _selector("name()"): (
+                "name",
+                lambda to, args: encode(["string"], ["Token"]),
+            ),
+            _selector("symbol()"): (
+                "symbol",
+                lambda to, args: encode(["string"], ["TKN"]),
+            ),
+        }
+        self.aggregate3 = _selector("aggregate3((address,bool,bytes)[])")
+
+    def _gauge_relative_weight(self, to: str, args: bytes) -> bytes:
+        (gauge,) = decode(["address"], args)
+        pool = self.world.pools_by_gauge.get(gauge.lower())
+        return encode(["uint256"], [pool["weight"] if pool else 0])
+
+    def _get_recipient(self, to: str, args: bytes) -> Optional[bytes]:
+        pool = self.world.pools_by_gauge.get(to.lower())
+        return encode(["address"], [pool["recipient"]]) if pool else None
+
+    def _get_pool(self, to: str, args: bytes) -> Optional[bytes]:
+        (pool_id,) = decode(["bytes32"], args)
+        pool = self.world.pools_by_id.get(pool_id)
+        return encode(["address", "uint8"], [pool["address"], 0]) if pool else None
+
+    def _get_pool_tokens(self, to: str, args: bytes) -> Optional[bytes]:
+        (pool_id,) = decode(["bytes32"], args)
+        pool = self.world.pools_by_id.get(pool_id)
+        if pool is None:
+            return None
+        return encode(
+            ["address[]", "uint256[]", "uint256"],
+            [pool["tokens"], [1000 * 10**18] * len(pool["tokens"]), 1],
+        )
+
+    def _total_supply(self, to: str, args: bytes) -> bytes:
+        pool = self.world.pools_by_address.get(to.lower())
+        supply = 1000 * 10**18 * (len(pool["tokens"]) if pool else 1)
+        return encode(["uint256"], [supply])
+
+    def _call(self, to: str, data: bytes) -> Tuple[str, Optional[bytes]]:
+        name, call = self.calls.get(data[:4], ("unknown", None))
+        return name, call(to, data[4:]) if call else None
+
+    def handle(self, body: Dict) -> Tuple[str, Dict]:
+        method, params = body["method"], body.get("params", [])
+        stage = method
+        error = None
+        result = None
+        if method == "eth_chainId":
+            result = "0x1"
+        elif method == "eth_blockNumber":
+            result = hex(self.world.head)
+        elif method == "eth_getBlockByNumber":
+            number = self.world.head if params[0] == "latest" else int(params[0], 16)
+            result = {
+                "number": hex(number),
+                "timestamp": hex(self.world.block_timestamp(number)),
+                "hash": "0x" + f"{number:064x}",
+            }
+        elif method == "eth_call":
+            to, data = params[0]["to"], bytes.fromhex(params[0]["data"][2:])
+            if to.lower() == MULTICALL3_ADDRESS.lower() and data[:4] == self.aggregate3:
+                (calls,) = decode(["(address,bool,bytes)[]"], data[4:])
+                results = [
+                    self._call(target, call_data) for target, _, call_data in calls
+                ]
+                names = sorted(set(name for name, _ in results))
+                stage = f"eth_call:aggregate3[{','.join(names)}]"
+                result = (
+                    "0x"
+                    + encode(
+                        ["(bool,bytes)[]"],
+                        [
+                            [
+                                (output is not None, output or b"")
+                                for _, output in results
+                            ]
+                        ],
+                    ).hex()
+                )
+            else:
+                name, output = self._call(to, data)
+                stage = f"eth_call:{name}"
+                if output is None:
+                    error = {"code": 3, "message": "execution reverted"}
+                else:
+                    result = "0x" + output.hex()
+        else:
+            error = {"code": -32601, "message": f"Method {method} not supported"}
+        response = {"jsonrpc": "2.0", "id": body.get("id")}
+        if error is not None:
+            response["error"] = error
+        else:
+            response["result"] = result
+        return stage, response
+
+
+MOCK_GRAPHQL_SDL = """
+scalar BigDecimal
+scalar BigInt
+enum OrderDirection { asc desc }
+enum PoolSnapshot_orderBy { id timestamp }
+enum Block_orderBy { number timestamp }
+enum GqlTokenChartDataRange { SEVEN_DAY THIRTY_DAY NINETY_DAY ONE_HUNDRED_EIGHTY_DAY ONE_YEAR }
+input PoolSnapshot_filter {
+  timestamp_gte: Int
+  timestamp_lt: Int
+  id_gt: String
+}
+input Block_filter {
+  timestamp_gt: BigInt
+  timestamp_lt: BigInt
+  timestamp_gte: BigInt
+}
+type SnapshotPool { id: String! address: String! }
+type PoolSnapshot {
+  id: ID!
+  pool: SnapshotPool!
+  timestamp: Int!
+  protocolFee: BigDecimal
+}
+type Block { number: BigInt! timestamp: BigInt! }
+type GqlVotingGauge {
+  address: String!
+  isKilled: Boolean!
+  relativeWeightCap: String
+  addedTimestamp: Int
+  childGaugeAddress: String
+}
+type GqlVotingPoolToken { address: String! logoURI: String symbol: String weight: String }
+type GqlVotingPool {
+  id: String!
+  address: String!
+  chain: String!
+  type: String
+  symbol: String!
+  gauge: GqlVotingGauge!
+  tokens: [GqlVotingPoolToken!]!
+}
+type GqlTokenPriceChartDataItem { id: String price: Float! timestamp: Int! }
+type Query {
+  poolSnapshots(
+    first: Int
+    skip: Int
+    orderBy: PoolSnapshot_orderBy
+    orderDirection: OrderDirection
+    where: PoolSnapshot_filter
+  ): [PoolSnapshot!]!
+  blocks(
+    first: Int
+    orderBy: Block_orderBy
+    orderDirection: OrderDirection
+    where: Block_filter
+  ): [Block!]!
+  veBalGetVotingList: [GqlVotingPool!]!
+  tokenGetPriceChartData(
+    address: String!
+    range: GqlTokenChartDataRange!
+  ): [GqlTokenPriceChartDataItem!]!
+}
+"""
+
+CHART_RANGE_DAYS = {
+    "SEVEN_DAY": 7,
+    "THIRTY_DAY": 30,
+    "NINETY_DAY": 90,
+    "ONE_HUNDRED_EIGHTY_DAY": 180,
+    "ONE_YEAR": 365,
+}
+
+
+class MockGraphQLServer(MockServer):
+    """
+    One endpoint standing in for the core and blocks subgraphs and the Balancer API
+    """
+
+    def __init__(self, world: MockWorld, latency: float = 0.0):
+        super().__init__(latency)
+        self.world = world
+        self.schema = build_schema(MOCK_GRAPHQL_SDL)
+        last_day = world.epoch_end // DAY_SECONDS * DAY_SECONDS
+        self.snapshots = sorted(
+            [
+                {
+                    "id": f"{pool['id']}-{last_day - day * DAY_SECONDS}",
+                    "pool": {"id": pool["id"], "address": pool["address"].lower()},
+                    "timestamp": last_day - day * DAY_SECONDS,
+                    "protocolFee": str(
+                        pool["fee_per_day"] * (world.snapshots_per_pool - day)
+                    ),
+                }
+                for pool in world.pools
+                for day in range(world.snapshots_per_pool)
+            ],
+            key=lambda snapshot: snapshot["id"],
+        )
+        self.snapshot_ids = [snapshot["id"] for snapshot in self.snapshots]
+        self.root = {
+            "poolSnapshots": self._pool_snapshots,
+            "blocks": self._blocks,
+            "veBalGetVotingList": self._voting_list,
+            "tokenGetPriceChartData": self._price_chart,
+        }
+
+    def _pool_snapshots(self, info, first=100, skip=0, where=None, **kwargs) -> List:
+        where = where or {}
+        start = 0
+        if "id_gt" in where:
+            start = bisect.bisect_right(self.snapshot_ids, where["id_gt"])
+        matches = []
+        for snapshot in self.snapshots[start:]:
+            if (
+                where.get("timestamp_gte", 0)
+                <= snapshot["timestamp"]
+                < where.get("timestamp_lt", 1 << 62)
+            ):
+                matches.append(snapshot)
+                if len(matches) == skip + first:
+                    break
+        return matches[skip:]
+
+    def _blocks(self, info, first=100, orderDirection="asc", where=None, **kwargs):
+        where = where or {}
+        low = int(where.get("timestamp_gte", int(where.get("timestamp_gt", 0)) + 1))
+        high = int(
+            where.get("timestamp_lt", self.world.block_timestamp(self.world.head))
+        )
+        first_number = -(-(low - GENESIS_TIMESTAMP) // BLOCK_TIME_SECONDS)
+        last_number = (high - 1 - GENESIS_TIMESTAMP) // BLOCK_TIME_SECONDS
+        numbers = range(first_number, last_number + 1)
+        if orderDirection == "desc":
+            numbers = reversed(numbers)
+        return [
+            {"number": number, "timestamp": self.world.block_timestamp(number)}
+            for number, _ in zip(numbers, range(first))
+        ]
+
+    def _voting_list(self, info) -> List:
+        return [
+            {
+                "id": pool["id"],
+                "address": pool["address"],
+                "chain": self.world.chain.upper(),
+                "symbol": pool["symbol"],
+                "gauge": {"address": pool["gauge"], "isKilled": False},
+                "tokens": [],
+            }
+            for pool in self.world.pools
+        ]
+
+    def _price_chart(self, info, address: str, **kwargs) -> List:
+        today = int(time.time()) // DAY_SECONDS * DAY_SECONDS
+        price = self.world.token_price(address)
+        return [
+            {"price": price, "timestamp": today - day * DAY_SECONDS}
+            for day in range(CHART_RANGE_DAYS[kwargs["range"]])
+        ]
+
+    def handle(self, body: Dict) -> Tuple[str, Dict]:
+        document = parse(body["query"])
+        fields = sorted(
+            set(
+                selection.name.value
+                for definition in document.definitions
+                if isinstance(definition, OperationDefinitionNode)
+                for selection in definition.selection_set.selections
+                if hasattr(selection, "name")
+            )
+        )
+        result = graphql_sync(
+            self.schema,
+            body["query"],
+            root_value=self.root,
+            variable_values=body.get("variables"),
+        )
+        response = {"data": result.data}
+        if result.errors:
+            response["errors"] = [error.formatted for error in result.errors]
+        return "+".join(fields), response
@@ -0,0 +1,358 @@
+"""
+End-to-end benchmarks of the pipeline against local mock JSON-RPC and GraphQL servers.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks --gauges 10,100,1000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+from contextlib import redirect_stdout
+from datetime import datetime
+from typing import Callable
+from typing import Dict
+from typing import List
+from unittest import mock
+
+from benchmarks.mock_servers import DAY_SECONDS
+from benchmarks.mock_servers import MockGraphQLServer
+from benchmarks.mock_servers import MockJsonRpcServer
+from benchmarks.mock_servers import MockServer
+from benchmarks.mock_servers import MockWorld
+
+BENCHMARK_CHAIN = "arbitrum"
+# The last full day a week ago, recent enough for the price API to serve the epoch's prices
+EPOCH_END = (int(time.time()) // DAY_SECONDS - 7) * DAY_SECONDS
+GAUGE_CONTROLLER = "0xC128468b7Ce63eA702C1f104D55A2566b13D3ABD"
+BAL_PRICE_USD = 4.0
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Each scenario runs twice on the same caches: a cold run like the first one of a fresh checkout,
+# and a warm one like every run after it. Checkpoints are not kept between the two, a warm run resumed
+# from them would make no requests at all
+PHASES = ("cold", "warm")
+
+try:
+    from automation import constants  # noqa: F401
+except ImportError:
+    sys.exit(
+        "automation/constants.py is missing, copy automation/constants.py.example to create it"
+    )
+
+from automation import helpers
+from automation import lstGrant
+from automation.allocation import to_wei
+from automation.cache import set_cache_dir
+from automation.checkpoints import set_checkpoint_dir
+from automation import transports
+from automation.program_config import ProgramConfig
+from automation.transports import make_web3
+
+
+def _patch_endpoints(stack: ExitStack, rpc_url: str, gql_url: str) -> List[Dict]:
+    """
+    Point every outside lookup of the pipeline at the mock servers. Outputs are collected in memory
+    and run metrics go to a temporary directory instead of output/
+    """
+    outputs = []
+    root_dir = stack.enter_context(
+        tempfile.TemporaryDirectory(prefix="benchmark_root_")
+    )
+    stack.enter_context(mock.patch.object(lstGrant, "get_root_dir", lambda: root_dir))
+    stack.enter_context(mock.patch.dict(os.environ, {"ETHNODEURL": rpc_url}))
+    stack.enter_context(mock.patch.object(helpers, "BAL_GQL_URL", gql_url))
+    for module in (helpers, lstGrant):
+        stack.enter_context(
+            mock.patch.object(
+                module, "get_subgraph_url", lambda chain, subgraph: gql_url
+            )
+        )
+    stack.enter_context(
+        mock.patch.object(
+            lstGrant, "get_gauge_controller_address", lambda: GAUGE_CONTROLLER
+        )
+    )
+    stack.enter_context(
+        mock.patch.object(lstGrant, "get_chain_name", lambda chain: chain)
+    )
+    stack.enter_context(
+        mock.patch.object(
+            transports,
+            "get_coingecko_price",
+            lambda ids, vs_currencies: {"balancer": {"usd": BAL_PRICE_USD}},
+        )
+    )
+    stack.enter_context(
+        mock.patch.object(
+            lstGrant,
+            "save_program_outputs",
+            lambda config, distributions, *args: outputs.append(distributions),
+        )
+    )
+    return outputs
+
+
+def _program_config(world: MockWorld) -> ProgramConfig:
+    return ProgramConfig(
+        file_prefix="benchmark",
+        chain_name=world.chain,
+        total_tokens_per_epoch=10_000,
+        fixed_incentive_tokens_per_epoch=0,
+        dynamic_boost_cap=3,
+        min_bal_in_usd_for_boost=200,
+        desired_default_vote_cap=30,
+        boost_data={},
+        cap_override_data={},
+        fixed_emissions_per_pool={pool["id"]: 0 for pool in world.gauge_pools},
+    )
+
+
+def _scenarios(
+    world: MockWorld, rpc_url: str, outputs: List[Dict]
+) -> Dict[str, Callable[[], None]]:
+    config = _program_config(world)
+    pool_ids = [pool["id"] for pool in world.gauge_pools]
+    epoch_start = datetime.fromtimestamp(EPOCH_END)
+    block_number = world.head - 1000
+
+    def _run_stip_pipeline():
+        lstGrant.run_stip_pipeline(EPOCH_END, config)
+        distributed = sum(gauge["distributionWei"] for gauge in outputs[-1].values())
+        assert distributed == to_wei(config.total_tokens_per_epoch), distributed
+
+    def _get_twap_bpt_price():
+        web3 = make_web3(rpc_url, world.chain)
+        for pool_id in pool_ids:
+            assert helpers.get_twap_bpt_price(
+                pool_id, world.chain, web3, epoch_start, block_number
+            )
+
+    def _get_twap_bpt_prices():
+        web3 = make_web3(rpc_url, world.chain)
+        prices = helpers.get_twap_bpt_prices(
+            pool_ids, world.chain, web3, epoch_start, block_number
+        )
+        assert all(prices.values())
+
+    return {
+        "run_stip_pipeline": _run_stip_pipeline,
+        "get_twap_bpt_price": _get_twap_bpt_price,
+        "get_twap_bpt_prices": _get_twap_bpt_prices,
+    }
+
+
+def _collect_stats(servers: Dict[str, MockServer]) -> Dict[str, Dict[str, int]]:
+    stats = {}
+    for prefix, server in servers.items():
+        for stage, count in server.requests.items():
+            stats[f"{prefix}:{stage}"] = {
+                "requests": count,
+                "bytes": server.bytes[stage],
+            }
+        server.reset_stats()
+    return stats
+
+
+def run_size(
+    n_gauges: int,
+    n_pools: int,
+    snapshots_per_pool: int,
+    tokens_per_pool: int,
+    latency: float,
+    verbose: bool = False,
+) -> Dict:
+    """
+    Run every scenario cold and warm against fresh mock servers for one world size
+    """
+    world = MockWorld(
+        BENCHMARK_CHAIN,
+        EPOCH_END,
+        n_gauges=n_gauges,
+        n_pools=n_pools,
+        snapshots_per_pool=snapshots_per_pool,
+        tokens_per_pool=tokens_per_pool,
+    )
+    results = {}
+    with MockJsonRpcServer(world, latency) as rpc, MockGraphQLServer(
+        world, latency
+    ) as gql, ExitStack() as stack:
+        outputs = _patch_endpoints(stack, rpc.url, gql.url)
+        servers = {"rpc": rpc, "gql": gql}
+        for name, scenario in _scenarios(world, rpc.url, outputs).items():
+            cache_dir = tempfile.mkdtemp(prefix="benchmark_cache_")
+            set_cache_dir(cache_dir)
+            try:
+                results[name] = {}
+                for phase in PHASES:
+                    set_checkpoint_dir(os.path.join(cache_dir, f"checkpoints_{phase}"))
+                    started = time.perf_counter()
+                    if verbose:
+                        scenario()
+                    else:
+                        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                            scenario()
+                    wall_time = time.perf_counter() - started
+                    results[name][phase] = {
+                        "wallTime": wall_time,
+                        "stages": _collect_stats(servers),
+                    }
+            finally:
+                set_checkpoint_dir(None)
+                set_cache_dir(None)
+                shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+
+def print_report(results: Dict) -> None:
+    for n_gauges, scenarios in results.items():
+        for name, phases in scenarios.items():
+            for phase, result in phases.items():
+                stages = result["stages"]
+                print(
+                    f"\n{name} [{n_gauges} gauges, {phase}]: {result['wallTime']:.2f}s, "
+                    f"{sum(s['requests'] for s in stages.values())} requests, "
+                    f"{sum(s['bytes'] for s in stages.values()) / 1024:.1f} KiB"
+                )
+                for stage, stats in sorted(stages.items()):
+                    print(
+                        f"  {stage:<70} {stats['requests']:>6} req {stats['bytes'] / 1024:>10.1f} KiB"
+                    )
+
+
+def request_counts(results: Dict) -> Dict:
+    return {
+        n_gauges: {
+            name: {
+                phase: {
+                    stage: stats["requests"]
+                    for stage, stats in result["stages"].items()
+                }
+                for phase, result in phases.items()
+            }
+            for name, phases in scenarios.items()
+        }
+        for n_gauges, scenarios in results.items()
+    }
+
+
+def find_regressions(counts: Dict, baseline: Dict) -> List[str]:
+    """
+    Every stage that needs more requests than in the baseline, or didn't exist in it
+    """
+    regressions = []
+    for n_gauges, scenarios in counts.items():
+        if n_gauges not in baseline:
+            print(f"WARNING: No baseline for {n_gauges} gauges, not checked")
+            continue
+        for name, phases in scenarios.items():
+            for phase, stages in phases.items():
+                expected = baseline[n_gauges].get(name, {}).get(phase, {})
+                for stage, count in stages.items():
+                    if count > expected.get(stage, 0):
+                        regressions.append(
+                            f"{name} [{n_gauges} gauges, {phase}] {stage}: "
+                            f"{count} requests, baseline {expected.get(stage, 0)}"
+                        )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--gauges",
+        help="Comma separated numbers of program gauges to benchmark",
+        type=str,
+        default="10,100,1000",
+    )
+    parser.add_argument(
+        "--pools",
+        help="Pools in the voting list, defaults to twice the number of gauges",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--snapshots-per-pool",
+        help="Daily fee snapshots per pool",
+        type=int,
+        default=30,
+    )
+    parser.add_argument(
+        "--tokens-per-pool", help="Tokens in every pool", type=int, default=3
+    )
+    parser.add_argument(
+        "--latency-ms",
+        help="Latency the mock servers add to every request",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--baseline",
+        help="Request count baseline to check against",
+        type=str,
+        default=DEFAULT_BASELINE_PATH,
+    )
+    parser.add_argument(
+        "--update-baseline",
+        help="Write the measured request counts as the new baseline",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verbose", help="Show the pipeline's own output", action="store_true"
+    )
+    parser.add_argument(
+        "--output", help="Write the full results as JSON to this file", type=str
+    )
+    args = parser.parse_args()
+
+    sizes = {
+        "pools": args.pools,
+        "snapshotsPerPool": args.snapshots_per_pool,
+        "tokensPerPool": args.tokens_per_pool,
+    }
+    results = {}
+    for n_gauges in [int(n) for n in args.gauges.split(",")]:
+        results[str(n_gauges)] = run_size(
+            n_gauges,
+            args.pools or 2 * n_gauges,
+            args.snapshots_per_pool,
+            args.tokens_per_pool,
+            args.latency_ms / 1000,
+            args.verbose,
+        )
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"sizes": sizes, "results": results}, f, indent=2)
+
+    counts = request_counts(results)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"sizes": sizes, "requests": counts}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nBaseline written to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"\nWARNING: No baseline at {args.baseline}, request counts not checked")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["sizes"] != sizes:
+        print(
+            f"\nWARNING: Baseline was recorded with sizes {baseline['sizes']}, request counts not checked"
+        )
+        return
+    regressions = find_regressions(counts, baseline["requests"])
+    if regressions:
+        print("\nRequest count regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("\nNo request count regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,13 @@
+from contextlib import nullcontext
+
+from automation.backfill import run_backfill
+from automation.cassette import use_cassette
+from automation.checkpoints import CHECKPOINT_STAGES
+from automation.checkpoints import force_stage
 from automation.lstGrant import run_stip_pipeline
+from automation.metrics import enable_otel_export
+from automation.multi_program import run_programs
+from automation.program_config import load_program_config
 import argparse
 
 # TS_NOW = 1702512000
@@ -9,7 +18,91 @@ parser = argparse.ArgumentParser()
 parser.add_argument(
     "--ts_bound", help="Timestamp up to which to run", type=int, required=False
 )
+parser.add_argument(
+    "--programs",
+    help="Comma separated pool config file prefixes to run concurrently, defaults to FILE_PREFIX in constants.py",
+    type=str,
+    required=False,
+)
+parser.add_argument(
+    "--from",
+    dest="from_ts",
+    help="Backfill mode: end timestamp of the first epoch to recompute, epochs follow every two weeks",
+    type=int,
+    required=False,
+)
+parser.add_argument(
+    "--to",
+    dest="to_ts",
+    help="Backfill mode: end timestamp of the last epoch to recompute, defaults to --ts_bound",
+    type=int,
+    required=False,
+)
+parser.add_argument(
+    "--workers",
+    help="Number of programs to run at the same time when running several programs",
+    type=int,
+    required=False,
+)
+parser.add_argument(
+    "--otel-spans",
+    help="Also export every pipeline stage as an OpenTelemetry span to this file (needs opentelemetry-sdk)",
+    dest="otel_spans",
+    type=str,
+    required=False,
+)
+parser.add_argument(
+    "--force-stage",
+    help="Recompute this stage and every stage after it instead of resuming from their checkpoints",
+    dest="force_stage",
+    choices=CHECKPOINT_STAGES,
+    required=False,
+)
+cassette_group = parser.add_mutually_exclusive_group()
+cassette_group.add_argument(
+    "--record",
+    help="Record every RPC, GraphQL and price API response of the run to this cassette file (.json.gz)",
+    type=str,
+    required=False,
+)
+cassette_group.add_argument(
+    "--replay",
+    help="Run offline, serving every outside request from this cassette file",
+    type=str,
+    required=False,
+)
 
 if __name__ == "__main__":
-    ts_now = parser.parse_args().ts_bound or TS_NOW
-    run_stip_pipeline(ts_now)
+    args = parser.parse_args()
+    ts_now = args.ts_bound or TS_NOW
+    if args.force_stage:
+        force_stage(args.force_stage)
+    if args.otel_spans:
+        enable_otel_export(args.otel_spans)
+    if args.record:
+        cassette = use_cassette(args.record, "record")
+    elif args.replay:
+        cassette = use_cassette(args.replay, "replay")
+    else:
+        cassette = nullcontext()
+    with cassette:
+        if args.from_ts:
+            run_backfill(
+                args.from_ts,
+                args.to_ts or ts_now,
+                [
+                    load_program_config(prefix)
+                    for prefix in (
+                        args.programs.split(",") if args.programs else [None]
+                    )
+                ],
+                max_workers=args.workers,
+            )
+        elif args.programs:
+            run_programs(
+                ts_now,
+                [load_program_config(prefix) for prefix in args.programs.split(",")],
+                max_workers=args.workers,
+            )
+        else:
+            run_stip_pipeline(ts_now)
@@ -0,0 +1,45 @@
+import pytest
+
+from automation import helpers
+from automation.cache import set_cache_dir
+from automation.helpers import get_block_by_ts
+
+TIMESTAMP = 1718000000
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path):
+    set_cache_dir(str(tmp_path))
+    yield tmp_path
+    set_cache_dir(None)
+
+
+class LaggingEth:
+    """
+    eth namespace of a node whose head block is older than TIMESTAMP
+    """
+
+    def get_block(self, identifier):
+        return {"number": 100, "timestamp": TIMESTAMP - 600}
+
+
+class LaggingWeb3:
+    eth = LaggingEth()
+
+
+class BlocksClient:
+    def execute(self, query):
+        return {
+            "before": [{"number": "150", "timestamp": str(TIMESTAMP - 12)}],
+            "after": [{"number": "151", "timestamp": str(TIMESTAMP)}],
+        }
+
+
+def test_lagging_node_falls_back_to_the_blocks_subgraph(monkeypatch):
+    monkeypatch.setattr(helpers, "get_subgraph_url", lambda chain, subgraph: "")
+    monkeypatch.setattr(helpers, "get_gql_client", lambda url: BlocksClient())
+
+    assert get_block_by_ts(TIMESTAMP, "mainnet", LaggingWeb3()) == 151
+    # The answer from the subgraph is resolved for good, the next lookup is local
+    monkeypatch.setattr(helpers, "get_gql_client", None)
+    assert get_block_by_ts(TIMESTAMP, "mainnet", LaggingWeb3()) == 151
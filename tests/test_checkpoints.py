@@ -0,0 +1,32 @@
+import pytest
+
+from automation import checkpoints
+from automation.checkpoints import checkpointed
+from automation.checkpoints import clear_checkpoints
+from automation.checkpoints import use_checkpoints
+
+
+@pytest.fixture(autouse=True)
+def checkpoint_dir(tmp_path):
+    checkpoints.set_checkpoint_dir(str(tmp_path))
+    yield tmp_path
+    checkpoints.set_checkpoint_dir(None)
+
+
+def _run(program, epoch, price):
+    with use_checkpoints(program, epoch):
+        return checkpointed("bal_price", {}, lambda: price)
+
+
+def test_failed_run_resumes_from_its_checkpoints():
+    assert _run("program", "2024-06-11", 4.0) == 4.0
+    assert _run("program", "2024-06-11", 5.0) == 4.0
+
+
+def test_cleared_run_fetches_afresh_and_keeps_other_runs():
+    _run("program", "2024-06-11", 4.0)
+    _run("other_program", "2024-06-11", 4.0)
+    clear_checkpoints("program", "2024-06-11")
+
+    assert _run("program", "2024-06-11", 5.0) == 5.0
+    assert _run("other_program", "2024-06-11", 5.0) == 4.0
@@ -0,0 +1,156 @@
+import json
+import os
+import shutil
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from automation import payload_builders
+from automation.allocation import WEI
+from automation.allocation import apportion
+from automation.payload_builders import AURA_DIRECT_TEMPLATE
+from automation.payload_builders import INJECTOR_PERIODS
+from automation.payload_builders import INJECTOR_TEMPLATE
+from automation.payload_builders import generate_and_save_aura_transaction
+from automation.payload_builders import generate_and_save_payloads
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+START = datetime(2024, 5, 28)
+END = datetime(2024, 6, 11)
+
+
+@pytest.fixture
+def root_dir(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / "data")
+    shutil.copy(
+        os.path.join(REPO_ROOT, "data", INJECTOR_TEMPLATE),
+        tmp_path / "data" / INJECTOR_TEMPLATE,
+    )
+    monkeypatch.setattr(payload_builders, "get_root_dir", lambda: str(tmp_path))
+    payload_builders.load_template.cache_clear()
+    yield tmp_path
+    payload_builders.load_template.cache_clear()
+
+
+@pytest.fixture
+def aura_template(root_dir, monkeypatch):
+    template = {
+        "version": "1.0",
+        "transactions": [
+            {
+                "contractMethod": {"name": "approve"},
+                "contractInputsValues": {"spender": "0x0", "amount": "0"},
+            },
+            {
+                "contractMethod": {"name": "streamRewards"},
+                "contractInputsValues": {"_pid": "0", "_amount": "0", "_periods": "0"},
+            },
+        ],
+    }
+    with open(root_dir / "data" / AURA_DIRECT_TEMPLATE, "w") as f:
+        json.dump(template, f)
+    monkeypatch.setattr(
+        payload_builders, "get_aura_pids", lambda chain_name: {f"0x{1000:040x}": 7}
+    )
+    return root_dir
+
+
+def _distributions(amounts):
+    return {
+        f"0x{i:040x}": {
+            "recipientGaugeAddr": f"0x{i + 1000:040x}",
+            "distributionWei": amount,
+            "distroToBalancerWei": amount,
+        }
+        for i, amount in enumerate(amounts)
+    }
+
+
+def _inputs(payload, method):
+    return next(
+        tx["contractInputsValues"]
+        for tx in payload["transactions"]
+        if tx["contractMethod"]["name"] == method
+    )
+
+
+def test_injector_payload_pays_out_the_allocated_total(root_dir):
+    total_wei = 7520 * WEI + 1
+    # Allocated the way calculate_gauge_distributions does, in units of INJECTOR_PERIODS wei
+    amounts = [
+        int(amount) * INJECTOR_PERIODS
+        for amount in apportion(total_wei // INJECTOR_PERIODS, [3, 7, 11, 13, 17])
+    ]
+    generate_and_save_payloads(
+        _distributions(amounts), START, END, "arbitrum", "test_program"
+    )
+
+    with open(
+        root_dir
+        / "output"
+        / "test_program_2024-05-28_2024-06-11_bal_injector_stream.json"
+    ) as f:
+        payload = json.load(f)
+    recipients = _inputs(payload, "setRecipientList")
+    per_period = json.loads(recipients["amountsPerPeriod"])
+    periods = json.loads(recipients["maxPeriods"])
+    assert sum(amount * n for amount, n in zip(per_period, periods)) == sum(amounts)
+    assert int(_inputs(payload, "transfer")["amount"]) == sum(amounts)
+    assert total_wei - sum(amounts) < INJECTOR_PERIODS
+
+
+def test_uneven_injector_amount_is_rejected(root_dir):
+    with pytest.raises(ValueError):
+        generate_and_save_payloads(
+            _distributions([WEI + 1]), START, END, "arbitrum", "test_program"
+        )
+
+
+def _aura_streams(payload):
+    return [
+        tx["contractInputsValues"]
+        for tx in payload["transactions"]
+        if "_pid" in tx["contractInputsValues"]
+    ]
+
+
+def test_aura_direct_payload_is_built_alongside_the_injector(aura_template):
+    distributions = _distributions([2 * WEI, 4 * WEI])
+    for gauge in distributions.values():
+        gauge["distroToAuraWei"] = WEI
+    generate_and_save_payloads(distributions, START, END, "arbitrum", "test_program")
+
+    with open(
+        aura_template
+        / "output"
+        / "test_program_2024-05-28_2024-06-11_aura_direct_stream.json"
+    ) as f:
+        payload = json.load(f)
+    assert _inputs(payload, "approve")["amount"] == str(2 * WEI)
+    streams = _aura_streams(payload)
+    # Gauges without an aura pid keep their address, so they are easy to spot
+    assert [stream["_pid"] for stream in streams] == [7, f"0x{1001:040x}"]
+    assert all(stream["_amount"] == str(WEI) for stream in streams)
+
+
+def test_aura_transaction_sends_a_share_of_each_distribution(
+    aura_template, monkeypatch
+):
+    monkeypatch.setattr(
+        payload_builders,
+        "_default_path",
+        lambda start, end, suffix: str(aura_template / "output" / suffix),
+    )
+    distributions = _distributions([0, 0])
+    for gauge, amount in zip(distributions.values(), ["10", "0"]):
+        gauge["distroToAura"] = amount
+
+    payload = generate_and_save_aura_transaction(
+        distributions, START, END, "arbitrum", pct_of_distribution=Decimal("0.25")
+    )
+
+    assert _inputs(payload, "approve")["amount"] == str(WEI * 5 // 2)
+    assert [stream["_amount"] for stream in _aura_streams(payload)] == [
+        str(WEI * 5 // 2)
+    ]
@@ -0,0 +1,121 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+from pycoingecko import CoinGeckoAPI
+
+from automation import scheduler
+from automation.scheduler import MAX_RETRIES
+from automation.transports import get_coingecko_price
+from automation.transports import make_web3
+
+
+@pytest.fixture
+def failing_server():
+    """
+    HTTP server answering every request with a 503, counting the requests it got
+    """
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _fail(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            requests_seen.append(json.loads(body) if body else self.path)
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        do_GET = _fail
+        do_POST = _fail
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", requests_seen
+    server.shutdown()
+
+
+@pytest.fixture
+def rpc_server():
+    """
+    JSON-RPC node answering eth_chainId and eth_call, recording the methods it was asked for
+    """
+    methods_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            methods_seen.append(request["method"])
+            result = "0x1" if request["method"] == "eth_chainId" else "0x"
+            body = json.dumps(
+                {"jsonrpc": "2.0", "id": request["id"], "result": result}
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", methods_seen
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(scheduler, "BACKOFF_BASE_SECONDS", 0.0)
+    monkeypatch.setattr(scheduler, "_scheduler", scheduler.RequestScheduler())
+
+
+def test_failing_rpc_call_is_tried_once_per_scheduler_attempt(failing_server):
+    url, requests_seen = failing_server
+    web3 = make_web3(url, "mainnet")
+    with pytest.raises(requests.HTTPError):
+        web3.eth.get_block(1)
+    assert len(requests_seen) == MAX_RETRIES + 1
+
+
+def test_failing_hedged_rpc_call_is_tried_once_per_scheduler_attempt(failing_server):
+    url, requests_seen = failing_server
+    # Two urls of the same node, so every request is counted by the one server
+    web3 = make_web3([url, f"{url}/"], "mainnet")
+    with pytest.raises(requests.HTTPError):
+        web3.eth.get_block("latest")
+    assert len(requests_seen) == 2 * (MAX_RETRIES + 1)
+
+
+def test_failing_price_lookup_is_tried_once_per_scheduler_attempt(
+    failing_server, monkeypatch
+):
+    url, requests_seen = failing_server
+    original_init = CoinGeckoAPI.__init__
+
+    def _init(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        # The mock server speaks plain http, give it the retrying adapter pycoingecko mounts for https
+        self.session.mount("http://", self.session.get_adapter("https://"))
+
+    monkeypatch.setattr(CoinGeckoAPI, "__init__", _init)
+    monkeypatch.setattr(CoinGeckoAPI, "_CoinGeckoAPI__API_URL_BASE", f"{url}/")
+    with pytest.raises(Exception):
+        get_coingecko_price(ids="balancer", vs_currencies="usd")
+    assert len(requests_seen) == MAX_RETRIES + 1
+
+
+def test_chain_id_is_fetched_once_per_web3_instance(rpc_server):
+    url, methods_seen = rpc_server
+    web3 = make_web3(url, "mainnet")
+    for _ in range(3):
+        web3.eth.call({"to": f"0x{1:040x}", "data": "0x"})
+    assert methods_seen.count("eth_chainId") == 1
+    assert methods_seen.count("eth_call") == 3